@@ -193,7 +193,7 @@ def generate_tts_audio(
     maintains the prosody, tone, and vocal qualities of the reference speaker, or uses default voice if no reference is provided.
 
     Args:
-        text_input (str): The text to synthesize into speech (maximum 300 characters)
+        text_input (str): The text to synthesize into speech (long text is split into sentence-sized chunks)
         language_id (str): The language code for synthesis (eg. en, fr, de, es, it, pt, hi)
         audio_prompt_path_input (str, optional): File path or URL to the reference audio file that defines the target voice style. Defaults to None.
         exaggeration_input (float, optional): Controls speech expressiveness (0.25-2.0, neutral=0.5, extreme values may be unstable). Defaults to 0.5.
@@ -228,8 +228,8 @@ def generate_tts_audio(
     else:
         print("No audio prompt provided; using default voice.")
         
-    wav = current_model.generate(
-        text_input[:300],  # Truncate text to max chars
+    wav = current_model.generate_long(
+        text_input,  # split into sentence-sized chunks
         language_id=language_id,
         **generate_kwargs
     )
@@ -251,7 +251,7 @@ with gr.Blocks() as demo:
             initial_lang = "fr"
             text = gr.Textbox(
                 value=default_text_for_ui(initial_lang),
-                label="Text to synthesize (max chars 300)",
+                label="Text to synthesize",
                 max_lines=5
             )
             
@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from .models.t3.modules.cond_enc import T3Cond
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConditionalsCache:
+    """
+    Content-addressed cache of the voice conditionals made by `prepare_conditionals`: a bounded in-memory LRU,
+    optionally backed by a directory of `Conditionals.save` files that outlives the process.
+
+    Entries are keyed by the bytes of the reference audio plus the model kind and preprocessing options, so the same
+    clip sent again (under any file name) skips loading, resampling, `S3Gen.embed_ref`, prompt tokenization and the
+    voice encoder. Exaggeration is not part of the key; callers set `emotion_adv` on the returned conditionals.
+    """
+
+    def __init__(self, max_entries: int = 32, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(wav_fpath, *extra):
+        "sha256 of the audio content and `extra` (model kind, preprocessing flags)"
+        h = hashlib.sha256()
+        if hasattr(wav_fpath, "read"):
+            pos = wav_fpath.tell()
+            h.update(wav_fpath.read())
+            wav_fpath.seek(pos)
+        else:
+            with open(wav_fpath, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+        h.update(repr(extra).encode())
+        return h.hexdigest()
+
+    def get(self, key, conds_cls, device):
+        "A fresh `conds_cls` instance on `device` for `key`, or None on a miss."
+        with self._lock:
+            conds = self._entries.get(key)
+            if conds is not None:
+                self._entries.move_to_end(key)
+        if conds is None and self.cache_dir is not None:
+            fpath = self._fpath(key)
+            if fpath.exists():
+                try:
+                    conds = conds_cls.load(fpath, map_location=device)
+                except Exception as e:
+                    logger.warning(f"ignoring unreadable cached conditionals {fpath}: {e}")
+                else:
+                    self._remember(key, conds)
+        if conds is None:
+            return None
+        return self._copy(conds, conds_cls).to(device)
+
+    def put(self, key, conds):
+        conds = self._copy(conds, type(conds))
+        self._remember(key, conds)
+        if self.cache_dir is not None:
+            fpath = self._fpath(key)
+            tmp = fpath.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            conds.save(tmp)
+            os.replace(tmp, fpath)  # atomic, concurrent writers of the same key are harmless
+
+    def clear(self):
+        "Drop the in-memory entries (files in `cache_dir` are kept)."
+        with self._lock:
+            self._entries.clear()
+
+    def _remember(self, key, conds):
+        with self._lock:
+            self._entries[key] = conds
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _fpath(self, key) -> Path:
+        return self.cache_dir / f"{key}.pt"
+
+    @staticmethod
+    def _copy(conds, conds_cls):
+        # New containers sharing the tensors: callers replace fields of their `Conditionals` (eg `emotion_adv`, or
+        # `T3.prepare_conditioning` filling `cond_prompt_speech_emb`), which must not leak into the cache.
+        t3 = dict(conds.t3.__dict__)
+        if t3["cond_prompt_speech_tokens"] is not None:
+            t3["cond_prompt_speech_emb"] = None  # derived from the tokens by T3, per model
+        return conds_cls(T3Cond(**t3), dict(conds.gen))
@@ -0,0 +1,222 @@
+"""
+Bulk voice enrollment: reference clips -> `VoiceLibrary`.
+
+Clips are decoded, resampled and prepared for the voice encoder on a pool of worker threads, then grouped into
+buckets of equal length so the S3Gen reference embedding (mel, fbank + CAMPPlus, S3 tokens), the T3 prompt tokens
+and the voice encoder run on whole batches. Equal lengths mean no padding, so every voice is the same as with
+`prepare_conditionals` (up to the `bucket_ms` trimming of clips shorter than the conditioning windows).
+
+    python -m chatterbox.enroll --out voices.cbvl clips/          # voice id = path relative to clips/, no suffix
+    python -m chatterbox.enroll --out voices.cbvl manifest.tsv    # "<voice id>\t<path>" per line
+"""
+import argparse
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from importlib import import_module
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import librosa
+import numpy as np
+import torch
+
+from .models.s3tokenizer import S3_SR
+from .models.s3gen import S3GEN_SR
+from .models.t3.modules.cond_enc import T3Cond
+from .models.voice_encoder.melspec import melspectrogram
+from .voice_library import VoiceLibrary
+
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = {".wav", ".flac", ".mp3", ".ogg", ".opus", ".m4a"}
+
+
+def read_clips(path) -> List[Tuple[str, str]]:
+    """
+    `(voice_id, audio_path)` pairs from a directory (every audio file in it, recursively; the voice id is the path
+    relative to the directory without suffix) or from a manifest with a tab- or comma-separated voice id and path per
+    line (relative paths are relative to the manifest; blank lines and lines starting with "#" are skipped).
+    """
+    path = Path(path)
+    if path.is_dir():
+        return [
+            (fpath.relative_to(path).with_suffix("").as_posix(), str(fpath))
+            for fpath in sorted(path.rglob("*")) if fpath.suffix.lower() in AUDIO_EXTENSIONS
+        ]
+
+    clips = []
+    for line in path.read_text().splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        voice_id, fpath = line.split("\t" if "\t" in line else ",", 1)
+        fpath = Path(fpath.strip())
+        clips.append((voice_id.strip(), str(fpath if fpath.is_absolute() else path.parent / fpath)))
+    return clips
+
+
+@dataclass
+class _Clip:
+    voice_id: str
+    ref_wav: np.ndarray  # 24 kHz, at most DEC_COND_LEN, for `S3Gen.embed_ref`
+    prompt_wav: np.ndarray  # 16 kHz, at most ENC_COND_LEN, for the T3 prompt tokens
+    ve_mel: np.ndarray  # (T, M) voice-encoder mel of the whole (trimmed) clip
+
+
+def _decode(voice_id, fpath, model, bucket_ms) -> Optional[_Clip]:
+    "Worker side of `enroll`: the per-clip (numpy / librosa) part of `prepare_conditionals`."
+    try:
+        wav, _ = librosa.load(fpath, sr=S3GEN_SR)
+        if hasattr(model, "norm_loudness"):  # Turbo
+            if len(wav) / S3GEN_SR <= 5.0:
+                logger.warning(f"skipping {voice_id}: audio prompt must be longer than 5 seconds")
+                return None
+            wav = model.norm_loudness(wav, S3GEN_SR)
+        wav_16k = librosa.resample(wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
+
+        ve_wav = librosa.effects.trim(wav_16k, top_db=20)[0]  # as `VoiceEncoder.embeds_from_wavs`
+        ve_mel = melspectrogram(ve_wav, model.ve.hp).T
+
+        # trim clips shorter than the conditioning windows to a multiple of `bucket_ms`, so they share buckets
+        ref_wav = wav[:model.DEC_COND_LEN]
+        prompt_wav = wav_16k[:model.ENC_COND_LEN]
+        if bucket_ms:
+            if len(ref_wav) < model.DEC_COND_LEN:
+                step = bucket_ms * S3GEN_SR // 1000
+                ref_wav = ref_wav[:max(step, len(ref_wav) // step * step)]
+            if len(prompt_wav) < model.ENC_COND_LEN:
+                step = bucket_ms * S3_SR // 1000
+                prompt_wav = prompt_wav[:max(step, len(prompt_wav) // step * step)]
+        return _Clip(voice_id, ref_wav, prompt_wav, ve_mel)
+    except Exception as e:
+        logger.warning(f"skipping {voice_id} ({fpath}): {e}")
+        return None
+
+
+@torch.inference_mode()
+def _embed_batch(model, clips: List[_Clip], exaggeration) -> Iterator[Tuple[str, object]]:
+    "Batched, model side of `enroll` for clips of equal `ref_wav` and `prompt_wav` lengths."
+    conds_cls = import_module(type(model).__module__).Conditionals
+    s3gen_ref_dict = model.s3gen.embed_ref(torch.from_numpy(np.stack([c.ref_wav for c in clips])), S3GEN_SR)
+
+    t3_cond_prompt_tokens = None
+    if plen := model.t3.hp.speech_cond_prompt_len:
+        t3_cond_prompt_tokens, _ = model.s3gen.tokenizer.forward([c.prompt_wav for c in clips], max_len=plen)
+
+    # (rate: as `VoiceEncoder.embeds_from_wavs`)
+    ve_embeds = model.ve.embeds_from_mels([c.ve_mel for c in clips], rate=1.3)
+
+    for i, clip in enumerate(clips):
+        t3_cond = T3Cond(
+            speaker_emb=torch.from_numpy(ve_embeds[i:i + 1]),
+            cond_prompt_speech_tokens=None if t3_cond_prompt_tokens is None else t3_cond_prompt_tokens[i:i + 1],
+            emotion_adv=exaggeration * torch.ones(1, 1, 1),
+        ).to(device="cpu")
+        gen = {k: v[i:i + 1].cpu() if torch.is_tensor(v) else v for k, v in s3gen_ref_dict.items()}
+        yield clip.voice_id, conds_cls(t3_cond, gen)
+
+
+def _embed_all(model, decoded: Iterable[_Clip], batch_size, max_buffered, exaggeration):
+    buckets = {}
+    n_buffered = 0
+    for clip in decoded:
+        if clip is None:
+            continue
+        key = (len(clip.ref_wav), len(clip.prompt_wav))
+        buckets.setdefault(key, []).append(clip)
+        n_buffered += 1
+        if len(buckets[key]) < batch_size:
+            if n_buffered < max_buffered:
+                continue
+            key = max(buckets, key=lambda k: len(buckets[k]))  # bound the memory held by partial buckets
+        batch = buckets.pop(key)
+        n_buffered -= len(batch)
+        yield from _embed_batch(model, batch, exaggeration)
+    for batch in buckets.values():
+        yield from _embed_batch(model, batch, exaggeration)
+
+
+def enroll(
+    model,
+    clips: Iterable[Tuple[str, str]],
+    out_fpath,
+    batch_size: int = 16,
+    num_workers: int = 8,
+    bucket_ms: int = 500,
+    exaggeration: float = 0.5,
+    precompute_t3_emb: bool = False,
+) -> int:
+    """
+    Enroll `(voice_id, audio_path)` pairs (eg from `read_clips`) with `model` (`ChatterboxTTS`,
+    `ChatterboxTurboTTS` or `ChatterboxMultilingualTTS`) and write them to a new `VoiceLibrary` at `out_fpath`.
+    Clips that can't be decoded are logged and skipped. Returns the number of voices written.
+    """
+    n_written = 0
+    max_buffered = 4 * batch_size
+
+    def decoded(executor):
+        pending = deque()
+        for voice_id, fpath in clips:
+            pending.append(executor.submit(_decode, voice_id, fpath, model, bucket_ms))
+            if len(pending) >= max_buffered:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def counted(voices):
+        nonlocal n_written
+        for voice in voices:
+            n_written += 1
+            if n_written % 100 == 0:
+                logger.info(f"enrolled {n_written} voices")
+            yield voice
+
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="enroll") as executor:
+        voices = _embed_all(model, decoded(executor), batch_size, max_buffered, exaggeration)
+        VoiceLibrary.write(out_fpath, counted(voices), t3=model.t3 if precompute_t3_emb else None)
+    logger.info(f"wrote {n_written} voices to {out_fpath}")
+    return n_written
+
+
+MODELS = {
+    "tts": ("chatterbox.tts", "ChatterboxTTS"),
+    "turbo": ("chatterbox.tts_turbo", "ChatterboxTurboTTS"),
+    "mtl": ("chatterbox.mtl_tts", "ChatterboxMultilingualTTS"),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Enroll reference clips into a voice library.")
+    parser.add_argument("clips", help="directory of audio files, or a manifest of '<voice id>\\t<path>' lines")
+    parser.add_argument("--out", required=True, help="voice library to write")
+    parser.add_argument("--model", choices=sorted(MODELS), default="tts")
+    parser.add_argument("--ckpt-dir", help="local checkpoint directory (default: download the pretrained model)")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--bucket-ms", type=int, default=500)
+    parser.add_argument("--precompute-t3-emb", action="store_true",
+                        help="also store the prompt speech token embeddings (the library is then tied to this model)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    module, name = MODELS[args.model]
+    model_cls = getattr(import_module(module), name)
+    model = model_cls.from_local(args.ckpt_dir, args.device) if args.ckpt_dir else model_cls.from_pretrained(args.device)
+
+    clips = read_clips(args.clips)
+    logger.info(f"enrolling {len(clips)} clips")
+    enroll(
+        model, clips, args.out,
+        batch_size=args.batch_size,
+        num_workers=args.workers,
+        bucket_ms=args.bucket_ms,
+        precompute_t3_emb=args.precompute_t3_emb,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Long-form synthesis: split text into sentence-sized chunks and run T3 decoding and S3Gen/HiFT rendering as a
+two-stage pipeline, so T3 works on chunk n+1 while chunk n is being rendered.
+"""
+import logging
+import queue
+import re
+import threading
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+# Sentence enders that need whitespace (or the end of the text) after them
+SENTENCE_ENDERS = ".!?…"
+# Enders that end a sentence on their own: CJK full-width, Arabic / Urdu question mark and full stop,
+# Devanagari danda, Greek question mark, Armenian full stop
+STANDALONE_SENTENCE_ENDERS = "。！？｡؟۔।॥\u037e։"
+# Extra enders (needing whitespace after them) per language: the Greek question mark is usually typed as ";"
+LANGUAGE_SENTENCE_ENDERS = {"el": ";"}
+# Closing quotes / brackets that belong to the sentence they follow
+CLOSERS = "\"'”’»)]}」』）】〕"
+# Where to split a sentence that is too long on its own
+CLAUSE_BREAKS = ",;:，、；：،"
+
+# Languages written without spaces between words
+NO_SPACE_LANGUAGES = {"zh", "ja"}
+
+# Common abbreviations that end with a period but not a sentence (English)
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "etc", "e.g", "i.e", "no", "fig"}
+
+
+def _split_on_enders(text: str, enders: str = SENTENCE_ENDERS) -> List[str]:
+    sentences = []
+    start = 0
+    i = 0
+    while i < len(text):
+        c = text[i]
+        end = None
+        if c in STANDALONE_SENTENCE_ENDERS:
+            end = i + 1
+        elif c in enders:
+            j = i + 1
+            while j < len(text) and text[j] in enders:
+                j += 1
+            while j < len(text) and text[j] in CLOSERS:
+                j += 1
+            if j == len(text) or text[j].isspace():
+                words = text[start:i].split()
+                if not (c == "." and words and words[-1].lower() in ABBREVIATIONS):
+                    end = j
+            i = j - 1
+        if end is not None:
+            while end < len(text) and text[end] in CLOSERS:
+                end += 1
+            sentences.append(text[start:end])
+            start = i = end
+            continue
+        i += 1
+    sentences.append(text[start:])
+    return [s.strip() for s in sentences if s.strip()]
+
+
+def _split_long(sentence: str, max_chars: int, joiner: str) -> List[str]:
+    "Split one over-long sentence at clause breaks, then at spaces, then anywhere."
+    if len(sentence) <= max_chars:
+        return [sentence]
+    for pattern in (f"(?<=[{re.escape(CLAUSE_BREAKS)}])", r"\s+"):
+        parts = [p.strip() for p in re.split(pattern, sentence) if p.strip()]
+        if len(parts) > 1:
+            return [c for part in _merge(parts, max_chars, joiner) for c in _split_long(part, max_chars, joiner)]
+    return [sentence[i:i + max_chars] for i in range(0, len(sentence), max_chars)]
+
+
+def _merge(parts: List[str], max_chars: int, joiner: str) -> List[str]:
+    "Greedily join consecutive parts while they fit in `max_chars`."
+    chunks = []
+    for part in parts:
+        if chunks and len(chunks[-1]) + len(joiner) + len(part) <= max_chars:
+            chunks[-1] = chunks[-1] + joiner + part
+        else:
+            chunks.append(part)
+    return chunks
+
+
+def split_sentences(text: str, language_id: Optional[str] = None, max_chars: int = 300) -> List[str]:
+    """
+    Split `text` into chunks of whole sentences, each at most `max_chars` long (sentences that are longer on their
+    own are split at clause breaks or spaces). Blank lines always end a chunk.
+    """
+    language_id = (language_id or "").lower()
+    joiner = "" if language_id in NO_SPACE_LANGUAGES else " "
+    enders = SENTENCE_ENDERS + LANGUAGE_SENTENCE_ENDERS.get(language_id, "")
+    chunks = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = " ".join(paragraph.split())
+        if not paragraph:
+            continue
+        sentences = [s for sentence in _split_on_enders(paragraph, enders) for s in _split_long(sentence, max_chars, joiner)]
+        chunks.extend(_merge(sentences, max_chars, joiner))
+    return chunks
+
+
+def crossfade_concat(wavs: Iterable[torch.Tensor], crossfade_len: int) -> torch.Tensor:
+    "Concatenate (1, n) waveforms, crossfading `crossfade_len` samples (equal power) at every joint."
+    out = None
+    for wav in wavs:
+        if out is None:
+            out = wav
+            continue
+        n = min(crossfade_len, out.size(1), wav.size(1))
+        if n == 0:
+            out = torch.cat([out, wav], dim=1)
+            continue
+        t = torch.linspace(0, torch.pi / 2, n, dtype=wav.dtype, device=wav.device)
+        joint = out[:, -n:] * torch.cos(t) + wav[:, :n] * torch.sin(t)
+        out = torch.cat([out[:, :-n], joint, wav[:, n:]], dim=1)
+    return out if out is not None else torch.zeros(1, 0)
+
+
+_DONE = object()
+
+
+def _worker(fn, inputs: queue.Queue, outputs: queue.Queue, stop: threading.Event, errors: list):
+    try:
+        with torch.inference_mode():  # (thread-local)
+            while True:
+                item = inputs.get()
+                if item is _DONE or stop.is_set():
+                    break
+                outputs.put(fn(item))
+    except BaseException as e:  # re-raised in the calling thread
+        errors.append(e)
+        stop.set()
+    finally:
+        outputs.put(_DONE)
+
+
+def pipelined_synthesis(
+    chunks: List[str],
+    generate_tokens: Callable[[str], torch.Tensor],
+    render: Callable[[torch.Tensor], torch.Tensor],
+    max_pending: int = 2,
+) -> Iterator[torch.Tensor]:
+    """
+    Yield `render(generate_tokens(chunk))` for every chunk, in order. The two stages run on their own worker threads
+    connected by a queue of at most `max_pending` token sequences, so the throughput is that of the slower stage.
+    """
+    texts, tokens, wavs = queue.Queue(), queue.Queue(maxsize=max_pending), queue.Queue()
+    stop = threading.Event()
+    errors = []
+    for chunk in chunks:
+        texts.put(chunk)
+    texts.put(_DONE)
+
+    workers = [
+        threading.Thread(target=_worker, args=(generate_tokens, texts, tokens, stop, errors), name="longform-t3"),
+        threading.Thread(target=_worker, args=(render, tokens, wavs, stop, errors), name="longform-s3gen"),
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for i in range(len(chunks)):
+            wav = wavs.get()
+            if wav is _DONE:
+                break
+            logger.debug(f"rendered chunk {i + 1}/{len(chunks)}")
+            yield wav
+    finally:
+        # on error or when the consumer stops early, wind down after the chunks in flight
+        stop.set()
+        while workers[0].is_alive():  # T3 may be blocked on a full queue
+            try:
+                tokens.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        try:
+            tokens.put_nowait(_DONE)  # in case the draining above took it
+        except queue.Full:
+            pass
+        for worker in workers:
+            worker.join()
+    if errors:
+        raise errors[0]
@@ -6,5 +6,6 @@ CFM_PARAMS = AttrDict({
     "t_scheduler": "cosine",
     "training_cfg_rate": 0.2,
     "inference_cfg_rate": 0.7,
+    "inference_cfg_interval": (0.0, 1.0),  # timesteps t in [start, end) that get CFG
     "reg_loss_type": "l1"
 })
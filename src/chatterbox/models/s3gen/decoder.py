@@ -11,6 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from dataclasses import dataclass, field
+from typing import List, Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -96,6 +99,35 @@ class CausalConv1d(torch.nn.Conv1d):
         x = F.pad(x, self.causal_padding)
         x = super(CausalConv1d, self).forward(x)
         return x
+@dataclass
+class DeepCache:
+    """
+    Opt-in DeepCache policy for `ConditionalDecoder`: the deep features barely change between adjacent solver steps,
+    so the mid blocks (most of the cost) are recomputed on the first `warmup` estimator calls of a solve and then
+    every `interval` calls. The other calls reuse the cached mid-block output and only run the down / up blocks, whose
+    skip connection carries the current input.
+
+    Pass a policy to the CFM (`cfm_deep_cache` of `S3Token2Wav.inference`); every solve starts from a `fresh` copy,
+    so a policy can be shared between calls and threads.
+    """
+    interval: int = 2
+    warmup: int = 1
+    step: int = field(default=0, repr=False)
+    features: Optional[torch.Tensor] = field(default=None, repr=False)
+
+    def fresh(self) -> "DeepCache":
+        return DeepCache(interval=self.interval, warmup=self.warmup)
+
+    def reuse(self, x: torch.Tensor) -> bool:
+        "Whether this call can skip the mid blocks for the input `x` of the mid blocks."
+        return (
+            self.features is not None
+            and self.features.shape == x.shape
+            and self.step >= self.warmup
+            and (self.step - self.warmup) % self.interval != 0
+        )
+
+
 class ConditionalDecoder(nn.Module):
     def __init__(
         self,
@@ -110,10 +142,14 @@ class ConditionalDecoder(nn.Module):
         num_heads=8,
         act_fn="gelu",
         meanflow=False,
+        static_chunk_size=0,
     ):
         """
         This decoder requires an input with the same shape of the target. So, if your text content
         is shorter or longer than the outputs, please re-sampling it before feeding to the decoder.
+
+        `static_chunk_size` is the attention chunk (in frames) of `streaming` decoding: a frame attends to its own
+        chunk and every earlier one, so chunks can be generated one after the other.
         """
         super().__init__()
         channels = tuple(channels)
@@ -133,8 +169,7 @@ class ConditionalDecoder(nn.Module):
         self.mid_blocks = nn.ModuleList([])
         self.up_blocks = nn.ModuleList([])
 
-        # NOTE jrm: `static_chunk_size` is missing?
-        self.static_chunk_size = 0
+        self.static_chunk_size = static_chunk_size
 
         output_channel = in_channels
         for i in range(len(channels)):  # pylint: disable=consider-using-enumerate
@@ -240,7 +275,41 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, r=None):
+    def embed_time(self, t, r=None):
+        "Timestep embedding (mixed with the end time `r` for meanflow)"
+        t_emb = self.time_mlp(self.time_embeddings(t).to(t.dtype))
+        if self.meanflow:
+            r_emb = self.time_mlp(self.time_embeddings(r).to(t.dtype))
+            t_emb = self.time_embed_mixer(torch.cat([t_emb, r_emb], dim=1))
+        return t_emb
+
+    def prepare(self, mask, t_span=None, streaming=False) -> "DecodePlan":
+        """
+        `DecodePlan` for a solve over `t_span` with the given `mask` (B, 1, T): the masks and attention biases of
+        every U-Net level (chunk-causal if `streaming`), and the timestep embeddings of the points of `t_span` (with
+        `r` = the next point for meanflow).
+        """
+        static_chunk_size = self.static_chunk_size if streaming else 0
+        masks = [mask]
+        for _ in range(len(self.down_blocks) - 1):
+            masks.append(masks[-1][:, :, ::2])
+        attn_biases = []
+        for level_mask in masks:
+            # (`add_optional_chunk_mask` only reads the length and device of its first argument)
+            attn_mask = add_optional_chunk_mask(
+                level_mask.transpose(1, 2), level_mask.bool(), False, False, 0, static_chunk_size, -1
+            )
+            attn_biases.append(mask_to_bias(attn_mask == 1, self.dtype))
+
+        plan = DecodePlan(masks=masks, attn_biases=attn_biases)
+        if t_span is not None:
+            plan.t_span = t_span.tolist()
+            # all steps in one pass
+            plan.time_embs = self.embed_time(t_span[:-1], t_span[1:]) if self.meanflow else self.embed_time(t_span)
+        return plan
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, r=None, deep_cache: Optional[DeepCache] = None,
+                plan: Optional["DecodePlan"] = None, step: Optional[int] = None, streaming=False):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -250,6 +319,10 @@ class ConditionalDecoder(nn.Module):
             spks (_type_, optional) Defaults to None.
             cond (_type_, optional)
             r: end time for meanflow mode (shape (1,) tensor)
+            deep_cache: state of an ongoing solve to reuse the mid-block output from, see `DeepCache`
+            plan: masks, attention biases and timestep embeddings precomputed by `prepare` (for this `mask`)
+            step: index of `t` in the `t_span` of `plan`, to use its precomputed embedding (None: embed `t` here)
+            streaming: chunk-causal attention (see `static_chunk_size`), without a `plan`
 
         Raises:
             ValueError: _description_
@@ -258,14 +331,11 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
-
-        if self.meanflow:
-            r = self.time_embeddings(r).to(t.dtype)
-            r = self.time_mlp(r)
-            concat_embed = torch.cat([t, r], dim=1)
-            t = self.time_embed_mixer(concat_embed)
+        if plan is None:
+            plan = self.prepare(mask, streaming=streaming)
+            t = self.embed_time(t, r)
+        else:
+            t = plan.time_emb(self, t, r if self.meanflow else None, step=step)
 
         x = pack([x, mu], "b * t")[0]
 
@@ -276,54 +346,49 @@ class ConditionalDecoder(nn.Module):
             x = pack([x, cond], "b * t")[0]
 
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        for level, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
+            mask_down = plan.masks[level]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
-                    attention_mask=attn_mask,
+                    attention_mask=plan.attn_biases[level],
                     timestep=t,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
-
-        for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+        mask_mid = plan.masks[-1]
+
+        if deep_cache is not None and deep_cache.reuse(x):
+            x = deep_cache.features
+        else:
+            for resnet, transformer_blocks in self.mid_blocks:
+                x = resnet(x, mask_mid, t)
+                x = rearrange(x, "b c t -> b t c").contiguous()
+                for transformer_block in transformer_blocks:
+                    x = transformer_block(
+                        hidden_states=x,
+                        attention_mask=plan.attn_biases[-1],
+                        timestep=t,
+                    )
+                x = rearrange(x, "b t c -> b c t").contiguous()
+            if deep_cache is not None:
+                deep_cache.features = x
+        if deep_cache is not None:
+            deep_cache.step += 1
+
+        for level, (resnet, transformer_blocks, upsample) in zip(reversed(range(len(plan.masks))), self.up_blocks):
+            mask_up = plan.masks[level]
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
-                    attention_mask=attn_mask,
+                    attention_mask=plan.attn_biases[level],
                     timestep=t,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
@@ -331,3 +396,38 @@ class ConditionalDecoder(nn.Module):
         x = self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
         return output * mask
+
+
+@dataclass
+class DecodePlan:
+    """
+    Constants of `ConditionalDecoder.forward` over one ODE solve (see `ConditionalDecoder.prepare`): the masks and
+    attention biases only depend on the sequence length and the timestep embeddings on the (known) time grid, so
+    they are built once per solve instead of on every block of every step. The embeddings are looked up by the index
+    of the timestep in `t_span`, which the solvers know on the host: reading the time back from the device would sync
+    on every call. Timesteps off the grid (eg the midpoints of higher-order solvers) are embedded on each call.
+    """
+    masks: List[torch.Tensor]  # (B, 1, T_level), per U-Net level
+    attn_biases: List[torch.Tensor]  # (B, T_level, T_level) additive attention biases, per level
+    t_span: List[float] = field(default_factory=list)  # (host copy of the time grid)
+    time_embs: Optional[torch.Tensor] = None  # (len(t_span), time_embed_dim), or (len(t_span) - 1, ...) for meanflow
+
+    def rows(self, n: int) -> "DecodePlan":
+        "This plan for the first `n` rows of the batch (eg the cond half of a CFG batch), sharing the time embeddings"
+        return DecodePlan(
+            masks=[m[:n] for m in self.masks],
+            attn_biases=[b[:n] for b in self.attn_biases],
+            t_span=self.t_span,
+            time_embs=self.time_embs,
+        )
+
+    def time_emb(self, decoder: ConditionalDecoder, t, r=None, step: Optional[int] = None):
+        """
+        Embedding of `t` (`t_span[step]`, or off the grid if `step` is None), expanded to the batch (all rows of a
+        solver step are at the same time)
+        """
+        if step is None or self.time_embs is None:
+            t_emb = decoder.embed_time(t[:1], None if r is None else r[:1])
+        else:
+            t_emb = self.time_embs[step:step + 1]
+        return t_emb.expand(t.size(0), -1)
@@ -140,9 +140,13 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   finalize,
                   n_timesteps=10,
                   noised_mels=None,
-                  meanflow=False):
+                  meanflow=False,
+                  solver="euler",
+                  deep_cache=None,
+                  streaming=False):
         # token: (B, n_toks)
         # token_len: (B,)
+        # streaming: chunk-causal attention in the encoder and the decoder, for the same mels as `stream`
         B = token.size(0)
 
         # xvec projection
@@ -166,11 +170,11 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         token = self.input_embedding(token.long()) * mask
 
         # text encode
-        h, h_masks = self.encoder(token, token_len)
+        h, h_masks = self.encoder(token, token_len, streaming=streaming)
+        h_lengths = h_masks.sum(dim=-1).squeeze(dim=-1)
         if finalize is False:
             h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
-
-        h_lengths = h_masks.sum(dim=-1).squeeze(dim=-1)
+            h_lengths = h_lengths - self.pre_lookahead_len * self.token_mel_ratio
         mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
         h = self.encoder_proj(h)
 
@@ -192,7 +196,196 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             n_timesteps=n_timesteps,
             noised_mels=noised_mels,
             meanflow=meanflow,
+            solver=solver,
+            deep_cache=deep_cache,
+            streaming=streaming,
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat, None  # NOTE jrm: why are they returning None here?
+
+    @torch.inference_mode()
+    def inference_batch(self,
+                        tokens,
+                        prompt_tokens,
+                        prompt_feats,
+                        embeddings,
+                        n_timesteps=10,
+                        meanflow=False,
+                        solver="euler",
+                        deep_cache=None):
+        """
+        `inference` (with `finalize=True`) of several utterances in one padded pass. Unlike `inference`, every item
+        has its own prompt: each row is packed as [prompt_i, tokens_i] followed by padding, so the prompts can have
+        different lengths. The encoder and the CFM decoder are masked, so padding doesn't change the result.
+
+        Args:
+            tokens: list of (n_toks_i,) speech tokens
+            prompt_tokens: list of (n_prompt_i,) prompt speech tokens
+            prompt_feats: list of (n_feat_i, 80) prompt mels
+            embeddings: list of (emb_dim,) x-vectors
+        Returns:
+            list of (80, n_mels_i) mels
+        """
+        B = len(tokens)
+        device = self.spk_embed_affine_layer.weight.device
+        embedding = F.normalize(torch.stack([e.reshape(-1) for e in embeddings]).to(device), dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)  # (B, emb_dim)
+
+        # pack [prompt_i, tokens_i] rows
+        token_len = torch.tensor([len(p) + len(t) for p, t in zip(prompt_tokens, tokens)], device=device)
+        token = torch.zeros(B, int(token_len.max()), dtype=torch.long, device=device)
+        for i, (p, t) in enumerate(zip(prompt_tokens, tokens)):
+            token[i, :token_len[i]] = torch.cat([p.reshape(-1), t.reshape(-1)]).to(device)
+        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+
+        if (token >= self.vocab_size).any():
+            logger.error(f"{token.max()}>{self.vocab_size}\n out-of-range special tokens found in flow, fix inputs!")
+        token = self.input_embedding(token) * mask
+
+        # text encode
+        h, h_masks = self.encoder(token, token_len)
+        h_lengths = h_masks.sum(dim=-1).squeeze(dim=-1)
+        h = self.encoder_proj(h)
+
+        # prompt mels as conditions, at the start of each row
+        conds = torch.zeros([B, h.size(1), self.output_size], device=device, dtype=h.dtype)
+        for i, feat in enumerate(prompt_feats):
+            conds[i, :feat.size(0)] = feat
+        conds = conds.transpose(1, 2)
+
+        mask = (~make_pad_mask(h_lengths, h.size(1))).unsqueeze(1).to(h)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask,
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            meanflow=meanflow,
+            solver=solver,
+            deep_cache=deep_cache,
+        )
+        return [feat[i, :, prompt_feats[i].size(0):h_lengths[i]] for i in range(B)]
+
+    def stream(self,
+               prompt_token,
+               prompt_token_len,
+               prompt_feat,
+               prompt_feat_len,
+               embedding,
+               n_timesteps=10,
+               meanflow=False,
+               batch_size=1,
+               noise=None) -> "CausalMaskedDiffWithXvecSession":
+        "Start an incremental synthesis session, see `CausalMaskedDiffWithXvecSession`."
+        return CausalMaskedDiffWithXvecSession(
+            self,
+            prompt_token=prompt_token,
+            prompt_feat=prompt_feat,
+            embedding=embedding,
+            n_timesteps=n_timesteps,
+            meanflow=meanflow,
+            batch_size=batch_size,
+            noise=noise,
+        )
+
+
+class CausalMaskedDiffWithXvecSession:
+    """
+    Streaming counterpart of `CausalMaskedDiffWithXvec.inference`: speech tokens are pushed as they arrive and the
+    mel frames of every token whose lookahead context is complete come back.
+
+    The encoder runs incrementally (`UpsampleConformerEncoderSession`), so `mu` of earlier frames never changes.
+    The flow-matching solve (`CausalConditionalCFM.forward_chunk`) only updates the new frames: the prompt region
+    and all earlier frames are context, fixed to the solver trajectory they had when they were generated, and each
+    frame's noise is drawn exactly once. Both the encoder and the decoder attention are chunk-causal, on a grid of
+    `static_chunk_size` counted from the first prompt token (the decoder's chunk is `token_mel_ratio` times the
+    encoder's), and frames are only generated once their attention chunk is complete. Earlier frames therefore
+    never see later ones, and the mels are the same as `inference` with `streaming=True` (see
+    `streamer.compare_streaming`), however the tokens are pushed.
+
+    The context frames go through the estimator again at every chunk, so the cost of a chunk grows with the
+    length generated so far (only the new frames are solved, and the encoder keeps attention caches).
+    """
+
+    def __init__(self, flow: CausalMaskedDiffWithXvec, *, prompt_token, prompt_feat, embedding, n_timesteps=10,
+                 meanflow=False, batch_size=1, noise=None):
+        self.flow = flow
+        self.n_timesteps = n_timesteps
+        self.meanflow = meanflow
+        # (B, 80, T) noise of the prompt and generated frames, in order, instead of drawing it chunk by chunk
+        # (see `compare_streaming`)
+        self.noise = noise
+        self.n_solved = 0
+
+        # xvec projection
+        embedding = torch.atleast_2d(embedding)
+        embedding = F.normalize(embedding, dim=1)
+        self.embedding = _repeat_batch_dim(flow.spk_embed_affine_layer(embedding), batch_size, ndim=2)
+        self.prompt_feat = _repeat_batch_dim(prompt_feat, batch_size, ndim=3)  # (B, n_feat, feat_dim=80)
+        self.mel_len1 = self.prompt_feat.size(1)
+
+        self.encoder = flow.encoder.stream()
+        dtype, device = self.embedding.dtype, self.embedding.device
+        self.mu = torch.zeros(batch_size, flow.output_size, 0, dtype=dtype, device=device)  # not solved yet
+        self.context_mu = self.mu
+        self.context = None  # solver trajectory of the context frames, (n_timesteps, B, 80, T_ctx)
+        # encoded together with the first chunk, so they share one attention chunk as in `inference`
+        self.prompt_token = _repeat_batch_dim(prompt_token, batch_size, ndim=2)
+
+    def _encode(self, token, finalize):
+        if self.prompt_token is not None:
+            token = torch.cat([self.prompt_token.to(token.device, token.dtype), token], dim=1)
+            self.prompt_token = None
+        if (token >= self.flow.vocab_size).any():
+            logger.error(f"{token.max()}>{self.flow.vocab_size}\n out-of-range special tokens found in flow, fix inputs!")
+        h = self.encoder(self.flow.input_embedding(token.long()), finalize=finalize)
+        h = self.flow.encoder_proj(h).transpose(1, 2)
+        self.mu = torch.cat([self.mu, h.to(self.mu.dtype)], dim=2)
+
+    @torch.inference_mode()
+    def __call__(self, token: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        """
+        :param token: (B, n) new speech tokens (n may be 0)
+        :param finalize: no more tokens follow, synthesize the lookahead tail too
+        :return: (B, 80, n_frames) newly completed mel frames (n_frames may be 0)
+        """
+        self._encode(token, finalize)
+        B, C, n_new = self.mu.shape
+        n_ctx = self.context_mu.size(2)
+        # the prompt region is solved along with the first generated frames
+        n_prompt_new = max(self.mel_len1 - n_ctx, 0)
+        if n_new <= n_prompt_new:
+            return self.mu.new_zeros(B, C, 0)
+
+        mu = torch.cat([self.context_mu, self.mu], dim=2)
+        T = mu.size(2)
+        conds = torch.zeros_like(mu)
+        conds[:, :, :self.mel_len1] = self.prompt_feat.transpose(1, 2)
+        mask = torch.ones(B, 1, T, dtype=mu.dtype, device=mu.device)
+        feat, trajectory = self.flow.decoder.forward_chunk(
+            mu=mu,
+            mask=mask,
+            n_timesteps=self.n_timesteps,
+            noise=self._noise(n_new),
+            spks=self.embedding,
+            cond=conds,
+            context=self.context,
+            meanflow=self.meanflow,
+        )
+
+        # everything so far is context for the next chunk
+        self.context = trajectory if self.context is None else torch.cat([self.context, trajectory], dim=3)
+        self.context_mu = mu
+        self.mu = self.mu[:, :, :0]
+        return feat[:, :, n_prompt_new:]
+
+    def _noise(self, n):
+        "Starting point of the next `n` frames to solve."
+        if self.noise is None:
+            noise = torch.randn_like(self.mu)
+        else:
+            noise = self.noise[:, :, self.n_solved:self.n_solved + n].to(self.mu)
+            assert noise.size(2) == n, "not enough noise for the frames to solve"
+        self.n_solved += n
+        return noise
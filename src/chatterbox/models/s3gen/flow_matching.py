@@ -16,6 +16,7 @@ import torch
 import torch.nn.functional as F
 from .matcha.flow_matching import BASECFM
 from .configs import CFM_PARAMS
+from .solvers import solve
 from tqdm import tqdm
 
 
@@ -34,6 +35,8 @@ class ConditionalCFM(BASECFM):
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
+        # CFG is only applied at timesteps in [start, end), the other steps run the cond batch alone
+        self.inference_cfg_interval = tuple(cfm_params.get("inference_cfg_interval", (0.0, 1.0)))
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
@@ -75,7 +78,12 @@ class ConditionalCFM(BASECFM):
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
         return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, meanflow=False):
+    def use_cfg(self, t: float) -> bool:
+        "Whether the solver step at time `t` runs with CFG (see `inference_cfg_interval`)"
+        start, end = self.inference_cfg_interval
+        return self.inference_cfg_rate > 0 and start <= t < end
+
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, meanflow=False, deep_cache=None, streaming=False):
         """
         Fixed euler solver for ODEs.
         Args:
@@ -90,6 +98,8 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
             meanflow: meanflow mode
+            deep_cache: `DeepCache` state of this solve, or None
+            streaming: chunk-causal estimator attention (see `ConditionalDecoder.static_chunk_size`)
         """
         in_dtype = x.dtype
         x, t_span, mu, mask, spks, cond = cast_all(x, t_span, mu, mask, spks, cond, dtype=self.estimator.dtype)
@@ -104,8 +114,16 @@ class ConditionalCFM(BASECFM):
         spks_in = torch.zeros([2 * B, 80   ], device=x.device, dtype=x.dtype)
         cond_in = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
         r_in    = torch.zeros([2 * B       ], device=x.device, dtype=x.dtype) # (only used for meanflow)
-
-        for t, r in zip(t_span[:-1], t_span[1:]):
+        # (constant over the steps)
+        mask_in[:B] = mask_in[B:] = mask
+        mu_in[:B] = mu
+        spks_in[:B] = spks
+        cond_in[:B] = cond
+        plan = self.estimator.prepare(mask_in, t_span, streaming=streaming)
+        plan_cond = plan.rows(B)  # steps outside of the CFG interval
+        use_cfg = [self.use_cfg(t) for t in plan.t_span[:-1]]
+
+        for step, (t, r) in enumerate(zip(t_span[:-1], t_span[1:])):
             t = t.unsqueeze(dim=0)
             r = r.unsqueeze(dim=0)
             # Shapes:
@@ -124,19 +142,21 @@ class ConditionalCFM(BASECFM):
             #      cond  (  B, 80, T )
             #         r  (  B,       )
 
-            x_in[:B] = x_in[B:] = x
-            mask_in[:B] = mask_in[B:] = mask
-            mu_in[:B] = mu
             t_in[:B] = t_in[B:] = t
-            spks_in[:B] = spks
-            cond_in[:B] = cond
             r_in[:B] = r_in[B:] = r # (only used for meanflow)
-            dxdt = self.estimator.forward(
-                x=x_in, mask=mask_in, mu=mu_in, t=t_in, spks=spks_in, cond=cond_in,
-                r=r_in if meanflow else None,
-            )
-            dxdt, cfg_dxdt = torch.split(dxdt, [B, B], dim=0)
-            dxdt = ((1.0 + self.inference_cfg_rate) * dxdt - self.inference_cfg_rate * cfg_dxdt)
+            if use_cfg[step]:
+                x_in[:B] = x_in[B:] = x
+                dxdt = self.estimator.forward(
+                    x=x_in, mask=mask_in, mu=mu_in, t=t_in, spks=spks_in, cond=cond_in,
+                    r=r_in if meanflow else None, deep_cache=deep_cache, plan=plan, step=step,
+                )
+                dxdt, cfg_dxdt = torch.split(dxdt, [B, B], dim=0)
+                dxdt = ((1.0 + self.inference_cfg_rate) * dxdt - self.inference_cfg_rate * cfg_dxdt)
+            else:
+                dxdt = self.estimator.forward(
+                    x=x, mask=mask, mu=mu, t=t_in[:B], spks=spks, cond=cond,
+                    r=r_in[:B] if meanflow else None, deep_cache=deep_cache, plan=plan_cond, step=step,
+                )
             dt = r - t
             x = x + dt * dxdt
 
@@ -193,7 +213,8 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = None
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, noised_mels=None, meanflow=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, noised_mels=None, meanflow=False,
+                solver="euler", deep_cache=None, streaming=False):
         """Forward diffusion
 
         Args:
@@ -207,6 +228,9 @@ class CausalConditionalCFM(ConditionalCFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
             noised_mels: gt mels noised a time t
+            solver: ODE solver, a name from `solvers.SOLVERS` or a solver function (ignored for meanflow)
+            deep_cache: optional `DeepCache` policy, to reuse the estimator's mid-block output across steps
+            streaming: chunk-causal estimator attention, as in `forward_chunk`
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
@@ -227,19 +251,121 @@ class CausalConditionalCFM(ConditionalCFM):
         # NOTE: right now, the only meanflow models are also distilled models, which don't need CFG
         #   because they were distilled with CFG outputs. We would need to add another hparam and
         #   change the conditional logic here if we want to use CFG inference with a meanflow model.
+        if deep_cache is not None:
+            deep_cache = deep_cache.fresh()
+
         if meanflow:
-            return self.basic_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+            return self.basic_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond,
+                                    deep_cache=deep_cache, streaming=streaming), None
+
+        if solver == "euler":
+            return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, meanflow=meanflow,
+                                    deep_cache=deep_cache, streaming=streaming), None
 
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, meanflow=meanflow), None
+        in_dtype = z.dtype
+        z, t_span, mu, mask, spks, cond = cast_all(z, t_span, mu, mask, spks, cond, dtype=self.estimator.dtype)
+        plan = self.estimator.prepare(torch.cat([mask, mask]), t_span, streaming=streaming)
+        velocity = lambda x, t, step=None: self._velocity(x, mask, mu, t, None, spks, cond, meanflow=False,
+                                                          deep_cache=deep_cache, plan=plan, step=step)
+        return solve(solver, velocity, z, t_span, mask=mask).to(in_dtype), None
+
+    @torch.inference_mode()
+    def forward_chunk(self, mu, mask, n_timesteps, noise, spks=None, cond=None, context=None, meanflow=False):
+        """Streaming diffusion: solve only the last frames of a window, the leading frames are fixed context.
+
+        Instead of the (unused) `flow_cache` of `ConditionalCFM.forward`, which only pins the noise and `mu` of the
+        prompt and overlap frames, the full solver trajectory of the context frames is kept. The context is then
+        exactly what it was when those frames were generated, and only the new frames are updated. The estimator
+        attention is chunk-causal (`streaming`), so the context frames never attend to the new ones: when the window
+        starts at the first frame and the new frames start on an attention chunk boundary, this is the same
+        computation as a `streaming` `forward` solve of the whole window.
+
+        Args:
+            mu (torch.Tensor): output of encoder for the whole window (context + new frames)
+                shape: (batch_size, n_feats, mel_timesteps)
+            mask (torch.Tensor): output_mask for the whole window
+                shape: (batch_size, 1, mel_timesteps)
+            n_timesteps (int): number of diffusion steps
+            noise (torch.Tensor): starting point of the new frames
+                shape: (batch_size, n_feats, n_new)
+            spks (torch.Tensor, optional): speaker embedding
+                shape: (batch_size, spk_emb_dim)
+            cond (torch.Tensor, optional): prompt mels for the whole window
+            context (torch.Tensor, optional): trajectory of the context frames, as returned by earlier calls
+                shape: (n_timesteps, batch_size, n_feats, mel_timesteps - n_new)
+            meanflow: meanflow mode (no CFG)
+        Returns:
+            sample: generated mel-spectrogram of the new frames
+                shape: (batch_size, n_feats, n_new)
+            trajectory: solver input of the new frames at every step
+                shape: (n_timesteps, batch_size, n_feats, n_new)
+        """
+        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
+        if (not meanflow) and (self.t_scheduler == 'cosine'):
+            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+
+        in_dtype = noise.dtype
+        x, t_span, mu, mask, spks, cond = cast_all(noise, t_span, mu, mask, spks, cond, dtype=self.estimator.dtype)
+        n_ctx = 0 if context is None else context.size(3)
+        plan = self.estimator.prepare(mask if meanflow else torch.cat([mask, mask]), t_span, streaming=True)
+
+        trajectory = []
+        for i, (t, r) in enumerate(zip(t_span[:-1], t_span[1:])):
+            t, r = t[None], r[None]
+            trajectory.append(x)
+            x_full = x if context is None else torch.cat([context[i].to(x.dtype), x], dim=2)
+            dxdt = self._velocity(x_full, mask, mu, t, r, spks, cond, meanflow, plan=plan, step=i)
+            x = x + (r - t) * dxdt[:, :, n_ctx:]
+        return x.to(in_dtype), torch.stack(trajectory)
+
+    def _velocity(self, x, mask, mu, t, r, spks, cond, meanflow, deep_cache=None, plan=None, step=None):
+        """
+        Estimator output for one solver step, with CFG unless `meanflow` or `t` is outside of `inference_cfg_interval`
+        (see `solve_euler` / `basic_euler`). `plan` is the estimator's `DecodePlan` for the (CFG-doubled unless
+        `meanflow`) mask, and `step` the index of `t` in its `t_span` (None off the grid).
+        """
+        if meanflow:
+            return self.estimator.forward(x, mask=mask, mu=mu, t=t, spks=spks, cond=cond, r=r, deep_cache=deep_cache,
+                                          plan=plan, step=step)
+
+        B, T = mu.size(0), x.size(2)
+        # (the host copy of the grid, as reading `t` back from the device syncs)
+        t_host = float(t[0]) if plan is None or step is None else plan.t_span[step]
+        if not self.use_cfg(t_host):
+            return self.estimator.forward(
+                x, mask=mask, mu=mu, t=t, spks=spks, cond=cond, r=None, deep_cache=deep_cache,
+                plan=None if plan is None else plan.rows(B), step=step,
+            )
+
+        x_in    = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
+        mask_in = torch.zeros([2 * B,  1, T], device=x.device, dtype=x.dtype)
+        mu_in   = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
+        t_in    = torch.zeros([2 * B       ], device=x.device, dtype=x.dtype)
+        spks_in = torch.zeros([2 * B, 80   ], device=x.device, dtype=x.dtype)
+        cond_in = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
+        x_in[:B] = x_in[B:] = x
+        mask_in[:B] = mask_in[B:] = mask
+        mu_in[:B] = mu
+        t_in[:B] = t_in[B:] = t
+        spks_in[:B] = spks
+        cond_in[:B] = cond
+        dxdt = self.estimator.forward(
+            x=x_in, mask=mask_in, mu=mu_in, t=t_in, spks=spks_in, cond=cond_in, r=None, deep_cache=deep_cache,
+            plan=plan, step=step,
+        )
+        dxdt, cfg_dxdt = torch.split(dxdt, [B, B], dim=0)
+        return (1.0 + self.inference_cfg_rate) * dxdt - self.inference_cfg_rate * cfg_dxdt
 
-    def basic_euler(self, x, t_span, mu, mask, spks, cond):
+    def basic_euler(self, x, t_span, mu, mask, spks, cond, deep_cache=None, streaming=False):
         in_dtype = x.dtype
         x, t_span, mu, mask, spks, cond = cast_all(x, t_span, mu, mask, spks, cond, dtype=self.estimator.dtype)
 
+        plan = self.estimator.prepare(mask, t_span, streaming=streaming)
         print("S3 Token -> Mel Inference...")
-        for t, r in tqdm(zip(t_span[..., :-1], t_span[..., 1:]), total=t_span.shape[-1] - 1):
+        for step, (t, r) in tqdm(enumerate(zip(t_span[..., :-1], t_span[..., 1:])), total=t_span.shape[-1] - 1):
             t, r = t[None], r[None]
-            dxdt = self.estimator.forward(x, mask=mask, mu=mu, t=t, spks=spks, cond=cond, r=r)
+            dxdt = self.estimator.forward(x, mask=mask, mu=mu, t=t, spks=spks, cond=cond, r=r, deep_cache=deep_cache,
+                                          plan=plan, step=step)
             dt = r - t
             x = x + dt * dxdt
 
@@ -198,9 +198,11 @@ class SineGen(torch.nn.Module):
         return uv
 
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, phase=None):
         """
         :param f0: [B, 1, sample_len], Hz
+        :param phase: optional [B, harmonic_num + 1, 1] initial phase in cycles, eg to continue the previous chunk
+            of a stream (see `end_phase`); random for the overtones and 0 for the fundamental by default
         :return: [B, 1, sample_len]
         """
 
@@ -209,9 +211,12 @@ class SineGen(torch.nn.Module):
             F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
 
         theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
-        phase_vec[:, 0, :] = 0
+        if phase is None:
+            u_dist = Uniform(low=-np.pi, high=np.pi)
+            phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+            phase_vec[:, 0, :] = 0
+        else:
+            phase_vec = 2 * np.pi * phase.to(F_mat.device)
 
         # generate sine waveforms
         sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
@@ -230,6 +235,17 @@ class SineGen(torch.nn.Module):
         sine_waves = sine_waves * uv + noise
         return sine_waves, uv, noise
 
+    def random_phase(self, batch_size, device=None):
+        "initial phase in cycles, as drawn by `forward` when none is given"
+        phase = torch.rand(batch_size, self.harmonic_num + 1, 1, device=device) - 0.5
+        phase[:, 0, :] = 0
+        return phase
+
+    def end_phase(self, f0, phase):
+        "phase (in cycles) at the end of `forward(f0, phase)`, to start the next chunk from"
+        harmonics = torch.arange(1, self.harmonic_num + 2, device=f0.device, dtype=torch.float32)[None, :, None]
+        return (phase + (f0.float().sum(dim=-1, keepdim=True) * harmonics / self.sampling_rate)) % 1
+
 
 class SourceModuleHnNSF(torch.nn.Module):
     """ SourceModule for hn-nsf
@@ -264,16 +280,17 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, phase=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
+        phase: optional initial phase of the sine generator, see `SineGen.forward`
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2), phase)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
@@ -472,3 +489,89 @@ class HiFTGenerator(nn.Module):
             s[:, :, :cache_source.shape[2]] = cache_source
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
+
+    def stream(self, mel_cache_len: int = 8) -> "HiFTGeneratorSession":
+        "Start a chunked vocoding session, see `HiFTGeneratorSession`."
+        return HiFTGeneratorSession(self, mel_cache_len=mel_cache_len)
+
+
+def fade_in_out(fade_in_wav: torch.Tensor, fade_out_wav: torch.Tensor, window: torch.Tensor):
+    """
+    Crossfade the start of `fade_in_wav` with the tail of `fade_out_wav`; `window` is a (2 * overlap,) window whose
+    rising half fades in and falling half fades out.
+    """
+    overlap = window.size(0) // 2
+    fade_in_wav = fade_in_wav.clone()
+    fade_in_wav[..., :overlap] = (
+        fade_in_wav[..., :overlap] * window[:overlap] + fade_out_wav[..., -overlap:] * window[overlap:]
+    )
+    return fade_in_wav
+
+
+class HiFTGeneratorSession:
+    """
+    Chunked `HiFTGenerator.inference` for streaming: feed mel frames as they are generated, get PCM back.
+
+    Each call vocodes the new frames together with the last `mel_cache_len` frames of the previous call, which give
+    the convolutions their left context. Those context frames reuse the excitation they were vocoded with
+    (`cache_source`), and the sine source of the new frames continues the phase of the previous chunk instead of
+    restarting it. The output for the context frames overlaps the tail that was withheld from the previous chunk and
+    the two are crossfaded with a Hamming window, as in CosyVoice.
+    """
+
+    def __init__(self, hift: HiFTGenerator, mel_cache_len: int = 8):
+        self.hift = hift
+        self.mel_cache_len = mel_cache_len
+        self.samples_per_frame = int(hift.f0_upsamp.scale_factor)  # 480 at 24 kHz
+        self.source_cache_len = mel_cache_len * self.samples_per_frame
+        self.speech_window = torch.from_numpy(np.hamming(2 * self.source_cache_len).astype(np.float32))
+
+        self.mel_cache = None
+        self.source_cache = None
+        self.speech_cache = None  # withheld output for the cached frames
+        self.phase = None
+
+    @torch.inference_mode()
+    def __call__(self, speech_feat: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        """
+        :param speech_feat: (B, 80, n_frames) new mel frames; unless `finalize`, more than `mel_cache_len`
+            (including frames cached from the previous call)
+        :param finalize: last chunk, emit everything
+        :return: (B, n_samples) waveform; `mel_cache_len` frames' worth is withheld until the next call
+        """
+        hift = self.hift
+        n_new = speech_feat.size(2)
+        if self.mel_cache is not None:
+            speech_feat = torch.cat([self.mel_cache, speech_feat], dim=2)
+        assert finalize or speech_feat.size(2) > self.mel_cache_len, "chunk too short to withhold the overlap"
+
+        # mel->f0, with the cached frames as left context
+        f0 = hift.f0_predictor(speech_feat)[:, -n_new:]
+        # f0->source, continuing the sine phase of the previous chunk
+        f0 = hift.f0_upsamp(f0[:, None])  # (B, 1, n_new * samples_per_frame)
+        if self.phase is None:
+            self.phase = hift.m_source.l_sin_gen.random_phase(f0.size(0), device=f0.device)
+        s, _, _ = hift.m_source(f0.transpose(1, 2), self.phase)
+        self.phase = hift.m_source.l_sin_gen.end_phase(f0, self.phase)
+        s = s.transpose(1, 2).to(speech_feat.dtype)
+        if self.source_cache is not None:
+            s = torch.cat([self.source_cache, s], dim=2)
+
+        wav = hift.decode(x=speech_feat, s=s)
+        if self.speech_cache is not None:
+            window = self.speech_window.to(device=wav.device, dtype=wav.dtype)
+            wav = fade_in_out(wav, self.speech_cache, window)
+
+        if finalize:
+            self.mel_cache = self.source_cache = self.speech_cache = None
+            return wav
+        self.mel_cache = speech_feat[:, :, -self.mel_cache_len:]
+        self.source_cache = s[:, :, -self.source_cache_len:]
+        self.speech_cache = wav[:, -self.source_cache_len:]
+        return wav[:, :-self.source_cache_len]
+
+    def flush(self) -> Optional[torch.Tensor]:
+        "Release the withheld tail when the stream ends without a final chunk (None if there is none)."
+        wav, self.speech_cache = self.speech_cache, None
+        self.mel_cache = self.source_cache = None
+        return wav
@@ -13,14 +13,16 @@
 # limitations under the License.
 
 import logging
+import math
 
 import numpy as np
 import torch
 import torchaudio as ta
 from functools import lru_cache
-from typing import Optional
+from typing import List, Optional, Union
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
+from ..utils import PRECISIONS
 from .const import S3GEN_SR
 from .flow import CausalMaskedDiffWithXvec
 from .xvector import CAMPPlus
@@ -76,6 +78,7 @@ class S3Token2Mel(torch.nn.Module):
             input_size=512,
             use_cnn_module=False,
             macaron_style=False,
+            static_chunk_size=25,  # (tokens, for streaming)
         )
 
         estimator = ConditionalDecoder(
@@ -90,6 +93,7 @@ class S3Token2Mel(torch.nn.Module):
             num_heads=8,
             act_fn='gelu',
             meanflow=self.meanflow,
+            static_chunk_size=2 * 25,  # (mel frames: token_mel_ratio * the encoder's)
         )
         cfm_params = CFM_PARAMS
         decoder = CausalConditionalCFM(
@@ -138,7 +142,7 @@ class S3Token2Mel(torch.nn.Module):
         ref_wav_24 = ref_wav
         if ref_sr != S3GEN_SR:
             ref_wav_24 = get_resampler(ref_sr, S3GEN_SR, device)(ref_wav)
-        ref_wav_24 = ref_wav_24.to(device=device, dtype=self.dtype)
+        ref_wav_24 = ref_wav_24.to(device=device, dtype=torch.float32)  # (STFT in fp32)
 
         ref_mels_24 = self.mel_extractor(ref_wav_24).transpose(1, 2).to(dtype=self.dtype)
         ref_mels_24_len = None
@@ -149,7 +153,8 @@ class S3Token2Mel(torch.nn.Module):
             ref_wav_16 = get_resampler(ref_sr, S3_SR, device)(ref_wav)
 
         # Speaker embedding
-        ref_x_vector = self.speaker_encoder.inference(ref_wav_16.to(dtype=self.dtype))
+        speaker_encoder_dtype = next(self.speaker_encoder.parameters()).dtype
+        ref_x_vector = self.speaker_encoder.inference(ref_wav_16.to(dtype=speaker_encoder_dtype)).to(self.dtype)
 
         # Tokenize 16khz reference
         ref_speech_tokens, ref_speech_token_lens = self.tokenizer(ref_wav_16.float())
@@ -160,7 +165,7 @@ class S3Token2Mel(torch.nn.Module):
                 "Reference mel length is not equal to 2 * reference token length.\n"
             )
             ref_speech_tokens = ref_speech_tokens[:, :ref_mels_24.shape[1] // 2]
-            ref_speech_token_lens[0] = ref_speech_tokens.shape[1]
+            ref_speech_token_lens.clamp_(max=ref_speech_tokens.shape[1])
 
         return dict(
             prompt_token=ref_speech_tokens.to(device),
@@ -170,6 +175,15 @@ class S3Token2Mel(torch.nn.Module):
             embedding=ref_x_vector,
         )
 
+    def cast_ref_dict(self, ref_dict: dict):
+        "type/device casting (all values will be numpy if it's from a prod API call)"
+        for rk in list(ref_dict):
+            if isinstance(ref_dict[rk], np.ndarray):
+                ref_dict[rk] = torch.from_numpy(ref_dict[rk])
+            if torch.is_tensor(ref_dict[rk]):
+                ref_dict[rk] = ref_dict[rk].to(device=self.device, dtype=self.dtype)
+        return ref_dict
+
     def forward(
         self,
         speech_tokens: torch.LongTensor,
@@ -182,6 +196,9 @@ class S3Token2Mel(torch.nn.Module):
         finalize: bool = False,
         speech_token_lens=None,
         noised_mels=None,
+        cfm_solver="euler",
+        cfm_deep_cache=None,
+        streaming=False,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -198,18 +215,16 @@ class S3Token2Mel(torch.nn.Module):
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `cfm_solver`: ODE solver of the CFM decoder, see `solvers.SOLVERS`
+        - `cfm_deep_cache`: optional `DeepCache` policy of the CFM decoder
+        - `streaming`: chunk-causal attention in the flow, for the same mels as `S3GenStreamer`
         """
         assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
 
         if ref_dict is None:
             ref_dict = self.embed_ref(ref_wav, ref_sr)
         else:
-            # type/device casting (all values will be numpy if it's from a prod API call)
-            for rk in list(ref_dict):
-                if isinstance(ref_dict[rk], np.ndarray):
-                    ref_dict[rk] = torch.from_numpy(ref_dict[rk])
-                if torch.is_tensor(ref_dict[rk]):
-                    ref_dict[rk] = ref_dict[rk].to(device=self.device, dtype=self.dtype)
+            ref_dict = self.cast_ref_dict(ref_dict)
 
         speech_tokens = torch.atleast_2d(speech_tokens)
 
@@ -224,6 +239,9 @@ class S3Token2Mel(torch.nn.Module):
             noised_mels=noised_mels,
             n_timesteps=n_cfm_timesteps,
             meanflow=self.meanflow,
+            solver=cfm_solver,
+            deep_cache=cfm_deep_cache,
+            streaming=streaming,
             **ref_dict,
         )
         return output_mels
@@ -256,7 +274,20 @@ class S3Token2Wav(S3Token2Mel):
         trim_fade = torch.zeros(2 * n_trim)
         trim_fade[n_trim:] = (torch.cos(torch.linspace(torch.pi, 0, n_trim)) + 1) / 2
         self.register_buffer("trim_fade", trim_fade, persistent=False) # (buffers get automatic device casting)
-        self.estimator_dtype = "fp32"
+        self.estimator_dtype = "fp32"  # see `set_estimator_dtype`
+
+    @property
+    def hift_dtype(self):
+        return self.mel2wav.conv_post.bias.dtype
+
+    def set_estimator_dtype(self, estimator_dtype: str):
+        """
+        Run the CFM estimator (the U-Net evaluated at every solver step) in "fp32", "bf16" or "fp16". The rest of the
+        model keeps its dtype: the CFM solvers cast to the estimator's dtype and back (`cast_all`).
+        """
+        self.flow.decoder.estimator.to(PRECISIONS[estimator_dtype])
+        self.estimator_dtype = estimator_dtype
+        return self
 
     def forward(
         self,
@@ -289,7 +320,9 @@ class S3Token2Wav(S3Token2Mel):
         # TODO jrm: ignoring the speed control (mel interpolation) and the HiFTGAN caching mechanisms for now.
         hift_cache_source = torch.zeros(1, 1, 0).to(self.device)
 
-        output_wavs, *_ = self.mel2wav.inference(speech_feat=output_mels, cache_source=hift_cache_source)
+        output_wavs, *_ = self.mel2wav.inference(
+            speech_feat=output_mels.to(self.hift_dtype), cache_source=hift_cache_source
+        )
 
         if not self.training:
             # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
@@ -309,6 +342,9 @@ class S3Token2Wav(S3Token2Mel):
         n_cfm_timesteps = None,
         finalize: bool = False,
         speech_token_lens=None,
+        cfm_solver="euler",
+        cfm_deep_cache=None,
+        streaming=False,
     ):
         n_cfm_timesteps = n_cfm_timesteps or (2 if self.meanflow else 10)
         noise = None
@@ -316,15 +352,16 @@ class S3Token2Wav(S3Token2Mel):
             noise = torch.randn(1, 80, speech_tokens.size(-1) * 2, dtype=self.dtype, device=self.device)
         output_mels = super().forward(
             speech_tokens, speech_token_lens=speech_token_lens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict,
-            n_cfm_timesteps=n_cfm_timesteps, finalize=finalize, noised_mels=noise,
+            n_cfm_timesteps=n_cfm_timesteps, finalize=finalize, noised_mels=noise, cfm_solver=cfm_solver,
+            cfm_deep_cache=cfm_deep_cache, streaming=streaming,
         )
         return output_mels
 
     @torch.inference_mode()
     def hift_inference(self, speech_feat, cache_source: torch.Tensor = None):
         if cache_source is None:
-            cache_source = torch.zeros(1, 1, 0).to(device=self.device, dtype=self.dtype)
-        return self.mel2wav.inference(speech_feat=speech_feat, cache_source=cache_source)
+            cache_source = torch.zeros(1, 1, 0).to(device=self.device, dtype=self.hift_dtype)
+        return self.mel2wav.inference(speech_feat=speech_feat.to(self.hift_dtype), cache_source=cache_source)
 
     @torch.inference_mode()
     def inference(
@@ -339,7 +376,16 @@ class S3Token2Wav(S3Token2Mel):
         drop_invalid_tokens=True,
         n_cfm_timesteps=None,
         speech_token_lens=None,
+        cfm_solver="euler",
+        cfm_deep_cache=None,
+        streaming=False,
     ):
+        """
+        Speech tokens -> waveform. `cfm_solver` picks the ODE solver of the CFM decoder (see `solvers.SOLVERS`), eg
+        "heun" with `n_cfm_timesteps=2` or "multistep" with `n_cfm_timesteps=5` for 4-5 estimator calls instead of 10.
+        `cfm_deep_cache` (eg `DeepCache(interval=2)`) reuses the decoder's mid-block output between solver steps.
+        `streaming` runs the flow with the chunk-causal attention of `S3GenStreamer`, which then streams the same mels.
+        """
         # hallucination prevention, drop special tokens
         # if drop_invalid_tokens:
         #     speech_tokens, speech_token_lens = drop_invalid(speech_tokens, pad=S3_QUIET_PAD)
@@ -352,11 +398,78 @@ class S3Token2Wav(S3Token2Mel):
             ref_dict=ref_dict,
             n_cfm_timesteps=n_cfm_timesteps,
             finalize=True,
+            cfm_solver=cfm_solver,
+            cfm_deep_cache=cfm_deep_cache,
+            streaming=streaming,
         )
-        output_mels = output_mels.to(dtype=self.dtype) # FIXME (fp16 mode) is this still needed?
         output_wavs, output_sources = self.hift_inference(output_mels, None)
 
         # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        speech_tokens: List[torch.Tensor],
+        ref_dicts: Union[dict, List[dict]],
+        drop_invalid_tokens=True,
+        n_cfm_timesteps=None,
+        cfm_solver="euler",
+        cfm_deep_cache=None,
+    ) -> List[torch.Tensor]:
+        """
+        `inference` for several utterances in one padded pass through the flow encoder, the CFM decoder and HiFT.
+
+        Args
+        ----
+        - `speech_tokens`: list of (n_toks_i,) or (1, n_toks_i) S3 speech tokens of any lengths
+        - `ref_dicts`: one reference dict (from `embed_ref`) for every utterance, or a single one for all of them
+
+        Returns a list of (1, n_samples_i) waveforms. The flow is exact under padding. HiFT has no masks, so its
+        convolutions see the (silence) padding: the last ~8 frames (~0.15 s) of the shorter utterances, which end in
+        silence anyway, can differ slightly from `inference`.
+        """
+        if isinstance(ref_dicts, dict):
+            ref_dicts = [ref_dicts] * len(speech_tokens)
+        assert len(ref_dicts) == len(speech_tokens)
+        ref_dicts = [self.cast_ref_dict(dict(ref_dict)) for ref_dict in ref_dicts]
+        tokens = [t.reshape(-1) for t in speech_tokens]
+        if drop_invalid_tokens:
+            tokens = [t[t < SPEECH_VOCAB_SIZE] for t in tokens]
+
+        def prompt(ref_dict, key):
+            x = ref_dict[key]
+            return x[0] if x.size(0) == 1 else x
+
+        n_cfm_timesteps = n_cfm_timesteps or (2 if self.meanflow else 10)
+        mels = self.flow.inference_batch(
+            [t.to(self.device) for t in tokens],
+            prompt_tokens=[prompt(r, "prompt_token").long() for r in ref_dicts],
+            prompt_feats=[prompt(r, "prompt_feat") for r in ref_dicts],
+            embeddings=[prompt(r, "embedding") for r in ref_dicts],
+            n_timesteps=n_cfm_timesteps,
+            meanflow=self.meanflow,
+            solver=cfm_solver,
+            deep_cache=cfm_deep_cache,
+        )
+
+        # pad with silence (the mel floor) and vocode together
+        mel_lens = [mel.size(1) for mel in mels]
+        speech_feat = torch.full(
+            (len(mels), 80, max(mel_lens)), math.log(1e-5), dtype=self.hift_dtype, device=self.device
+        )
+        for i, mel in enumerate(mels):
+            speech_feat[i, :, :mel.size(1)] = mel
+        output_wavs, _ = self.hift_inference(speech_feat, None)
+
+        samples_per_frame = int(self.mel2wav.f0_upsamp.scale_factor)
+        n_fade = len(self.trim_fade)
+        wavs = []
+        for i, mel_len in enumerate(mel_lens):
+            wav = output_wavs[i:i + 1, :mel_len * samples_per_frame].clone()
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            wav[:, :n_fade] *= self.trim_fade[:wav.size(1)]
+            wavs.append(wav)
+        return wavs
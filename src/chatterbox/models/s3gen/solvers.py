@@ -0,0 +1,129 @@
+"""
+ODE solvers for the CFM decoder: integrate dx/dt = velocity(x, t) from the noise at t_span[0] to the mel at
+t_span[-1]. Each estimator call (with CFG, one pass over a doubled batch) dominates the cost, so the solvers differ in
+how much accuracy they get per call:
+
+- `euler`: 1 call per step (what `ConditionalCFM.solve_euler` does)
+- `midpoint`, `heun`: 2nd order, 2 calls per step
+- `multistep`: 2nd order Adams-Bashforth on the previous velocity (the flow-matching form of DPM-Solver++(2M)), 1 call
+  per step
+- `adaptive`: Heun with an embedded Euler error estimate and step-size control, as many calls as the tolerance needs
+
+A solver is a function `(velocity, x, t_span, mask) -> x`; `solve` looks one up by name (or takes such a function).
+When `t` is a point of `t_span`, the solvers pass its index as `step`, so the estimator can use what it precomputed
+for the grid without reading `t` back from the device.
+"""
+import logging
+from typing import Callable, Optional, Union
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+# (x, t of shape (1,), step: index of t in t_span or None) -> dx/dt
+Velocity = Callable[[torch.Tensor, torch.Tensor, Optional[int]], torch.Tensor]
+
+
+def euler(velocity: Velocity, x, t_span, mask=None):
+    for i, (t, r) in enumerate(zip(t_span[:-1], t_span[1:])):
+        x = x + (r - t) * velocity(x, t[None], i)
+    return x
+
+
+def midpoint(velocity: Velocity, x, t_span, mask=None):
+    for i, (t, r) in enumerate(zip(t_span[:-1], t_span[1:])):
+        dt = r - t
+        x_mid = x + 0.5 * dt * velocity(x, t[None], i)
+        x = x + dt * velocity(x_mid, (t + 0.5 * dt)[None], None)
+    return x
+
+
+def heun(velocity: Velocity, x, t_span, mask=None):
+    for i, (t, r) in enumerate(zip(t_span[:-1], t_span[1:])):
+        dt = r - t
+        v = velocity(x, t[None], i)
+        v_next = velocity(x + dt * v, r[None], i + 1)
+        x = x + 0.5 * dt * (v + v_next)
+    return x
+
+
+def multistep(velocity: Velocity, x, t_span, mask=None):
+    v_prev = dt_prev = None
+    for i, (t, r) in enumerate(zip(t_span[:-1], t_span[1:])):
+        dt = r - t
+        v = velocity(x, t[None], i)
+        if v_prev is None:
+            x = x + dt * v
+        else:
+            # extrapolate the velocity linearly to the middle of the step (variable-step Adams-Bashforth 2)
+            k = 0.5 * dt / dt_prev
+            x = x + dt * ((1 + k) * v - k * v_prev)
+        v_prev, dt_prev = v, dt
+    return x
+
+
+def adaptive(velocity: Velocity, x, t_span, mask=None, atol=1e-2, rtol=1e-2, max_steps=16):
+    """
+    Heun steps with the Euler step as the embedded lower-order estimate. The first step is the first step of
+    `t_span`; then each step is sized so the estimated local error, RMS over the (masked) frames and relative to
+    `atol + rtol * |x|`, stays at 1.
+
+    `max_steps` bounds the accepted steps (and, separately, the rejected ones): the last step the budget allows goes
+    to `t_span[-1]` whatever its error, so the solve always finishes.
+    """
+    t, t_end = t_span[0], t_span[-1]
+    dt = t_span[1] - t_span[0]
+    n_calls = n_steps = n_rejected = 0
+    v = None
+    while True:
+        last = n_steps + 1 >= max_steps or n_rejected >= max_steps
+        dt = t_end - t if last else torch.minimum(dt, t_end - t)
+        if v is None:
+            v = velocity(x, t[None], 0 if n_steps == 0 else None)
+            n_calls += 1
+        x_euler = x + dt * v
+        v_next = velocity(x_euler, (t + dt)[None], None)
+        n_calls += 1
+        x_heun = x + 0.5 * dt * (v + v_next)
+
+        err = (x_heun - x_euler) / (atol + rtol * torch.maximum(x.abs(), x_heun.abs()))
+        if mask is not None:
+            err = err * mask
+            err = (err.pow(2).sum() / (mask.sum() * err.size(1))).sqrt()
+        else:
+            err = err.pow(2).mean().sqrt()
+        err = err.item()
+
+        if err <= 1.0 or last:  # accept
+            if err > 1.0:
+                logger.warning(
+                    f"adaptive solver out of steps ({max_steps=}), last step from t={t.item():.3f} with error {err:.2f}"
+                )
+            x, t = x_heun, t + dt
+            v = None
+            n_steps += 1
+            if last or bool(t >= t_end - 1e-6):
+                break
+        else:
+            n_rejected += 1
+        # 2nd order: err ~ dt^2
+        dt = dt * min(2.0, max(0.2, 0.9 * (max(err, 1e-6) ** -0.5)))
+    logger.debug(f"adaptive solver: {n_steps} steps, {n_rejected} rejected, {n_calls} estimator calls")
+    return x
+
+
+SOLVERS = {
+    "euler": euler,
+    "midpoint": midpoint,
+    "heun": heun,
+    "multistep": multistep,
+    "adaptive": adaptive,
+}
+
+
+def solve(solver: Union[str, Callable], velocity: Velocity, x, t_span, mask=None):
+    if isinstance(solver, str):
+        assert solver in SOLVERS, f"unknown CFM solver {solver!r}, expected one of {sorted(SOLVERS)}"
+        solver = SOLVERS[solver]
+    return solver(velocity, x, t_span, mask=mask)
@@ -0,0 +1,165 @@
+import logging
+from typing import TYPE_CHECKING, Optional
+
+import torch
+
+from ..s3tokenizer import SPEECH_VOCAB_SIZE
+
+if TYPE_CHECKING:
+    from .s3gen import S3Token2Wav
+
+
+logger = logging.getLogger(__name__)
+
+
+# Upper bound of the relative L2 distance between streamed mels and `streaming=True` offline mels in float32 (see
+# `compare_streaming`): they are the same computation, up to rounding.
+STREAMING_MEL_TOLERANCE = 1e-4
+
+
+class S3GenStreamer:
+    """
+    Incremental S3 token -> waveform synthesis for one utterance: `push` speech tokens as they come out of T3 and get
+    waveform chunks back, then `flush` once T3 is done.
+
+    Every `chunk_size` new tokens go through an incremental flow session (`CausalMaskedDiffWithXvecSession`; tokens
+    wait for their right context and for their attention chunk to complete) and the new mel frames go to a HiFT
+    session (`HiFTGeneratorSession`), which vocodes them with `mel_cache_len` frames of left context and crossfades
+    the overlap, so chunk boundaries don't click.
+
+    The mels are the same as `S3Token2Wav.inference(..., streaming=True)` of the same tokens (see
+    `compare_streaming`); without `streaming`, offline synthesis uses full attention and sounds slightly different.
+    """
+
+    def __init__(
+        self,
+        s3gen: 'S3Token2Wav',
+        ref_dict: dict,
+        *,
+        chunk_size: int = 25,
+        n_cfm_timesteps: Optional[int] = None,
+        mel_cache_len: int = 8,
+    ):
+        assert chunk_size > 0
+        self.s3gen = s3gen
+        self.ref_dict = ref_dict
+        self.chunk_size = chunk_size
+        self.n_cfm_timesteps = n_cfm_timesteps or (2 if s3gen.meanflow else 10)
+
+        self.flow_session = s3gen.flow.stream(
+            **s3gen.cast_ref_dict(ref_dict),
+            n_timesteps=self.n_cfm_timesteps,
+            meanflow=s3gen.meanflow,
+        )
+        self.hift_session = s3gen.mel2wav.stream(mel_cache_len=mel_cache_len)
+        self.mel_cache_len = mel_cache_len
+
+        self.tokens = torch.zeros(1, 0, dtype=torch.long, device=s3gen.device)  # not yet passed to the flow
+        self.mels = torch.zeros(1, 80, 0, dtype=s3gen.hift_dtype, device=s3gen.device)  # not yet vocoded
+        self.n_chunks = 0
+
+    def push(self, speech_tokens: torch.Tensor) -> Optional[torch.Tensor]:
+        """
+        Add speech tokens (any shape; special tokens like EOS are dropped). Returns a (1, n_samples) waveform chunk
+        once enough new tokens are buffered, else None.
+        """
+        self._append(speech_tokens)
+        if self.tokens.size(1) >= self.chunk_size:
+            return self._synthesize(finalize=False)
+        return None
+
+    def flush(self, speech_tokens: Optional[torch.Tensor] = None) -> torch.Tensor:
+        "Synthesize everything that is left, eg after T3 emitted EOS."
+        if speech_tokens is not None:
+            self._append(speech_tokens)
+        return self._synthesize(finalize=True)
+
+    def _append(self, speech_tokens: torch.Tensor):
+        speech_tokens = speech_tokens.reshape(-1).to(self.tokens.device)
+        speech_tokens = speech_tokens[speech_tokens < SPEECH_VOCAB_SIZE]
+        self.tokens = torch.cat([self.tokens, speech_tokens.long()[None]], dim=1)
+
+    @torch.inference_mode()
+    def _synthesize(self, finalize: bool):
+        mels = self.flow_session(self.tokens, finalize=finalize).to(dtype=self.s3gen.hift_dtype)
+        self.tokens = self.tokens[:, :0]
+        mels = torch.cat([self.mels, mels], dim=2)
+        if not finalize and mels.size(2) <= self.mel_cache_len:
+            # too short for the HiFT session to withhold its overlap, wait for more
+            self.mels = mels
+            return None
+        self.mels = mels[:, :, :0]
+
+        if mels.size(2) > 0:
+            wav = self.hift_session(mels, finalize=finalize)
+        else:
+            wav = self.hift_session.flush()
+            if wav is None:
+                wav = torch.zeros(1, 0, device=mels.device)
+
+        if self.n_chunks == 0:
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip (as in `S3Token2Wav.inference`)
+            n = min(wav.size(1), len(self.s3gen.trim_fade))
+            wav[:, :n] *= self.s3gen.trim_fade[:n]
+        self.n_chunks += 1
+        return wav
+
+
+@torch.inference_mode()
+def compare_streaming(
+    s3gen: 'S3Token2Wav',
+    speech_tokens: torch.Tensor,
+    ref_dict: dict,
+    *,
+    chunk_size: int = 25,
+    n_cfm_timesteps: Optional[int] = None,
+    seed: int = 0,
+):
+    """
+    Parity check of streaming against offline synthesis: the mels of `speech_tokens` are generated by the flow in
+    one pass (with `streaming=True`), and chunk by chunk as `S3GenStreamer` does, from the same noise.
+
+    Returns a dict with the relative L2 distance between the streamed and the offline mels (within
+    `STREAMING_MEL_TOLERANCE` in float32) and their max absolute difference.
+    """
+    speech_tokens = torch.atleast_2d(speech_tokens).to(s3gen.device)
+    speech_tokens = speech_tokens[:, (speech_tokens < SPEECH_VOCAB_SIZE).all(dim=0)]
+    ref_dict = s3gen.cast_ref_dict(dict(ref_dict))
+    n_cfm_timesteps = n_cfm_timesteps or (2 if s3gen.meanflow else 10)
+    flow = s3gen.flow
+    n_prompt = ref_dict["prompt_feat"].size(1)
+    n_frames = n_prompt + flow.token_mel_ratio * speech_tokens.size(1)
+
+    devices = [s3gen.device] if s3gen.device.type == "cuda" else []
+    with torch.random.fork_rng(devices=devices):
+        # (the offline solve draws the prompt frames' noise first thing, so reseeding reproduces it)
+        torch.manual_seed(seed)
+        noise = torch.randn(1, 80, n_frames, dtype=s3gen.dtype, device=s3gen.device)
+        torch.manual_seed(seed)
+        offline, _ = flow.inference(
+            token=speech_tokens,
+            token_len=torch.tensor([speech_tokens.size(1)], device=s3gen.device),
+            finalize=True,
+            n_timesteps=n_cfm_timesteps,
+            noised_mels=noise[:, :, n_prompt:],
+            meanflow=s3gen.meanflow,
+            streaming=True,
+            **ref_dict,
+        )
+
+    session = flow.stream(**ref_dict, n_timesteps=n_cfm_timesteps, meanflow=s3gen.meanflow, noise=noise)
+    chunks = []
+    for start in range(0, speech_tokens.size(1), chunk_size):
+        end = start + chunk_size
+        chunks.append(session(speech_tokens[:, start:end], finalize=end >= speech_tokens.size(1)))
+    streamed = torch.cat(chunks, dim=2)
+
+    diff = (streamed - offline).float()
+    stats = dict(
+        rel_l2=(diff.norm() / offline.float().norm()).item(),
+        max_abs_diff=diff.abs().max().item(),
+    )
+    logger.info(f"streaming parity ({chunk_size=}): {stats}")
+    if stats["rel_l2"] > STREAMING_MEL_TOLERANCE:
+        logger.warning(f"streamed mels differ from offline ones beyond {STREAMING_MEL_TOLERANCE=}")
+    return stats
@@ -226,13 +226,25 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         """Compute relative positional encoding.
 
         Args:
-            x (torch.Tensor): Input tensor (batch, head, time1, 2*time1-1).
-            time1 means the length of query vector.
+            x (torch.Tensor): Input tensor (batch, head, time1, 2*time2-1).
+            time1 means the length of query vector, time2 the length of key
+            vector. When time1 < time2 (chunk decoding with an attention
+            cache), the queries are the last time1 positions.
 
         Returns:
-            torch.Tensor: Output tensor.
+            torch.Tensor: Output tensor (batch, head, time1, time2).
 
         """
+        time1, time2 = x.size(2), (x.size(3) + 1) // 2
+        if time1 != time2:
+            # out[..., i, j] = x[..., i, time1 - 1 - i + j]
+            x = x.contiguous()
+            b, h, _, n = x.shape
+            return x.as_strided(
+                (b, h, time1, time2),
+                (x.stride(0), x.stride(1), n - 1, 1),
+                x.storage_offset() + time1 - 1,
+            )
         zero_pad = torch.zeros((x.size()[0], x.size()[1], x.size()[2], 1),
                                device=x.device,
                                dtype=x.dtype)
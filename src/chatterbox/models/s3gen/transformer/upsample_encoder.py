@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import List, Tuple
 
 import torch
 from torch import nn
@@ -62,6 +62,21 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, cache: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Upsample the next chunk of a stream.
+
+        Args:
+            inputs: (batch, channels, time)
+            cache: last `2 * stride` interpolated frames of the previous chunk,
+                (batch, channels, 2 * stride), zeros for the first chunk.
+        Returns:
+            outputs (batch, out_channels, time * stride) and the new cache.
+        """
+        outputs = F.interpolate(inputs, scale_factor=float(self.stride), mode="nearest")
+        outputs = torch.cat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -self.stride * 2:]
+        return self.conv(outputs), new_cache
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, channels: int, pre_lookahead_len: int = 1):
@@ -95,6 +110,32 @@ class PreLookaheadLayer(nn.Module):
         outputs = outputs + inputs
         return outputs
 
+    def forward_chunk(
+        self,
+        inputs: torch.Tensor,
+        context: torch.Tensor,
+        cache: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Process the next chunk of a stream.
+
+        Args:
+            inputs: (batch_size, seq_len, channels)
+            context: the (up to `pre_lookahead_len`) frames following `inputs`,
+                (batch_size, context_len, channels); missing frames are zero
+                padded, as at the end of an utterance.
+            cache: last 2 `conv1` outputs of the previous chunk,
+                (batch_size, channels, 2), zeros for the first chunk.
+        Returns:
+            outputs (batch_size, seq_len, channels) and the new cache.
+        """
+        outputs = torch.cat([inputs, context], dim=1).transpose(1, 2).contiguous()
+        outputs = F.pad(outputs, (0, inputs.size(1) + self.pre_lookahead_len - outputs.size(2)), mode='constant', value=0.0)
+        outputs = F.leaky_relu(self.conv1(outputs))
+        outputs = torch.cat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -2:]
+        outputs = self.conv2(outputs).transpose(1, 2).contiguous()
+        return outputs + inputs, new_cache
+
 
 class UpsampleConformerEncoder(torch.nn.Module):
 
@@ -240,6 +281,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
         xs_lens: torch.Tensor,
         decoding_chunk_size: int = 0,
         num_decoding_left_chunks: int = -1,
+        streaming: bool = False,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Embed positions in tensor.
 
@@ -254,6 +296,8 @@ class UpsampleConformerEncoder(torch.nn.Module):
             the chunk size is decoding_chunk_size.
                 >=0: use num_decoding_left_chunks
                 <0: use all left chunks
+            streaming: chunk-causal attention with `static_chunk_size`, as
+                in `UpsampleConformerEncoderSession` (full attention if False)
         Returns:
             encoder output tensor xs, and subsampled masks
             xs: padded output tensor (B, T' ~= T/subsample_rate, D)
@@ -265,6 +309,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
             https://discuss.pytorch.org/t/any-different-between-model-input-and-model-forward-input/3690/2
         """
         T = xs.size(1)
+        static_chunk_size = self.static_chunk_size if streaming else 0
         masks = ~make_pad_mask(xs_lens, T).unsqueeze(1)  # (B, 1, T)
         if self.global_cmvn is not None:
             xs = self.global_cmvn(xs)
@@ -274,9 +319,12 @@ class UpsampleConformerEncoder(torch.nn.Module):
                                               self.use_dynamic_chunk,
                                               self.use_dynamic_left_chunk,
                                               decoding_chunk_size,
-                                              self.static_chunk_size,
+                                              static_chunk_size,
                                               num_decoding_left_chunks)
         # lookahead + conformer encoder
+        # (zero the padding first: the lookahead of the last valid frames must see zeros, as at the end of an unpadded
+        # sequence, for padded batches to match unbatched inference)
+        xs = xs * mask_pad.transpose(1, 2).to(xs.dtype)
         xs = self.pre_lookahead_layer(xs)
         xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
@@ -292,7 +340,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
                                               self.use_dynamic_chunk,
                                               self.use_dynamic_left_chunk,
                                               decoding_chunk_size,
-                                              self.static_chunk_size * self.up_layer.stride,
+                                              static_chunk_size * self.up_layer.stride,
                                               num_decoding_left_chunks)
         xs = self.forward_up_layers(xs, chunk_masks, pos_emb, mask_pad)
 
@@ -303,6 +351,10 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def stream(self) -> "UpsampleConformerEncoderSession":
+        "Start an incremental encoding session, see `UpsampleConformerEncoderSession`."
+        return UpsampleConformerEncoderSession(self)
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
@@ -316,3 +368,129 @@ class UpsampleConformerEncoder(torch.nn.Module):
         for layer in self.up_encoders:
             xs, chunk_masks, _, _ = layer(xs, chunk_masks, pos_emb, mask_pad)
         return xs
+
+
+class UpsampleConformerEncoderSession:
+    """Incremental `UpsampleConformerEncoder` for streaming synthesis.
+
+    Speech token embeddings are pushed as they arrive (the prompt tokens
+    first); each push returns the encoder output of the tokens whose
+    `pre_lookahead_len` right context is now complete (all remaining tokens
+    when `finalize=True`), `up_layer.stride` frames per token.
+
+    Only the new tokens go through the network: the conformer layers keep
+    their attention KV caches, the lookahead and upsampling convolutions
+    keep their left context. Attention is therefore chunk-causal (a chunk
+    sees itself and every earlier chunk), so earlier outputs never change
+    and each step costs the same, up to attention over the cached keys.
+    With a `static_chunk_size`, tokens are only encoded once their whole
+    attention chunk (counted from the first prompt token) is complete, so
+    the output is the same as `UpsampleConformerEncoder.forward` with
+    `streaming=True`, however the tokens are pushed. Without, each push is
+    one chunk.
+
+    NOTE: batch rows are assumed to have equal lengths (no padding).
+    """
+
+    def __init__(self, encoder: UpsampleConformerEncoder):
+        assert not encoder.training, "streaming is for inference only"
+        self.encoder = encoder
+        self.pending = None  # embedded inputs still waiting for lookahead context (or for their chunk)
+        self.n_encoded = 0
+        self.lookahead_cache = None
+        self.up_cache = None
+        self.att_caches = [torch.zeros((0, 0, 0, 0))] * len(encoder.encoders)
+        self.up_att_caches = [torch.zeros((0, 0, 0, 0))] * len(encoder.up_encoders)
+
+    @property
+    def num_pending(self) -> int:
+        "number of pushed tokens without output yet"
+        return 0 if self.pending is None else self.pending.size(1)
+
+    def __call__(self, xs: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        """Push new inputs.
+
+        Args:
+            xs: (B, T, D) new token embeddings, T may be 0
+            finalize: no more inputs follow, flush everything
+        Returns:
+            (B, T' * up_layer.stride, D) encoder output of the T' newly
+            completed tokens (T' may be 0)
+        """
+        encoder = self.encoder
+        lookahead_len = encoder.pre_lookahead_layer.pre_lookahead_len
+
+        if encoder.global_cmvn is not None:
+            xs = encoder.global_cmvn(xs)
+        xs = encoder.embed.out(xs) * encoder.embed.pos_enc.xscale
+        self.pending = xs if self.pending is None else torch.cat([self.pending, xs], dim=1)
+
+        n_ready = self.pending.size(1) if finalize else self.pending.size(1) - lookahead_len
+        chunk_size = encoder.static_chunk_size
+        if chunk_size > 0 and not finalize:
+            n_ready = (self.n_encoded + n_ready) // chunk_size * chunk_size - self.n_encoded
+        if n_ready <= 0:
+            B, _, D = self.pending.shape
+            return self.pending.new_zeros(B, 0, D)
+        xs = self.pending[:, :n_ready]
+        context = self.pending[:, n_ready:n_ready + lookahead_len]
+        self.pending = self.pending[:, n_ready:]
+
+        if self.lookahead_cache is None:
+            B, _, D = xs.shape
+            self.lookahead_cache = xs.new_zeros(B, D, 2)
+            self.up_cache = xs.new_zeros(B, D, 2 * encoder.up_layer.stride)
+
+        # lookahead + conformer encoder
+        xs, self.lookahead_cache = encoder.pre_lookahead_layer.forward_chunk(xs, context, self.lookahead_cache)
+        chunks = self._chunk_sizes(n_ready)
+        xs, self.att_caches = self._forward_layers(encoder.encoders, encoder.embed, xs, self.att_caches, chunks)
+
+        # upsample + conformer encoder
+        stride = encoder.up_layer.stride
+        xs, self.up_cache = encoder.up_layer.forward_chunk(xs.transpose(1, 2), self.up_cache)
+        xs = encoder.up_embed.out(xs.transpose(1, 2)) * encoder.up_embed.pos_enc.xscale
+        xs, self.up_att_caches = self._forward_layers(
+            encoder.up_encoders, encoder.up_embed, xs, self.up_att_caches, [n * stride for n in chunks]
+        )
+        self.n_encoded += n_ready
+
+        if encoder.normalize_before:
+            xs = encoder.after_norm(xs)
+        return xs
+
+    def _chunk_sizes(self, n: int) -> List[int]:
+        "How the next `n` tokens split at attention chunk boundaries"
+        chunk_size = self.encoder.static_chunk_size
+        if chunk_size <= 0:
+            return [n]
+        sizes, start = [], self.n_encoded
+        while start < self.n_encoded + n:
+            end = min((start // chunk_size + 1) * chunk_size, self.n_encoded + n)
+            sizes.append(end - start)
+            start = end
+        return sizes
+
+    @classmethod
+    def _forward_layers(cls, layers, embed, xs, att_caches, chunks):
+        "Attention chunks of `chunks` frames each, one after the other"
+        outputs = []
+        for chunk in xs.split(chunks, dim=1):
+            chunk, att_caches = cls._forward_chunk(layers, embed, chunk, att_caches)
+            outputs.append(chunk)
+        return torch.cat(outputs, dim=1), att_caches
+
+    @staticmethod
+    def _forward_chunk(layers, embed, xs, att_caches):
+        # relative positions span the cached keys and the new chunk
+        cache_len = att_caches[0].size(2)
+        total_len = cache_len + xs.size(1)
+        embed.pos_enc.extend_pe(xs.new_zeros(1, total_len))
+        pos_emb = embed.pos_enc.position_encoding(offset=cache_len, size=total_len)
+
+        new_att_caches = []
+        for layer, att_cache in zip(layers, att_caches):
+            # no mask: every new position attends to the whole cache and chunk
+            xs, _, new_att_cache, _ = layer(xs, torch.ones((0, 0, 0), dtype=torch.bool), pos_emb, att_cache=att_cache)
+            new_att_caches.append(new_att_cache)
+        return xs, new_att_caches
@@ -3,6 +3,7 @@
 # MIT License
 import logging
 import torch
+import torch.nn.functional as F
 from dataclasses import dataclass
 from types import MethodType
 
@@ -30,7 +31,8 @@ class AlignmentAnalysisResult:
 
 
 class AlignmentStreamAnalyzer:
-    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0):
+    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0, rows=(0,),
+                 aligned_heads=LLAMA_ALIGNED_HEADS):
         """
         Some transformer TTS models implicitly solve text-speech alignment in one or more of their self-attention
         activation maps. This module exploits this to perform online integrity checks which streaming.
@@ -38,36 +40,117 @@ class AlignmentStreamAnalyzer:
         position, repetition, etc.
 
         NOTE: currently requires no queues.
+
+        The hooks stay registered until `close()` (or the end of a `with` block), so create one analyzer per request
+        and always close it.
+
+        `rows` are the batch rows to analyze (eg only the cond row with CFG), which all share the layout given by
+        `text_tokens_slice`. All state is kept on the model's device as (B,) tensors over these rows and updated
+        incrementally, so `step` never synchronizes with the host; the attention maps are collected into a
+        preallocated buffer (`alignment`).
+
+        `aligned_heads` are the (layer, head) pairs whose attention maps are averaged (see `T3.find_alignment_heads`).
+        For a Llama `tfmr` they are collected through hooks; `gpt2_forward` runs its own attention instead, so for a
+        GPT-2 `tfmr` pass `attention_spies` to it.
+
+        Analyzers of different requests can be combined with `cat` / `select` (see `T3BatchScheduler`); each row
+        then keeps its own text layout and frame count.
         """
         # self.queue = queue
         self.text_tokens_slice = (i, j) = text_tokens_slice
         self.eos_idx = eos_idx
-        self.alignment = torch.zeros(0, j-i)
-        # self.alignment_bin = torch.zeros(0, j-i)
+        self.rows = list(rows)
+        self.tfmr = tfmr
+        self.aligned_heads = aligned_heads
+        B, S = len(self.rows), j - i
+        device = next(tfmr.parameters()).device
+        self.device = device
+
+        # where each row's text tokens are in the attention keys (rows of a `cat` analyzer have their own)
+        self.text_start = torch.full((B,), i, dtype=torch.long, device=device)
+        self.text_len = torch.full((B,), S, dtype=torch.long, device=device)
+
+        self._alignment = torch.zeros(B, 256, S, device=device)  # grown as needed, see `alignment`
+        self.n_frames = 0  # (at least the frames of any row)
+        self._row_frames = torch.zeros(B, dtype=torch.long, device=device)
         self.curr_frame_pos = 0
-        self.text_position = 0
+        self._frame_pos = torch.zeros(B, dtype=torch.long, device=device)
+        self.text_position = torch.zeros(B, dtype=torch.long, device=device)
 
-        self.started = False
-        self.started_at = None
+        self.started = torch.zeros(B, dtype=torch.bool, device=device)
+        self.started_at = torch.full((B,), -1, dtype=torch.long, device=device)  # -1 = not yet
 
-        self.complete = False
-        self.completed_at = None
-        
-        # Track generated tokens for repetition detection
-        self.generated_tokens = []
+        self.complete = torch.zeros(B, dtype=torch.bool, device=device)
+        self.completed_at = torch.full((B,), -1, dtype=torch.long, device=device)
+
+        # Running statistics of the alignment, instead of reductions over the whole history every step
+        self._head_max = torch.zeros(B, device=device)  # max over all frames of the first 4 text tokens
+        self._prev_tail_max = torch.zeros(B, device=device)  # max over the last 2 text tokens of the last frame
+        self._tail_sums = torch.zeros(B, 3, device=device)  # per last-3 text token, sum over frames after completion
+        self._repetition_sum = torch.zeros(B, device=device)  # sum over frames after completion of the max over the
+                                                              # text tokens before the last 5
+
+        # Track generated tokens for repetition detection (the last two, and how many were seen)
+        self._last_tokens = torch.full((B, 2), -1, dtype=torch.long, device=device)
+        self._n_tokens = torch.zeros(B, dtype=torch.long, device=device)
+
+        # why EOS was forced on the last step: (B, 3) long_tail, alignment_repetition, token_repetition
+        self.forced_eos = torch.zeros(B, 3, dtype=torch.bool, device=device)
+
+        # text attention of the next frames when it wasn't collected by the hooks, left-padded with empty frames
+        # up to the most of any row, and the number of actual frames per row (see `cat`)
+        self._chunk = self._chunk_frames = None
 
         # Using `output_attentions=True` is incompatible with optimized attention kernels, so
         # using it for all layers slows things down too much. We can apply it to just one layer
         # by intercepting the kwargs and adding a forward hook (credit: jrm)
-        self.last_aligned_attns = []
-        for i, (layer_idx, head_idx) in enumerate(LLAMA_ALIGNED_HEADS):
-            self.last_aligned_attns += [None]
-            self._add_attention_spy(tfmr, i, layer_idx, head_idx)
+        self.last_aligned_attns = [None] * len(aligned_heads)
+        self.hook_handles = []
+        self.attention_spies = {}  # GPT-2: layer_idx -> callback, see `gpt2_forward`
+        self.open()
+
+    # per-row state, see `select` / `cat`
+    _ROW_STATE = (
+        "text_start", "text_len", "_row_frames", "_frame_pos", "text_position", "started", "started_at", "complete",
+        "completed_at", "_head_max", "_prev_tail_max", "_tail_sums", "_repetition_sum", "_last_tokens", "_n_tokens",
+        "forced_eos",
+    )
+
+    def open(self):
+        "(Re-)install the attention hooks, eg after `close()` (idempotent)."
+        if self.hook_handles or self.attention_spies:
+            return
+        is_gpt2 = hasattr(self.tfmr, "h")
+        for i, (layer_idx, head_idx) in enumerate(self.aligned_heads):
+            if is_gpt2:
+                self._add_gpt2_spy(i, layer_idx, head_idx)
+            else:
+                self._add_attention_spy(self.tfmr, i, layer_idx, head_idx)
 
     def _add_attention_spy(self, tfmr, buffer_idx, layer_idx, head_idx):
         """
-        Adds a forward hook to a specific attention layer to collect outputs.
+        Adds hooks to a specific attention layer to collect outputs. Only this layer is switched to eager attention
+        (`output_attentions=True`), the rest of the model keeps its SDPA kernels.
         """
+        def attention_forward_pre_hook(module, args, kwargs):
+            """
+            Request attention weights from this layer only. The model-level causal mask is skipped for SDPA
+            (`is_causal` is used instead), but the eager path needs an explicit one for multi-token inputs.
+            """
+            kwargs["output_attentions"] = True
+            hidden_states = kwargs.get("hidden_states", args[0] if args else None)
+            q_len = hidden_states.size(1)
+            if kwargs.get("attention_mask") is None and q_len > 1:
+                cache_position = kwargs.get("cache_position")
+                if cache_position is None:
+                    cache_position = torch.arange(q_len, device=hidden_states.device)
+                kv_len = int(cache_position[-1]) + 1
+                k_pos = torch.arange(kv_len, device=hidden_states.device)
+                mask = torch.zeros(q_len, kv_len, dtype=hidden_states.dtype, device=hidden_states.device)
+                mask.masked_fill_(k_pos[None] > cache_position[:, None], torch.finfo(hidden_states.dtype).min)
+                kwargs["attention_mask"] = mask[None, None]  # (1, 1, q_len, kv_len)
+            return args, kwargs
+
         def attention_forward_hook(module, input, output):
             """
             See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
@@ -76,103 +159,224 @@ class AlignmentStreamAnalyzer:
             - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
             """
             if isinstance(output, tuple) and len(output) > 1 and output[1] is not None:
-                step_attention = output[1].cpu()  # (B, n_heads, T0, Ti)
-                self.last_aligned_attns[buffer_idx] = step_attention[0, head_idx]  # (T0, Ti)
+                step_attention = output[1][self.rows, head_idx]  # (B, T0, Ti), stays on device
+                self.last_aligned_attns[buffer_idx] = step_attention
 
         target_layer = tfmr.layers[layer_idx].self_attn
-        # Register hook and store the handle
-        target_layer.register_forward_hook(attention_forward_hook)
-        if hasattr(tfmr, 'config') and hasattr(tfmr.config, 'output_attentions'):
-            self.original_output_attentions = tfmr.config.output_attentions
-            tfmr.config.output_attentions = True
+        # Register hooks and store the handles
+        self.hook_handles.append(target_layer.register_forward_pre_hook(attention_forward_pre_hook, with_kwargs=True))
+        self.hook_handles.append(target_layer.register_forward_hook(attention_forward_hook))
 
-    def step(self, logits, next_token=None):
+    def _add_gpt2_spy(self, buffer_idx, layer_idx, head_idx):
+        "Collects the attention maps of a `gpt2_forward` layer (chained with other heads of the same layer)."
+        previous = self.attention_spies.get(layer_idx)
+
+        def spy(attn_weights):  # (B, H, T0, Ti)
+            if previous is not None:
+                previous(attn_weights)
+            self.last_aligned_attns[buffer_idx] = attn_weights[self.rows, head_idx]
+
+        self.attention_spies[layer_idx] = spy
+
+    def close(self):
+        "Remove the attention hooks from the transformer (idempotent); attention maps already collected are kept."
+        for handle in self.hook_handles:
+            handle.remove()
+        self.hook_handles = []
+        self.attention_spies = {}
+
+    def shift(self, offset: int):
+        "The attention keys moved by `offset` positions (eg the rows of a KV-cache were re-aligned)."
+        self.text_start += offset
+        return self
+
+    def select(self, idx):
+        "Keep only the analyzed rows `idx` (an index tensor)."
+        for name in self._ROW_STATE:
+            setattr(self, name, getattr(self, name)[idx])
+        self._alignment = self._alignment[idx]
+        self.rows = torch.as_tensor(self.rows, device=self.device)[idx]
+        self.last_aligned_attns = [None if a is None else a[idx] for a in self.last_aligned_attns]
+        if self._chunk is not None:
+            self._chunk, self._chunk_frames = self._chunk[idx], self._chunk_frames[idx]
+        return self
+
+    @classmethod
+    def cat(cls, analyzers, rows):
         """
-        Emits an AlignmentAnalysisResult into the output queue, and potentially modifies the logits to force an EOS.
+        Combine `analyzers` (eg one per request) into one over the batch `rows`, which are given in the same order.
+        The attention each of them collected last is used for the next `step`; their hooks are removed and the new
+        analyzer hooks the transformer instead.
         """
-        # extract approximate alignment matrix chunk (1 frame at a time after the first chunk)
-        aligned_attn = torch.stack(self.last_aligned_attns).mean(dim=0) # (N, N)
-        i, j = self.text_tokens_slice
+        chunks = [a._text_attention() for a in analyzers]
+        frames = [
+            torch.full((c.size(0),), c.size(1), device=c.device) if a._chunk is None else a._chunk_frames
+            for a, c in zip(analyzers, chunks)
+        ]
+        for a in analyzers:
+            a.close()
+        S = max(a._alignment.size(2) for a in analyzers)
+        first = analyzers[0]
+        out = cls(first.tfmr, None, (0, S), eos_idx=first.eos_idx, rows=rows, aligned_heads=first.aligned_heads)
+        out.text_tokens_slice = None  # (per row, see `text_start` / `text_len`)
+        for name in cls._ROW_STATE:
+            setattr(out, name, torch.cat([getattr(a, name) for a in analyzers]))
+        out.n_frames = max(a.n_frames for a in analyzers)
+        out.curr_frame_pos = max(a.curr_frame_pos for a in analyzers)
+        n = max(a._alignment.size(1) for a in analyzers)
+        out._alignment = torch.cat([
+            F.pad(a._alignment, (0, S - a._alignment.size(2), 0, n - a._alignment.size(1))) for a in analyzers
+        ])
+        n = max(c.size(1) for c in chunks)
+        out._chunk = torch.cat([F.pad(c, (0, S - c.size(2), n - c.size(1), 0)) for c in chunks])
+        out._chunk_frames = torch.cat(frames)
+        return out
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def alignment(self):
+        """
+        Text-speech alignment so far, (T, S) (or (B, T, S) for several rows), on device. Rows that have fewer frames
+        or text tokens than others are zero-padded.
+        """
+        A = self._alignment[:, :self.n_frames]
+        return A[0] if A.size(0) == 1 else A
+
+    def _append(self, A_chunk, n_valid=None):
+        "Add the frames of `A_chunk`; with `n_valid`, the number of actual frames per row, they are left-padded."
+        n = A_chunk.size(1)
+        if self.n_frames + n > self._alignment.size(1):
+            grown = self._alignment.new_zeros(
+                self._alignment.size(0), max(2 * self._alignment.size(1), self.n_frames + n), self._alignment.size(2)
+            )
+            grown[:, :self.n_frames] = self._alignment[:, :self.n_frames]
+            self._alignment = grown
+        k = torch.arange(n, device=self.device)
+        frames = self._row_frames[:, None] + k  # (B, n)
+        if n_valid is None:
+            self._row_frames = self._row_frames + n
+        else:
+            # (the empty frames are written after the row's last one, which is still empty and overwritten later)
+            n_pad = (n - n_valid)[:, None]
+            frames = torch.where(k < n_pad, frames + n_valid[:, None], frames - n_pad)
+            self._row_frames = self._row_frames + n_valid
+        self._alignment.scatter_(1, frames[..., None].expand(-1, -1, A_chunk.size(2)), A_chunk)
+        self.n_frames += n
+
+    def _text_attention(self):
+        "(B, n, S) attention of the frames of the last forward pass over the text tokens, zero past each row's text"
+        if self._chunk is not None:
+            return self._chunk
+        aligned_attn = torch.stack(self.last_aligned_attns).mean(dim=0)  # (B, N, N)
         if self.curr_frame_pos == 0:
             # first chunk has conditioning info, text tokens, and BOS token
-            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
-        else:
-            # subsequent chunks have 1 frame due to KV-caching
-            A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
+            # (queries start after the conditioning when it was served from a cached prefix)
+            i, j = self.text_tokens_slice
+            q_offset = aligned_attn.size(2) - aligned_attn.size(1)
+            return aligned_attn[:, j - q_offset:, i:j].float()  # (B, T, S)
 
-        # TODO: monotonic masking; could have issue b/c spaces are often skipped.
-        A_chunk[:, self.curr_frame_pos + 1:] = 0
+        # subsequent chunks have 1 frame due to KV-caching
+        cols = torch.arange(self._alignment.size(2), device=self.device)
+        idx = (self.text_start[:, None] + cols).clamp(max=aligned_attn.size(2) - 1)  # (B, S)
+        A_chunk = aligned_attn.float().gather(2, idx[:, None].expand(-1, aligned_attn.size(1), -1))
+        return A_chunk.masked_fill(cols >= self.text_len[:, None, None], 0)  # (B, 1, S)
 
+    def _last_text(self, A_chunk, k):
+        "(B, n, k) attention over the last `k` text tokens of each row"
+        idx = self.text_len[:, None] - k + torch.arange(k, device=self.device)  # (B, k)
+        last = A_chunk.gather(2, idx.clamp(min=0)[:, None].expand(-1, A_chunk.size(1), -1))
+        return last.masked_fill(idx[:, None] < 0, 0)
 
-        self.alignment = torch.cat((self.alignment, A_chunk), dim=0)
+    def step(self, logits, next_token=None):
+        """
+        Updates the alignment with the last forward pass, and potentially modifies the logits, (B, V) for the
+        analyzed rows, to suppress or force an EOS. Runs entirely on device.
+        """
+        # extract approximate alignment matrix chunk (1 frame at a time after the first chunk)
+        A_chunk = self._text_attention()
+        n_valid = self._chunk_frames
+        self._chunk = self._chunk_frames = None
+        S = self.text_len  # (B,)
 
-        A = self.alignment
-        T, S = A.shape
+        # TODO: monotonic masking; could have issue b/c spaces are often skipped.
+        cols = torch.arange(A_chunk.size(2), device=self.device)
+        A_chunk = A_chunk.masked_fill(cols > self._frame_pos[:, None, None], 0)
+        self._append(A_chunk, n_valid)
+        T = self._row_frames
 
         # update position
-        cur_text_posn = A_chunk[-1].argmax()
-        discontinuity = not(-4 < cur_text_posn - self.text_position < 7) # NOTE: very lenient!
-        if not discontinuity:
-            self.text_position = cur_text_posn
+        cur_text_posn = A_chunk[:, -1].argmax(dim=-1)  # (B,)
+        step = cur_text_posn - self.text_position
+        discontinuity = ~((-4 < step) & (step < 7))  # NOTE: very lenient!
+        self.text_position = torch.where(discontinuity, self.text_position, cur_text_posn)
 
         # Hallucinations at the start of speech show up as activations at the bottom of the attention maps!
         # To mitigate this, we just wait until there are no activations far off-diagonal in the last 2 tokens,
         # and there are some strong activations in the first few tokens.
-        false_start = (not self.started) and (A[-2:, -2:].max() > 0.1 or A[:, :4].max() < 0.5)
-        self.started = not false_start
-        if self.started and self.started_at is None:
-            self.started_at = T
+        tail_2 = self._last_text(A_chunk, 2)
+        last_tail_max = tail_2[:, -2:].amax(dim=(1, 2))
+        if n_valid is not None:
+            last_tail_max = torch.where(
+                n_valid < 2, torch.maximum(last_tail_max, self._prev_tail_max), last_tail_max
+            )
+        elif A_chunk.size(1) < 2:
+            last_tail_max = torch.maximum(last_tail_max, self._prev_tail_max)  # (the last 2 frames)
+        self._prev_tail_max = tail_2[:, -1].amax(dim=-1)
+        self._head_max = torch.maximum(self._head_max, A_chunk[:, :, :4].amax(dim=(1, 2)))
+        false_start = ~self.started & ((last_tail_max > 0.1) | (self._head_max < 0.5))
+        self.started = ~false_start
+        self.started_at = torch.where(self.started & (self.started_at < 0), T, self.started_at)
 
-        # Is generation likely complete?
-        self.complete = self.complete or self.text_position >= S - 3
-        if self.complete and self.completed_at is None:
-            self.completed_at = T
+        # Frames after the one where generation completed (the history analysed below)
+        after_completion = self.complete.float()
+        self._tail_sums += self._last_text(A_chunk, 3).sum(dim=1) * after_completion[:, None]
+        before_last_5 = A_chunk.masked_fill(cols >= (S - 5)[:, None, None], 0)  # (zeros don't change the max)
+        self._repetition_sum += before_last_5.amax(dim=2).sum(dim=1) * after_completion * (S > 5)
 
-        # NOTE: EOS rarely assigned activations, and second-last token is often punctuation, so use last 3 tokens.
-        # NOTE: due to the false-start behaviour, we need to make sure we skip activations for the first few tokens.
-        last_text_token_duration = A[15:, -3:].sum()
+        # Is generation likely complete?
+        self.complete = self.complete | (self.text_position >= S - 3)
+        self.completed_at = torch.where(self.complete & (self.completed_at < 0), T, self.completed_at)
 
         # Activations for the final token that last too long are likely hallucinations.
-        long_tail = self.complete and (A[self.completed_at:, -3:].sum(dim=0).max() >= 5) # 200ms
+        long_tail = self.complete & (self._tail_sums.amax(dim=-1) >= 5)  # 200ms
 
         # If there are activations in previous tokens after generation has completed, assume this is a repetition error.
-        alignment_repetition = self.complete and (A[self.completed_at:, :-5].max(dim=1).values.sum() > 5)
-        
+        alignment_repetition = self.complete & (self._repetition_sum > 5)
+
         # Track generated tokens for repetition detection
         if next_token is not None:
-            # Convert tensor to scalar if needed
-            if isinstance(next_token, torch.Tensor):
-                token_id = next_token.item() if next_token.numel() == 1 else next_token.view(-1)[0].item()
-            else:
-                token_id = next_token
-            self.generated_tokens.append(token_id)
-            
-            # Keep only last 8 tokens to prevent memory issues
-            if len(self.generated_tokens) > 8:
-                self.generated_tokens = self.generated_tokens[-8:]
-            
+            token = torch.as_tensor(next_token, device=self.device).view(-1).expand(len(self.rows))
+            self._last_tokens = torch.stack([self._last_tokens[:, 1], token], dim=1)
+            self._n_tokens = self._n_tokens + 1
+
         # Check for excessive token repetition (3x same token in a row)
-        token_repetition = (
-            # self.complete and 
-            len(self.generated_tokens) >= 3 and
-            len(set(self.generated_tokens[-2:])) == 1
+        token_repetition = (self._last_tokens[:, 0] == self._last_tokens[:, 1]) & (self._n_tokens >= 3)
+
+        # Suppress EoS to prevent early termination (only if text is longer than 5 tokens)
+        suppress = (S > 5) & (cur_text_posn < S - 3)
+        logits[..., self.eos_idx] = torch.where(
+            suppress, torch.full_like(logits[..., self.eos_idx], -2**15), logits[..., self.eos_idx]
         )
-        
-        if token_repetition:
-            repeated_token = self.generated_tokens[-1]
-            logger.warning(f"🚨 Detected 2x repetition of token {repeated_token}")
-            
-        # Suppress EoS to prevent early termination
-        if cur_text_posn < S - 3 and S > 5:  # Only suppress if text is longer than 5 tokens
-            logits[..., self.eos_idx] = -2**15
 
         # If a bad ending is detected, force emit EOS by modifying logits
         # NOTE: this means logits may be inconsistent with latents!
-        if long_tail or alignment_repetition or token_repetition:
-            logger.warning(f"forcing EOS token, {long_tail=}, {alignment_repetition=}, {token_repetition=}")
-            # (±2**15 is safe for all dtypes >= 16bit)
-            logits = -(2**15) * torch.ones_like(logits)
-            logits[..., self.eos_idx] = 2**15
+        self.forced_eos = torch.stack([long_tail, alignment_repetition, token_repetition], dim=-1)
+        # (±2**15 is safe for all dtypes >= 16bit)
+        forced = -(2**15) * torch.ones_like(logits)
+        forced[..., self.eos_idx] = 2**15
+        logits = torch.where(self.forced_eos.any(dim=-1)[:, None], forced, logits)
 
         self.curr_frame_pos += 1
+        self._frame_pos = self._frame_pos + 1
         return logits
+
+    def log_forced_eos(self):
+        "Log why EOS was forced at the last step, if it was (synchronizes, so call it once generation has stopped)"
+        for row, (long_tail, alignment_repetition, token_repetition) in enumerate(self.forced_eos.tolist()):
+            if long_tail or alignment_repetition or token_repetition:
+                logger.warning(f"forced EOS token, {row=}, {long_tail=}, {alignment_repetition=}, {token_repetition=}")
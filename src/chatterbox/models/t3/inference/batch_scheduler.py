@@ -0,0 +1,453 @@
+import heapq
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, List, Optional
+
+import torch
+from torch import Tensor
+
+from ..modules.cond_enc import T3Cond
+from .alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .kv_cache import StaticKVCache
+from .sampler import SpeechTokenSampler
+
+if TYPE_CHECKING:
+    from ..t3 import T3
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class T3Request:
+    """
+    One `T3.inference`-style generation request. The sampling fields mirror the `T3.inference` kwargs; the rest is
+    decoding state owned by `T3BatchScheduler`.
+    """
+    t3_cond: T3Cond
+    text_tokens: Tensor
+    max_new_tokens: int = 1000
+    temperature: float = 0.8
+    top_p: float = 0.95
+    min_p: float = 0.05
+    repetition_penalty: float = 1.2
+    cfg_weight: float = 0.5
+    cfg_max_tokens: Optional[int] = None  # CFG for the first tokens only, see `T3.inference`
+
+    future: Future = field(default_factory=Future, repr=False)
+    generated: List[int] = field(default_factory=list, repr=False)  # sampled token ids
+    step: int = 0
+    rows: List[int] = field(default_factory=list, repr=False)  # batch rows: (cond, uncond) with CFG, else (cond,)
+
+    @property
+    def n_rows(self):
+        return len(self.rows)
+
+
+class T3BatchScheduler:
+    """
+    Continuous batching for `T3.inference`: requests are admitted into the running decode batch at token boundaries
+    and retired as soon as they emit EOS (or run out of tokens), so concurrent requests share every transformer step.
+
+    The KV-cache is a preallocated `StaticKVCache` (from `T3.kv_cache_pool`) with a fixed set of row slots: each
+    request holds one cond and, with CFG, one uncond row, plus its own sampling params and step counter. All rows
+    share the write position, so a new request's prefill is copied into free rows, right-aligned to it, and rows
+    are freed by masking them out; active rows never move. Positions are tracked per row so RoPE sees exactly the
+    positions a solo `T3.inference` call would. Only the rows up to the highest one in use go through the
+    transformer, and columns that are padding for every row are only dropped when the cache runs out of space.
+
+    For models with `alignment_heads` (multilingual), a single `AlignmentStreamAnalyzer` covers the cond rows of
+    all requests; like the sampler, it is combined / narrowed down as requests join and leave.
+
+    Usage, either driven by a background thread:
+
+        scheduler = T3BatchScheduler(t3).start()
+        speech_tokens = scheduler.submit(t3_cond, text_tokens, cfg_weight=0.5).result()
+
+    or synchronously, for offline jobs: `submit(...)` a set of requests and call `run_until_complete()`.
+    """
+
+    def __init__(self, t3: 'T3', max_batch_size: int = 8):
+        assert not t3.is_gpt, "continuous batching is only implemented for the Llama T3 (use `inference_turbo`)"
+        self.t3 = t3
+        self.max_batch_size = max_batch_size
+        self.backend = t3.backend
+
+        self.pending = deque()
+        self.active: List[T3Request] = []
+        self.max_rows = 2 * max_batch_size
+        self.free_rows = list(range(self.max_rows))  # heap, the lowest free row is used first
+        self.n_used = 0  # rows [0, n_used) go through the transformer
+        self.past: Optional[StaticKVCache] = None  # over all `max_rows` rows, None while idle
+        self.attention_mask = None  # (max_rows, past.max_len) padding mask of every row
+        self.next_logits = None  # (max_rows, V) logits for the next token of every row
+        self.sampler = None  # one row per active request
+        self.analyzer: Optional[AlignmentStreamAnalyzer] = None  # one row per active request, see `alignment_heads`
+        self.cond_rows = self.uncond_rows = None  # rows of `next_logits` holding each request's cond / uncond logits
+
+        self._cv = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    @property
+    def n_rows(self):
+        return sum(req.n_rows for req in self.active)
+
+    @property
+    def seq_len(self):
+        "write position shared by all rows"
+        return 0 if self.past is None else self.past.get_seq_length()
+
+    def submit(
+        self,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        *,
+        max_new_tokens=1000,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+        cfg_max_tokens=None,
+        use_token_budget=False,
+    ) -> Future:
+        """
+        Queue a request; the returned future resolves to the predicted speech tokens, (1, num_tokens) including EOS,
+        just like `T3.inference`. `text_tokens` must already hold two rows when `cfg_weight > 0`. With
+        `use_token_budget`, `max_new_tokens` is also capped by `T3.speech_token_budget` of the text.
+        """
+        text_tokens = torch.atleast_2d(text_tokens)
+        if use_token_budget:
+            max_new_tokens = min(max_new_tokens, self.t3.speech_token_budget(text_tokens))
+        req = T3Request(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            min_p=min_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            cfg_max_tokens=cfg_max_tokens,
+        )
+        with self._cv:
+            self.pending.append(req)
+            self._cv.notify()
+        return req.future
+
+    def start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="T3BatchScheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cv:
+            self._stopped = True
+            self._cv.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_until_complete(self):
+        "Synchronously decode until all submitted requests are done."
+        assert self._thread is None, "scheduler is driven by its background thread"
+        while self.pending or self.active:
+            self.step()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not (self._stopped or self.pending or self.active):
+                    self._cv.wait()
+                if self._stopped:
+                    break
+            try:
+                self.step()
+            except Exception as e:
+                logger.exception("T3BatchScheduler step failed")
+                self._fail_active(e)
+
+        self._fail_active(RuntimeError("T3BatchScheduler stopped"))
+        with self._cv:
+            while self.pending:
+                self.pending.popleft().future.set_exception(RuntimeError("T3BatchScheduler stopped"))
+
+    def _fail_active(self, exc):
+        for req in self.active:
+            if not req.future.done():
+                req.future.set_exception(exc)
+        self.active = []
+        self._reset()
+
+    def _reset(self):
+        "Back to an empty batch; the KV-cache goes back to the pool."
+        if self.past is not None:
+            self.t3.kv_cache_pool.release(self.past)
+        if self.analyzer is not None:
+            self.analyzer.close()
+        self.past = self.attention_mask = self.next_logits = self.sampler = self.analyzer = None
+        self.free_rows = list(range(self.max_rows))
+        self.n_used = 0
+
+    @torch.inference_mode()
+    def step(self):
+        """
+        One token boundary: admit waiting requests, sample the next token of every active request, retire the
+        finished ones and run a single batched transformer step for the rest.
+        """
+        self._admit()
+        if not self.active:
+            return
+
+        t3 = self.t3
+        stop_token = t3.hp.stop_speech_token
+
+        # sample the next token of every request in one pass (per-row CFG weights and sampling params)
+        stepped = self.active
+        logits = self.sampler.apply_cfg(self.next_logits[self.cond_rows], self.next_logits[self.uncond_rows])
+        if self.analyzer is not None:
+            last_tokens = [req.generated[-1] if req.generated else t3.hp.start_speech_token for req in stepped]
+            logits = self.analyzer.step(logits, next_token=torch.tensor(last_tokens, device=logits.device))
+        next_tokens = self.sampler(logits)  # (N, 1)
+        sampled = next_tokens.view(-1).tolist()
+        keep = []
+        for req, token in zip(stepped, sampled):
+            req.generated.append(token)
+            req.step += 1
+            done = token == stop_token or req.step >= req.max_new_tokens
+            if done:
+                req.future.set_result(torch.tensor([req.generated], dtype=torch.long, device=t3.device))
+            keep.append(not done)
+
+        if not all(keep):
+            if self.analyzer is not None and stop_token in sampled:
+                self.analyzer.log_forced_eos()
+            self._retire(keep)
+        if not self.active:
+            return
+        self._end_cfg()
+
+        # embed the new tokens; positions follow each request's own step counter (free rows just repeat a token, their
+        # outputs are never used)
+        device = next_tokens.device
+        kept = torch.tensor(keep, device=device).nonzero().squeeze(1)
+        tokens = next_tokens[kept].view(-1)
+        positions = torch.tensor([req.step for req in self.active], device=device)
+        row_tokens = torch.full((self.n_used,), stop_token, dtype=torch.long, device=device)
+        row_positions = torch.zeros(self.n_used, dtype=torch.long, device=device)
+        for rows in (self.cond_rows, self.uncond_rows):
+            row_tokens[rows] = tokens
+            row_positions[rows] = positions
+        inputs_embeds = t3.speech_emb(row_tokens[:, None])
+        inputs_embeds = inputs_embeds + t3.speech_pos_emb.get_fixed_embedding(row_positions[:, None])  # (R, 1, dim)
+
+        self._reserve(1)
+        T = self.seq_len
+        mask = self.attention_mask[:self.n_used, :T + 1]
+        position_ids = mask[:, :T].sum(dim=1, keepdim=True)  # (R, 1)
+        mask[:, T] = 1
+        output = self.backend(
+            inputs_embeds=inputs_embeds,
+            past_key_values=self.past.select_rows(self.n_used),
+            attention_mask=mask,
+            position_ids=position_ids,
+            output_attentions=False,
+            output_hidden_states=False,
+            return_dict=True,
+            num_logits_to_keep=1,
+        )
+        self.next_logits[:self.n_used] = output.logits[:, -1, :]
+
+    def _update_rows(self):
+        "Index each request's cond / uncond rows in the batch; requests without CFG use their cond row twice."
+        device = self.next_logits.device
+        self.cond_rows = torch.tensor([req.rows[0] for req in self.active], device=device)
+        self.uncond_rows = torch.tensor([req.rows[-1] for req in self.active], device=device)
+        self.n_used = 1 + max(row for req in self.active for row in req.rows)
+
+    def _admit(self):
+        "Prefill waiting requests one by one and merge them into the running batch."
+        while len(self.active) < self.max_batch_size:
+            with self._cv:
+                if not self.pending:
+                    break
+                req = self.pending.popleft()
+            if not req.future.set_running_or_notify_cancel():
+                continue
+            if self.analyzer is not None:
+                self.analyzer.close()  # (its hooks would also see the prefill)
+            try:
+                past, logits, analyzer = self._prefill(req)
+            except Exception as e:
+                req.future.set_exception(e)
+                continue
+            self._merge(req, past, logits, analyzer)
+        if self.analyzer is not None:
+            self.analyzer.open()
+
+    def _prefill(self, req: T3Request):
+        t3 = self.t3
+        text_tokens = req.text_tokens.to(dtype=torch.long, device=t3.device)
+        n_rows = 2 if req.cfg_weight > 0.0 else 1
+        assert text_tokens.size(0) >= n_rows, "CFG needs two rows of text tokens"
+        text_tokens = text_tokens[:n_rows]
+
+        # prefill text and BOS on top of the (cached) conditioning prefix
+        inputs_embeds, _ = t3.prepare_inference_embeds(
+            t3_cond=req.t3_cond,
+            text_tokens=text_tokens,
+            cfg_weight=req.cfg_weight,
+            include_cond=False,
+        )
+        cond_prefix = t3.get_cond_prefix(req.t3_cond)
+        analyzer = None
+        if t3.alignment_heads is not None:
+            # (analyzes the cond row, with this request's own layout until it is merged into the batch)
+            analyzer = AlignmentStreamAnalyzer(
+                t3.tfmr,
+                None,
+                text_tokens_slice=(cond_prefix.len_cond, cond_prefix.len_cond + text_tokens.size(-1)),
+                eos_idx=t3.hp.stop_speech_token,
+                aligned_heads=t3.alignment_heads,
+            )
+        try:
+            output = self.backend(
+                inputs_embeds=inputs_embeds,
+                past_key_values=cond_prefix.to_dynamic_cache(n_rows),
+                use_cache=True,
+                output_attentions=False,
+                output_hidden_states=False,
+                return_dict=True,
+                num_logits_to_keep=1,
+            )
+        finally:
+            if analyzer is not None:
+                analyzer.close()
+        req.generated = []
+        req.step = 0
+        return output.past_key_values, output.logits[:, -1, :], analyzer
+
+    def _make_sampler(self, req: T3Request):
+        sampler = SpeechTokenSampler(
+            1,
+            self.t3.hp.speech_tokens_dict_size,
+            temperature=req.temperature,
+            top_p=req.top_p,
+            min_p=req.min_p,
+            repetition_penalty=req.repetition_penalty,
+            cfg_weight=req.cfg_weight if req.n_rows == 2 else 0.0,
+            device=self.t3.device,
+        )
+        # generated ids start with BOS, like `T3.inference`
+        sampler.update(torch.tensor([self.t3.hp.start_speech_token], device=self.t3.device))
+        return sampler
+
+    def _merge(self, req: T3Request, past, logits: Tensor, analyzer: Optional[AlignmentStreamAnalyzer]):
+        "Copy a prefilled request into free rows, right-aligned to the shared write position."
+        new_len = past.get_seq_length()
+        req.rows = [heapq.heappop(self.free_rows) for _ in range(logits.size(0))]
+        if self.past is None:
+            self.past = self.t3.kv_cache_pool.acquire(
+                batch_size=self.max_rows,
+                max_len=new_len + req.max_new_tokens,
+                dtype=self.t3.tfmr.dtype,
+                device=logits.device,
+            )
+            self.attention_mask = torch.zeros(self.max_rows, self.past.max_len, dtype=torch.long, device=logits.device)
+            self.next_logits = logits.new_zeros(self.max_rows, logits.size(-1))
+        if new_len > self.seq_len:
+            # longer than the batch so far: shift all rows right to make room on the left
+            if new_len > self.past.max_len:
+                self._grow(new_len)
+            self._move(0, self.seq_len, new_len - self.seq_len)
+
+        rows = torch.tensor(req.rows, device=logits.device)
+        T = self.seq_len
+        self.past.write_rows(rows, past, T)
+        self.attention_mask[rows] = 0
+        self.attention_mask[rows, T - new_len:T] = 1
+        self.next_logits[rows] = logits
+
+        sampler = self._make_sampler(req)
+        self.sampler = sampler if self.sampler is None else SpeechTokenSampler.cat([self.sampler, sampler])
+        self.active = self.active + [req]
+        if analyzer is not None:
+            analyzer.shift(T - new_len)  # (from the prefill's positions to the batch's)
+            analyzers = [analyzer] if self.analyzer is None else [self.analyzer, analyzer]
+            self.analyzer = AlignmentStreamAnalyzer.cat(analyzers, rows=[r.rows[0] for r in self.active])
+        self._update_rows()
+
+    def _free_rows(self, rows: List[int]):
+        self.attention_mask[rows] = 0
+        for row in rows:
+            heapq.heappush(self.free_rows, row)
+
+    def _retire(self, keep: List[bool]):
+        "Free the rows of finished requests."
+        for req, k in zip(self.active, keep):
+            if not k:
+                self._free_rows(req.rows)
+        self.active = [req for req, k in zip(self.active, keep) if k]
+        if not self.active:
+            self._reset()
+            return
+
+        kept = torch.tensor(keep, device=self.next_logits.device).nonzero().squeeze(1)
+        self.sampler.select(kept)
+        if self.analyzer is not None:
+            self.analyzer.select(kept)
+        self._update_rows()
+
+    def _end_cfg(self):
+        "Free the uncond row of requests that are past their CFG window (`cfg_max_tokens`)."
+        ended = False
+        for req in self.active:
+            if req.n_rows == 2 and req.cfg_max_tokens is not None and req.step >= req.cfg_max_tokens:
+                # (its sampler row then combines the cond logits with themselves, ie no CFG)
+                self._free_rows(req.rows[1:])
+                req.rows = req.rows[:1]
+                ended = True
+        if ended:
+            self._update_rows()
+
+    def _move(self, start: int, end: int, to: int):
+        "Move KV-cache and mask columns [start, end) to `to`, see `StaticKVCache.move`."
+        self.past.move(start, end, to)
+        n = end - start
+        self.attention_mask[:, to:to + n] = self.attention_mask[:, start:end].clone()
+        self.attention_mask[:, :to] = 0
+        if self.analyzer is not None:
+            self.analyzer.shift(to - start)
+
+    def _reserve(self, n: int):
+        "Make room for `n` more positions: drop the columns that are padding for every request, else grow the cache."
+        T = self.seq_len
+        if T + n <= self.past.max_len:
+            return
+        rows = torch.tensor([row for req in self.active for row in req.rows], device=self.attention_mask.device)
+        start = int(self.attention_mask[rows, :T].any(dim=0).nonzero()[0])
+        if start > 0:
+            self._move(start, T, 0)
+        if self.seq_len + n > self.past.max_len:
+            self._grow(self.seq_len + n)
+
+    def _grow(self, length: int):
+        "Move to a larger KV-cache from the pool, of at least `length` positions."
+        device = self.next_logits.device
+        grown = self.t3.kv_cache_pool.acquire(
+            batch_size=self.max_rows,
+            max_len=max(length, 2 * self.past.max_len),
+            dtype=self.t3.tfmr.dtype,
+            device=device,
+        )
+        grown.write_rows(torch.arange(self.max_rows, device=device), self.past.select_rows(self.max_rows), self.seq_len)
+        mask = self.attention_mask.new_zeros(self.max_rows, grown.max_len)
+        mask[:, :self.attention_mask.size(1)] = self.attention_mask
+        self.t3.kv_cache_pool.release(self.past)
+        self.past, self.attention_mask = grown, mask
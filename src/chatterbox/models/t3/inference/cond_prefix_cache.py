@@ -0,0 +1,80 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+from torch import Tensor
+from transformers import DynamicCache
+
+from ..modules.cond_enc import T3Cond
+
+
+@dataclass
+class CondPrefix:
+    """
+    Transformer KV state of the conditioning prefix (speaker embedding, prompt speech tokens / perceiver output,
+    emotion), for a single row. The prefix only attends to itself, so it is the same for every text and for both
+    CFG rows.
+    """
+    keys: List[Tensor]  # per layer, (1, n_kv_heads, len_cond, head_dim)
+    values: List[Tensor]
+
+    @property
+    def len_cond(self):
+        return self.keys[0].size(2)
+
+    def to_dynamic_cache(self, n_rows: int):
+        "Fresh `DynamicCache` holding the prefix for `n_rows` rows."
+        return DynamicCache.from_legacy_cache(tuple(
+            (k.expand(n_rows, -1, -1, -1).clone(), v.expand(n_rows, -1, -1, -1).clone())
+            for k, v in zip(self.keys, self.values)
+        ))
+
+
+class CondPrefixCache:
+    """
+    Bounded LRU of `CondPrefix`, keyed by the content of a `T3Cond` (so a new `T3Cond` for the same voice and
+    exaggeration hits the cache).
+    """
+
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(t3_cond: T3Cond, *extra):
+        h = hashlib.sha1()
+        fields = ["speaker_emb", "clap_emb", "cond_prompt_speech_tokens", "emotion_adv"]
+        if t3_cond.cond_prompt_speech_tokens is None:
+            fields.append("cond_prompt_speech_emb")
+        for name in fields:
+            x = getattr(t3_cond, name)
+            if x is None:
+                h.update(b"none")
+                continue
+            x = torch.as_tensor(x).detach()
+            h.update(f"{name}:{x.dtype}:{tuple(x.shape)}".encode())
+            h.update(x.cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+        h.update(repr(extra).encode())
+        return h.hexdigest()
+
+    def get(self, key) -> Optional[CondPrefix]:
+        with self._lock:
+            prefix = self._entries.get(key)
+            if prefix is not None:
+                self._entries.move_to_end(key)
+            return prefix
+
+    def put(self, key, prefix: CondPrefix):
+        with self._lock:
+            self._entries[key] = prefix
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
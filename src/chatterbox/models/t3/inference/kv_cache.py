@@ -0,0 +1,239 @@
+import math
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from transformers import GPT2Model
+from transformers.cache_utils import Cache
+
+if TYPE_CHECKING:
+    from .cond_prefix_cache import CondPrefix
+
+
+class StaticKVCache(Cache):
+    """
+    Pre-allocated KV-cache, updated in place. Unlike HF's `DynamicCache` it never re-allocates (no `torch.cat` per
+    token), and unlike HF's `StaticCache` it hands out views over the filled part only, so attention cost and masking
+    are exactly those of a dynamic cache (SDPA `is_causal` for prefill, no mask for single-token steps).
+
+    Buffers are (B, n_kv_heads, max_len, head_dim) per layer; `reset()` makes the cache reusable for the next request
+    (see `KVCachePool`).
+    """
+
+    def __init__(
+        self,
+        *,
+        num_layers: int,
+        batch_size: int,
+        num_heads: int,
+        head_dim: int,
+        max_len: int,
+        dtype: torch.dtype,
+        device: torch.device,
+    ):
+        super().__init__()
+        self.batch_size = batch_size
+        self.max_len = max_len
+        shape = (batch_size, num_heads, max_len, head_dim)
+        self.key_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.value_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.seen = [0] * num_layers
+        # full-batch buffers, see `select_rows` (not `_buffers`: HF `Cache` is an `nn.Module`)
+        self._full_key_cache, self._full_value_cache = list(self.key_cache), list(self.value_cache)
+
+    @classmethod
+    def for_model(cls, config, *, batch_size: int, max_len: int, dtype: torch.dtype, device: torch.device):
+        "Size the buffers from a `LlamaConfig` or `GPT2Config`."
+        num_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        return cls(
+            num_layers=config.num_hidden_layers,
+            batch_size=batch_size,
+            num_heads=num_heads,
+            head_dim=head_dim,
+            max_len=max_len,
+            dtype=dtype,
+            device=device,
+        )
+
+    def __len__(self):
+        "number of populated layers (0 for a fresh cache), like `DynamicCache`"
+        return sum(s > 0 for s in self.seen)
+
+    def update(
+        self,
+        key_states: Tensor,
+        value_states: Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[Tensor, Tensor]:
+        start = self.seen[layer_idx]
+        end = start + key_states.size(2)
+        assert end <= self.max_len, f"StaticKVCache overflow ({end} > {self.max_len})"
+        self.key_cache[layer_idx][:, :, start:end].copy_(key_states)
+        self.value_cache[layer_idx][:, :, start:end].copy_(value_states)
+        self.seen[layer_idx] = end
+        return self.key_cache[layer_idx][:, :, :end], self.value_cache[layer_idx][:, :, :end]
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self.seen[layer_idx or 0]
+
+    def get_max_length(self) -> Optional[int]:
+        # NOTE: reported as unbounded so HF treats this like a dynamic cache (masks sized by the filled length)
+        return None
+
+    def get_max_cache_shape(self) -> Optional[int]:
+        return None
+
+    def load_prefix(self, prefix: 'CondPrefix'):
+        "Start from a cached conditioning prefix (broadcast to every row) instead of an empty cache."
+        L = prefix.len_cond
+        for layer_idx, (k, v) in enumerate(zip(prefix.keys, prefix.values)):
+            self.key_cache[layer_idx][:, :, :L].copy_(k)
+            self.value_cache[layer_idx][:, :, :L].copy_(v)
+        self.seen = [L] * len(self.seen)
+        return self
+
+    def crop(self, max_length: int):
+        "Drop everything after the first `max_length` positions (contents are simply overwritten later)."
+        self.seen = [min(s, max_length) for s in self.seen]
+
+    def select_rows(self, n: int):
+        "Use only the first `n` rows (eg drop the CFG uncond row), as views over the same buffers, until `reset`."
+        self.key_cache = [k[:n] for k in self._full_key_cache]
+        self.value_cache = [v[:n] for v in self._full_value_cache]
+        self.batch_size = n
+        return self
+
+    def write_rows(self, rows: Tensor, past: Cache, end: int):
+        """
+        Copy the filled part of another cache (eg a prefill `DynamicCache`) into `rows` (an index tensor),
+        right-aligned to end at position `end`. The filled length grows to `end` if it was shorter.
+        """
+        n = past.get_seq_length()
+        for k, v, k_new, v_new in zip(self._full_key_cache, self._full_value_cache, past.key_cache, past.value_cache):
+            k[rows, :, end - n:end] = k_new[:, :, :n]
+            v[rows, :, end - n:end] = v_new[:, :, :n]
+        self.seen = [max(s, end) for s in self.seen]
+
+    def move(self, start: int, end: int, to: int):
+        "Move positions [start, end) of every row to [to, to + end - start), which becomes the filled length."
+        n = end - start
+        assert to + n <= self.max_len, f"StaticKVCache overflow ({to + n} > {self.max_len})"
+        for k, v in zip(self._full_key_cache, self._full_value_cache):
+            k[:, :, to:to + n] = k[:, :, start:end].clone()
+            v[:, :, to:to + n] = v[:, :, start:end].clone()
+        self.seen = [to + n] * len(self.seen)
+
+    def reset(self):
+        self.seen = [0] * len(self.seen)
+        self.key_cache, self.value_cache = list(self._full_key_cache), list(self._full_value_cache)
+        self.batch_size = self.key_cache[0].size(0)
+
+
+class KVCachePool:
+    """
+    Reuses `StaticKVCache` buffers across requests. Lengths are rounded up to a multiple of `bucket_size`, so
+    requests of similar length share buffers and device memory stays predictable. Caches that are never released
+    (eg when generation raises) are simply garbage collected.
+    """
+
+    def __init__(self, config, bucket_size: int = 256, max_free: int = 4):
+        self.config = config
+        self.bucket_size = bucket_size
+        self.max_free = max_free
+        self._free = OrderedDict()  # id -> (key, cache), oldest first
+        self._lock = threading.Lock()
+
+    def _bucket(self, max_len: int):
+        return -(-max_len // self.bucket_size) * self.bucket_size
+
+    def acquire(self, *, batch_size: int, max_len: int, dtype: torch.dtype, device) -> StaticKVCache:
+        key = (batch_size, self._bucket(max_len), dtype, torch.device(device))
+        with self._lock:
+            for cache_id, (cache_key, cache) in self._free.items():
+                if cache_key == key:
+                    del self._free[cache_id]
+                    cache.reset()
+                    return cache
+        cache = StaticKVCache.for_model(
+            self.config,
+            batch_size=batch_size,
+            max_len=key[1],
+            dtype=dtype,
+            device=device,
+        )
+        cache.pool_key = key
+        return cache
+
+    def release(self, cache: StaticKVCache):
+        with self._lock:
+            self._free[id(cache)] = (cache.pool_key, cache)
+            while len(self._free) > self.max_free:
+                self._free.popitem(last=False)
+
+    @contextmanager
+    def borrow(self, **kwargs):
+        cache = self.acquire(**kwargs)
+        try:
+            yield cache
+        finally:
+            self.release(cache)
+
+
+def gpt2_forward(
+    gpt2: GPT2Model,
+    inputs_embeds: Tensor,
+    past_key_values: StaticKVCache,
+    attention_spies: Optional[Dict[int, Callable[[Tensor], None]]] = None,
+):
+    """
+    `GPT2Model.forward` (eval mode, absolute position embeddings included) over a `StaticKVCache`. The HF GPT-2
+    implementation only supports legacy tuple caches, which are grown by concatenation.
+
+    `attention_spies` maps layer indices to callbacks that receive the attention probabilities of that layer,
+    (B, n_heads, S, past + S); they are computed explicitly for these layers only (eg for `AlignmentStreamAnalyzer`),
+    the other layers keep their SDPA kernels.
+
+    Returns the final hidden states, (B, S, dim).
+    """
+    B, S, _ = inputs_embeds.shape
+    past_len = past_key_values.get_seq_length()
+    positions = torch.arange(past_len, past_len + S, device=inputs_embeds.device)
+    hidden_states = inputs_embeds + gpt2.wpe(positions)[None]
+
+    attn_mask = None
+    if S > 1 and past_len > 0:
+        k_pos = torch.arange(past_len + S, device=inputs_embeds.device)
+        attn_mask = k_pos[None] <= positions[:, None]  # (S, past + S), True = attend
+
+    for layer_idx, block in enumerate(gpt2.h):
+        attn = block.attn
+        residual = hidden_states
+        hidden_states = block.ln_1(hidden_states)
+        q, k, v = attn.c_attn(hidden_states).split(attn.split_size, dim=2)
+        q, k, v = (x.view(B, S, attn.num_heads, attn.head_dim).transpose(1, 2) for x in (q, k, v))
+        k, v = past_key_values.update(k, v, layer_idx)
+        if attention_spies and layer_idx in attention_spies:
+            scores = (q @ k.transpose(-1, -2)).float() / math.sqrt(attn.head_dim)
+            if S > 1:
+                k_pos = torch.arange(past_len + S, device=inputs_embeds.device)
+                scores = scores.masked_fill(k_pos[None] > positions[:, None], -float("inf"))
+            attn_weights = torch.softmax(scores, dim=-1).to(q.dtype)
+            attention_spies[layer_idx](attn_weights)
+            attn_out = attn_weights @ v
+        else:
+            attn_out = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=attn_mask, is_causal=(S > 1 and past_len == 0)
+            )
+        attn_out = attn_out.transpose(1, 2).reshape(B, S, attn.embed_dim)
+        hidden_states = residual + attn.c_proj(attn_out)
+
+        residual = hidden_states
+        hidden_states = residual + block.mlp(block.ln_2(hidden_states))
+
+    return gpt2.ln_f(hidden_states)
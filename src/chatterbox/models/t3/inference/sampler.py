@@ -0,0 +1,165 @@
+from typing import Optional, Sequence, Union
+
+import torch
+from torch import Tensor
+
+
+Param = Union[float, int, Sequence[float], Tensor]
+
+
+def _per_row(x: Param, batch_size: int, device, dtype=torch.float32):
+    x = torch.as_tensor(x, dtype=dtype, device=device).reshape(-1)
+    return x.expand(batch_size).clone() if x.numel() == 1 else x
+
+
+class SpeechTokenSampler:
+    """
+    Batched, on-device replacement for the HF logits-processor chain used in T3 decoding. One call applies, per row:
+
+        CFG -> repetition penalty -> temperature -> top-k -> min-p -> top-p -> multinomial draw
+
+    which is the order `T3.inference` has always used. With `penalty_last` (Turbo, ie `T3.inference_turbo`) the
+    repetition penalty is applied after the filters instead, as Turbo has always done:
+
+        temperature -> top-k -> min-p -> top-p -> repetition penalty -> multinomial draw
+
+    All filtering works on a single descending sort of the vocab, and tokens seen so far are tracked in a preallocated (B, V) mask instead of
+    re-concatenating the generated ids every step. Every parameter can be a scalar or a per-row sequence.
+
+    Rows can be re-combined with `cat` / `select`, eg when requests join or leave a decode batch.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        vocab_size: int,
+        *,
+        temperature: Param = 1.0,
+        top_k: Param = 0,
+        top_p: Param = 1.0,
+        min_p: Param = 0.0,
+        repetition_penalty: Param = 1.0,
+        cfg_weight: Param = 0.0,
+        penalty_last: bool = False,
+        device=None,
+    ):
+        self.batch_size = batch_size
+        self.vocab_size = vocab_size
+        self.penalty_last = penalty_last
+        self.temperature = _per_row(temperature, batch_size, device)
+        self.top_k = _per_row(top_k, batch_size, device, dtype=torch.long)
+        self.top_p = _per_row(top_p, batch_size, device)
+        self.min_p = _per_row(min_p, batch_size, device)
+        self.repetition_penalty = _per_row(repetition_penalty, batch_size, device)
+        self.cfg_weight = _per_row(cfg_weight, batch_size, device)
+        self.seen = torch.zeros(batch_size, vocab_size, dtype=torch.bool, device=device)
+        self._update_flags()
+
+    def _update_flags(self):
+        # resolved once on the host, so `__call__` can skip unused stages without syncing
+        self.use_repetition_penalty = bool((self.repetition_penalty != 1.0).any())
+        self.use_temperature = bool((self.temperature != 1.0).any())
+        self.use_top_k = bool(((self.top_k > 0) & (self.top_k < self.vocab_size)).any())
+        self.use_min_p = bool((self.min_p > 0.0).any())
+        self.use_top_p = bool((self.top_p < 1.0).any())
+
+    def update(self, tokens: Tensor):
+        "Mark sampled (or prompt) tokens, (B,) or (B, n), as seen for the repetition penalty."
+        self.seen.scatter_(1, tokens.view(self.batch_size, -1), True)
+
+    def apply_cfg(self, cond: Tensor, uncond: Optional[Tensor]):
+        if uncond is None:
+            return cond
+        cfg = self.cfg_weight.to(cond.dtype)[:, None]
+        return cond + cfg * (cond - uncond)
+
+    def _penalize(self, logits: Tensor, seen: Tensor):
+        penalty = self.repetition_penalty[:, None]
+        penalized = torch.where(logits < 0, logits * penalty, logits / penalty)
+        return torch.where(seen, penalized, logits)
+
+    def _filter(self, logits: Tensor, uncond_logits: Optional[Tensor], seen: Tensor):
+        """
+        Every stage before the draw. Returns the final logits, sorted in descending order together with the sorting
+        indices when any of the top-k / min-p / top-p filters is used, else in vocab order (and None).
+        """
+        logits = self.apply_cfg(logits, uncond_logits).float()
+
+        if self.use_repetition_penalty and not self.penalty_last:
+            logits = self._penalize(logits, seen)
+
+        if self.use_temperature:
+            logits = logits / self.temperature[:, None]
+
+        if not (self.use_top_k or self.use_min_p or self.use_top_p):
+            if self.use_repetition_penalty and self.penalty_last:
+                logits = self._penalize(logits, seen)
+            return logits, None
+
+        sorted_logits, sorted_idx = torch.sort(logits, dim=-1, descending=True)
+        if self.use_top_k:
+            rank = torch.arange(self.vocab_size, device=logits.device)[None]
+            top_k = torch.where(self.top_k > 0, self.top_k, self.vocab_size)[:, None]
+            sorted_logits = sorted_logits.masked_fill(rank >= top_k, -float("inf"))
+        if self.use_min_p:
+            probs = torch.softmax(sorted_logits, dim=-1)
+            remove = probs < self.min_p[:, None] * probs[:, :1]
+            sorted_logits = sorted_logits.masked_fill(remove, -float("inf"))
+        if self.use_top_p:
+            # drop a token once the (renormalised) mass of strictly more likely tokens reaches top_p
+            probs = torch.softmax(sorted_logits, dim=-1)
+            mass_before = torch.cumsum(probs, dim=-1) - probs
+            remove = mass_before >= self.top_p[:, None]
+            remove[:, 0] = False
+            sorted_logits = sorted_logits.masked_fill(remove, -float("inf"))
+        if self.use_repetition_penalty and self.penalty_last:
+            # (filtered tokens stay at -inf; the penalized ones may end up out of order, which the draw doesn't mind)
+            sorted_logits = self._penalize(sorted_logits, seen.gather(1, sorted_idx))
+        return sorted_logits, sorted_idx
+
+    def __call__(self, logits: Tensor, uncond_logits: Optional[Tensor] = None, update: bool = True):
+        """
+        :param logits: (B, V) conditional logits, or already CFG-combined logits if `uncond_logits` is None.
+        :param uncond_logits: optional (B, V) unconditional logits for CFG.
+        :param update: mark the sampled tokens as seen.
+        :return: (B, 1) sampled token ids.
+        """
+        logits, sorted_idx = self._filter(logits, uncond_logits, self.seen)
+        next_tokens = torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1)
+        if sorted_idx is not None:
+            next_tokens = sorted_idx.gather(1, next_tokens)
+
+        if update:
+            self.update(next_tokens)
+        return next_tokens
+
+    def probs(self, logits: Tensor, uncond_logits: Optional[Tensor] = None, seen: Optional[Tensor] = None):
+        """
+        The distribution `__call__` draws from, (B, V) in vocab order. `seen` overrides the tokens seen so far (for
+        the repetition penalty), eg to score several positions ahead (see `speculative.verify_draft`).
+        """
+        logits, sorted_idx = self._filter(logits, uncond_logits, self.seen if seen is None else seen)
+        probs = torch.softmax(logits, dim=-1)
+        if sorted_idx is not None:
+            probs = torch.zeros_like(probs).scatter_(1, sorted_idx, probs)
+        return probs
+
+    def select(self, rows: Tensor):
+        "Keep only `rows` (an index tensor)."
+        for name in ("temperature", "top_k", "top_p", "min_p", "repetition_penalty", "cfg_weight", "seen"):
+            setattr(self, name, getattr(self, name)[rows])
+        self.batch_size = self.seen.size(0)
+        self._update_flags()
+        return self
+
+    @classmethod
+    def cat(cls, samplers: Sequence['SpeechTokenSampler']):
+        assert len({s.penalty_last for s in samplers}) == 1, "can't combine samplers with different stage orders"
+        out = cls.__new__(cls)
+        out.vocab_size = samplers[0].vocab_size
+        out.penalty_last = samplers[0].penalty_last
+        for name in ("temperature", "top_k", "top_p", "min_p", "repetition_penalty", "cfg_weight", "seen"):
+            setattr(out, name, torch.cat([getattr(s, name) for s in samplers]))
+        out.batch_size = out.seen.size(0)
+        out._update_flags()
+        return out
@@ -0,0 +1,83 @@
+from typing import List, Optional, Sequence
+
+import torch
+from torch import Tensor
+
+from .sampler import SpeechTokenSampler
+
+
+class PromptLookupDrafter:
+    """
+    Drafts speech tokens for speculative decoding (see `T3.inference`) without a second model: the last
+    `max_ngram`..`min_ngram` tokens are looked up in the history (the conditioning prompt tokens followed by the
+    tokens generated so far), and the `num_draft_tokens` tokens that followed the most recent earlier match are
+    proposed. Speech has a lot of locally repeated structure (silences, sustained sounds), which is what this picks up.
+
+    Drafters only need a `propose(history) -> List[int]` method. Their proposals are treated as deterministic, which
+    is what keeps `verify_draft` exact; any drafter that is a function of the history (eg greedy decoding with a
+    smaller model) fits.
+    """
+
+    def __init__(self, num_draft_tokens: int = 4, max_ngram: int = 3, min_ngram: int = 1):
+        assert 1 <= min_ngram <= max_ngram
+        self.num_draft_tokens = num_draft_tokens
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def propose(self, history: Sequence[int]) -> List[int]:
+        for n in range(self.max_ngram, self.min_ngram - 1, -1):
+            if len(history) <= n:
+                continue
+            tail = list(history[-n:])
+            for start in range(len(history) - n - 1, -1, -1):
+                if history[start] == tail[0] and list(history[start:start + n]) == tail:
+                    return list(history[start + n:start + n + self.num_draft_tokens])
+        return []
+
+
+@torch.inference_mode()
+def verify_draft(
+    sampler: SpeechTokenSampler,
+    logits: Tensor,
+    uncond_logits: Optional[Tensor],
+    draft: Sequence[int],
+) -> List[int]:
+    """
+    Speculative sampling acceptance test for a deterministic draft, for a single-row `sampler`.
+
+    `logits` (and `uncond_logits` for CFG) are the (len(draft) + 1, V) target logits after the last accepted token
+    and after each draft token. Draft token `d` is accepted with probability p(d) under the sampler's distribution
+    (repetition penalty included, with the earlier draft tokens counted as seen); on the first rejection a token is
+    drawn from p with `d` removed, and if every draft token is accepted one more token is drawn from the last
+    position. Every emitted token is thereby distributed exactly as with one-token-at-a-time sampling.
+
+    Returns the 1 to len(draft) + 1 emitted tokens, which are also marked as seen in `sampler`.
+    """
+    assert sampler.batch_size == 1
+    seen = sampler.seen.clone()
+    out = []
+    for j in range(len(draft) + 1):
+        p = sampler.probs(
+            logits[j:j + 1],
+            None if uncond_logits is None else uncond_logits[j:j + 1],
+            seen=seen,
+        )[0]  # (V,)
+        if j == len(draft):
+            out.append(int(torch.multinomial(p, num_samples=1)))
+            break
+
+        d = draft[j]
+        if torch.rand((), device=p.device) < p[d]:
+            out.append(d)
+            seen[0, d] = True
+            continue
+
+        residual = p.clone()
+        residual[d] = 0.0
+        if residual.sum() <= 0:  # p(d) == 1 up to rounding
+            residual = p
+        out.append(int(torch.multinomial(residual, num_samples=1)))
+        break
+
+    sampler.update(torch.tensor(out, device=sampler.seen.device))
+    return out
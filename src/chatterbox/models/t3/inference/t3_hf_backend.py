@@ -74,35 +74,46 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         self,
         inputs_embeds: torch.Tensor,
         past_key_values: Optional[torch.Tensor]=None,
+        attention_mask: Optional[torch.Tensor]=None,
+        position_ids: Optional[torch.Tensor]=None,
         use_cache=True,
         output_attentions=False,
         output_hidden_states=True,
         return_dict=True,
+        num_logits_to_keep: int=0,
     ):
         """
         This is a method used by huggingface's generate() method.
         Overridden here to apply our custom layer norm and speech logit projection layers.
 
-        :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given,
-        S should be 1.
+        :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs.
+        :param attention_mask: optional (B, past + S) padding mask, needed when rows of different lengths share a
+        batch (see `T3BatchScheduler`).
+        :param position_ids: optional (B, S) positions, needed together with a left-padded `attention_mask`.
+        :param num_logits_to_keep: only project the last `num_logits_to_keep` positions through `speech_head`
+        (0 = all). Decoding only ever needs the last one.
+
+        NOTE: for decoding, pass `output_attentions=False, output_hidden_states=False, num_logits_to_keep=1`. All
+        layers then keep their SDPA kernels (the alignment analyzer, if any, switches its own layers to eager
+        attention through hooks) and only the KV-cache and last-position logits are returned.
         """
-        is_large_input = inputs_embeds.size(1) != 1
-        has_cache = past_key_values is not None and len(past_key_values) > 0
-        assert not (is_large_input and has_cache)
+        # NOTE: multi-token inputs on top of a non-empty cache are fine, eg prefilling text after a cached
+        # conditioning prefix (see `T3.get_cond_prefix`)
         assert return_dict
-        assert output_hidden_states
 
         tfmr_out = self.model(
             inputs_embeds=inputs_embeds,
             past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
             use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=True,
         )
-        hidden_states = tfmr_out.hidden_states[-1]  # (B, seq, dim)
+        hidden_states = tfmr_out.last_hidden_state  # (B, seq, dim)
 
-        logits = self.speech_head(hidden_states)
+        logits = self.speech_head(hidden_states[:, -num_logits_to_keep:, :])
         # assert inputs_embeds.size(0) == 1 # (disabled for CFG)
 
         # NOTE: hallucination handler may modify logits to force emit an EOS token
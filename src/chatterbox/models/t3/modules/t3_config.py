@@ -12,6 +12,14 @@ class T3Config:
         self.stop_speech_token = 6562
         self.speech_tokens_dict_size = 8194
         self.max_speech_tokens = 4096
+        # Per-request cap on generated speech tokens, from the text length (see `T3.speech_token_budget`): a
+        # generous bound for slow speech (~1.7 speech tokens per character at a normal pace), plus a floor
+        self.speech_tokens_per_text_token = 6.0
+        self.min_speech_token_budget = 75  # 3s
+
+        # (layer, head) pairs used for alignment analysis (see `AlignmentStreamAnalyzer`); None = the heads known
+        # for the model (multilingual), or no analysis
+        self.alignment_heads = None
 
         self.llama_config_name = "Llama_520M"
         self.input_pos_emb = "learned"
@@ -38,4 +46,6 @@ class T3Config:
     @classmethod 
     def multilingual(cls):
         """Create configuration for multilingual TTS model."""
-        return cls(text_tokens_dict_size=2454)
+        config = cls(text_tokens_dict_size=2454)
+        config.speech_tokens_per_text_token = 10.0  # (CJK characters take several speech tokens each)
+        return config
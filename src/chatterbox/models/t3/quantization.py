@@ -0,0 +1,225 @@
+"""
+Int8 T3 for CPU serving: the linear layers of the backbone, the cond encoder and the heads, and the text / speech
+embeddings, are stored as int8 with one scale per output channel (per row for embeddings).
+
+Quantized models are plain state dicts of int8 tensors and scales, so they are saved to (and loaded directly from)
+safetensors, see `save_quantized_t3` / `load_quantized_t3`. Use `compare_token_distributions` to check a quantized
+model against the fp32 one.
+"""
+import dataclasses
+import logging
+from pathlib import Path
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+from torch import nn, Tensor
+from transformers.pytorch_utils import Conv1D
+
+from .modules.cond_enc import T3Cond
+
+
+logger = logging.getLogger(__name__)
+
+
+# "dynamic": int8 x int8 matmuls (fbgemm), activations are quantized on the fly per token; CPU and float32 only, and
+#   falls back to "weight_only" elsewhere
+# "weight_only": weights are dequantized per call, which only saves memory
+QUANTIZATION_MODES = ("dynamic", "weight_only")
+
+
+def _quantize_rows(weight: Tensor):
+    "Symmetric int8 quantization with a float32 scale per row."
+    weight = weight.detach().float()
+    scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+    return torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8), scale
+
+
+class Int8Linear(nn.Module):
+    "`nn.Linear` with int8 weights, see `QUANTIZATION_MODES`."
+
+    def __init__(self, in_features, out_features, bias=True, mode="dynamic"):
+        super().__init__()
+        assert mode in QUANTIZATION_MODES, f"unknown quantization mode {mode}"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.mode = mode
+        self.register_buffer("weight_int8", torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("weight_scale", torch.ones(out_features))
+        self.bias = nn.Parameter(torch.zeros(out_features), requires_grad=False) if bias else None
+        self._packed = None  # fbgemm weights for "dynamic", built on first use
+
+    @classmethod
+    def from_float(cls, linear: nn.Module, mode="dynamic"):
+        "From an `nn.Linear` (or a GPT-2 `Conv1D`, which stores the transposed weight)."
+        weight = linear.weight.t() if isinstance(linear, Conv1D) else linear.weight
+        out_features, in_features = weight.shape
+        module = cls(in_features, out_features, bias=linear.bias is not None, mode=mode).to(weight.device)
+        module.weight_int8, module.weight_scale = _quantize_rows(weight)
+        if linear.bias is not None:
+            module.bias.data = linear.bias.detach().float().clone()
+        return module
+
+    def dequantize(self, dtype=torch.float32):
+        return self.weight_int8.to(dtype) * self.weight_scale[:, None].to(dtype)
+
+    def _apply(self, fn, *args, **kwargs):
+        self._packed = None  # moved or cast
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._packed = None
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    def forward(self, x: Tensor):
+        if self.mode == "dynamic" and x.device.type == "cpu" and x.dtype == torch.float32:
+            if self._packed is None:
+                weight = torch._make_per_channel_quantized_tensor(
+                    self.weight_int8.cpu(),
+                    self.weight_scale.double().cpu(),
+                    torch.zeros(self.out_features, dtype=torch.long),
+                    0,
+                )
+                bias = None if self.bias is None else self.bias.float()
+                self._packed = torch.ops.quantized.linear_prepack(weight, bias)
+            # (reduce_range: 7-bit activations, which fbgemm's x86 kernels need to avoid saturation)
+            return torch.ops.quantized.linear_dynamic(x, self._packed, True)
+        bias = None if self.bias is None else self.bias.to(x.dtype)
+        return F.linear(x, self.dequantize(x.dtype), bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, mode={self.mode}"
+
+
+class Int8Embedding(nn.Module):
+    "`nn.Embedding` with int8 rows."
+
+    def __init__(self, num_embeddings, embedding_dim):
+        super().__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.register_buffer("weight_int8", torch.zeros(num_embeddings, embedding_dim, dtype=torch.int8))
+        self.register_buffer("weight_scale", torch.ones(num_embeddings))
+
+    @classmethod
+    def from_float(cls, embedding: nn.Embedding):
+        module = cls(embedding.num_embeddings, embedding.embedding_dim).to(embedding.weight.device)
+        module.weight_int8, module.weight_scale = _quantize_rows(embedding.weight)
+        return module
+
+    def forward(self, idx: Tensor):
+        return F.embedding(idx, self.weight_int8).to(self.weight_scale.dtype) * self.weight_scale[idx].unsqueeze(-1)
+
+    def extra_repr(self):
+        return f"{self.num_embeddings}, {self.embedding_dim}"
+
+
+def _convert(t3, mode, from_float=True):
+    "Swap the quantized layers of `t3` in place, either quantizing their weights or as empty modules to load into."
+    def linear(module):
+        if from_float:
+            return Int8Linear.from_float(module, mode=mode)
+        if isinstance(module, Conv1D):
+            in_features, out_features = module.weight.shape
+        else:
+            out_features, in_features = module.weight.shape
+        return Int8Linear(in_features, out_features, bias=module.bias is not None, mode=mode)
+
+    def embedding(module):
+        if from_float:
+            return Int8Embedding.from_float(module)
+        return Int8Embedding(module.num_embeddings, module.embedding_dim)
+
+    # Backbone and cond encoder: all their linear layers (the backbone's own token embeddings aren't used by T3)
+    for root in (t3.tfmr, t3.cond_enc):
+        for name, module in list(root.named_modules()):
+            if isinstance(module, (nn.Linear, Conv1D)):
+                parent_name, _, attr = name.rpartition(".")
+                setattr(root.get_submodule(parent_name), attr, linear(module))
+
+    t3.speech_head = linear(t3.speech_head)
+    t3.text_head = linear(t3.text_head)
+    t3.speech_emb = embedding(t3.speech_emb)
+    t3.text_emb = embedding(t3.text_emb)
+
+    # State that holds on to the replaced modules or was computed with the float weights
+    t3.__dict__["patched_model"] = None
+    t3.cond_prefix_cache.clear()
+    t3.quantization = mode
+    return t3
+
+
+@torch.no_grad()
+def quantize_t3(t3, mode="dynamic"):
+    """
+    Quantizes a float `T3` (Llama or GPT-2 backbone) to int8 in place, see `QUANTIZATION_MODES`, and returns it.
+
+    NOTE: `T3Cond.cond_prompt_speech_emb` is computed once per conditionals object with the model's speech embedding;
+    conditionals prepared with the float model keep their float embeddings.
+    """
+    assert mode in QUANTIZATION_MODES, f"unknown quantization mode {mode}"
+    assert getattr(t3, "quantization", None) is None, "already quantized"
+    return _convert(t3, mode, from_float=True)
+
+
+def save_quantized_t3(t3, fpath):
+    "Saves a model quantized with `quantize_t3` to a safetensors file, for `load_quantized_t3`."
+    assert getattr(t3, "quantization", None) is not None, "not a quantized T3"
+    state = {k: v.contiguous() for k, v in t3.state_dict().items()}
+    save_file(state, str(fpath), metadata={"quantization": "int8", "mode": t3.quantization})
+
+
+def load_quantized_t3(t3, fpath, mode: Optional[str] = None):
+    """
+    Loads a `save_quantized_t3` file into a freshly constructed (float) `T3` with the same config, without
+    quantizing anything. `mode` overrides the mode the file was saved with.
+    """
+    fpath = Path(fpath)
+    with safe_open(str(fpath), framework="pt") as f:
+        metadata = f.metadata() or {}
+    assert metadata.get("quantization") == "int8", f"{fpath} is not a quantized T3"
+    _convert(t3, mode or metadata["mode"], from_float=False)
+    t3.load_state_dict(load_file(fpath))
+    return t3
+
+
+def _teacher_forced_speech_logits(t3, t3_cond: T3Cond, text_tokens: Tensor, speech_tokens: Tensor):
+    "(B, T + 1, V) speech logits after BOS and after each of the T `speech_tokens`."
+    text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=t3.device)
+    speech_tokens = torch.atleast_2d(speech_tokens).to(dtype=torch.long, device=t3.device)
+    bos = t3.hp.start_speech_token * torch.ones_like(speech_tokens[:, :1])
+    embeds, len_cond = t3.prepare_input_embeds(
+        # (a copy: the prompt embedding is cached on the conditionals, and must come from this model)
+        t3_cond=dataclasses.replace(t3_cond, cond_prompt_speech_emb=None),
+        text_tokens=text_tokens,
+        speech_tokens=torch.cat([bos, speech_tokens], dim=1),
+    )
+    hidden_states = t3.tfmr(inputs_embeds=embeds, return_dict=True).last_hidden_state
+    return t3.speech_head(hidden_states[:, len_cond + text_tokens.size(1):]).float()
+
+
+@torch.inference_mode()
+def compare_token_distributions(reference, quantized, t3_cond: T3Cond, text_tokens: Tensor, speech_tokens: Tensor):
+    """
+    Parity check of a quantized T3 against its float `reference`: both models are run teacher-forced on the same
+    text and speech tokens (eg generated by the reference), and their next-speech-token distributions are compared
+    at every position.
+
+    Returns a dict with the mean and max KL divergence KL(reference || quantized), the mean total variation
+    distance, and how often both models agree on the most likely token.
+    """
+    ref_logits = _teacher_forced_speech_logits(reference, t3_cond, text_tokens, speech_tokens)
+    q_logits = _teacher_forced_speech_logits(quantized, t3_cond, text_tokens, speech_tokens)
+    ref_logp, q_logp = ref_logits.log_softmax(dim=-1), q_logits.log_softmax(dim=-1)
+    kl = (ref_logp.exp() * (ref_logp - q_logp)).sum(dim=-1)
+    tv = 0.5 * (ref_logp.exp() - q_logp.exp()).abs().sum(dim=-1)
+    stats = dict(
+        kl_mean=kl.mean().item(),
+        kl_max=kl.max().item(),
+        tv_mean=tv.mean().item(),
+        top1_agreement=(ref_logits.argmax(dim=-1) == q_logits.argmax(dim=-1)).float().mean().item(),
+    )
+    logger.info(f"int8 T3 parity: {stats}")
+    return stats
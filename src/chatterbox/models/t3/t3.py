@@ -1,6 +1,8 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
+import dataclasses
 import logging
+import math
 from typing import Union, Optional, List
 
 logger = logging.getLogger(__name__)
@@ -10,21 +12,17 @@ import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
 from transformers import LlamaModel, LlamaConfig, GPT2Config, GPT2Model
-from transformers.generation.logits_process import (
-    LogitsProcessorList,
-    RepetitionPenaltyLogitsProcessor,
-    TemperatureLogitsWarper,
-    TopKLogitsWarper,
-    TopPLogitsWarper,
-    MinPLogitsWarper,
-)
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
 from .modules.cond_enc import T3CondEnc, T3Cond
 from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
-from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer, LLAMA_ALIGNED_HEADS
+from .inference.kv_cache import KVCachePool, StaticKVCache, gpt2_forward
+from .inference.cond_prefix_cache import CondPrefix, CondPrefixCache
+from .inference.sampler import SpeechTokenSampler
+from .inference.speculative import verify_draft
 from ..utils import AttrDict
 
 
@@ -84,11 +82,46 @@ class T3(nn.Module):
         # logit projection
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=self.is_gpt)
-        self.compiled = False
+        self.patched_model = None  # see `backend`
+        self.quantization = None  # int8 mode, see `quantization.quantize_t3`
+
+        # pre-allocated KV-caches, reused across `inference` / `inference_turbo` calls
+        self.kv_cache_pool = KVCachePool(self.cfg)
+        # transformer KV state of recently used conditioning prefixes (see `get_cond_prefix`)
+        self.cond_prefix_cache = CondPrefixCache()
 
     @property
     def device(self):
-        return self.speech_head.weight.device
+        return self.tfmr.device  # (the heads may be quantized, see `quantization.quantize_t3`)
+
+    @property
+    def alignment_heads(self):
+        "(layer, head) pairs for `AlignmentStreamAnalyzer`, or None when the model's aligned heads aren't known"
+        if self.hp.alignment_heads is not None:
+            return self.hp.alignment_heads
+        return LLAMA_ALIGNED_HEADS if self.hp.is_multilingual else None
+
+    def speech_token_budget(self, text_tokens: Tensor) -> int:
+        "Upper bound on the speech tokens a request can need, from its number of text tokens (see `T3Config`)"
+        n_text = text_tokens.size(-1)
+        return max(self.hp.min_speech_token_budget, math.ceil(self.hp.speech_tokens_per_text_token * n_text))
+
+    @property
+    def backend(self) -> T3HuggingfaceBackend:
+        """
+        HF-style wrapper around `tfmr` with the speech embedding and head, used for decoding. It holds no request
+        state, so it is built once and shared by all requests (and `T3BatchScheduler`).
+        """
+        if self.patched_model is None:
+            # (not registered as a submodule: it only wraps modules of this T3, which would then show up twice in
+            # `state_dict()`)
+            self.__dict__["patched_model"] = T3HuggingfaceBackend(
+                config=self.cfg,
+                llama=self.tfmr,
+                speech_enc=self.speech_emb,
+                speech_head=self.speech_head,
+            )
+        return self.patched_model
 
     def prepare_conditioning(self, t3_cond: T3Cond):
         """
@@ -98,18 +131,25 @@ class T3(nn.Module):
             t3_cond.cond_prompt_speech_emb = self.speech_emb(t3_cond.cond_prompt_speech_tokens)
             if not self.is_gpt:
                 t3_cond.cond_prompt_speech_emb += self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens)
+
+        # Conditionals are prepared in fp32, the model may run in reduced precision (see `utils.apply_precision`)
+        dtype = self.tfmr.dtype
+        casts = {
+            k: v.to(dtype) for k, v in vars(t3_cond).items()
+            if torch.is_tensor(v) and v.is_floating_point() and v.dtype != dtype
+        }
+        if casts:
+            t3_cond = dataclasses.replace(t3_cond, **casts)
         return self.cond_enc(t3_cond)  # (B, len_cond, dim)
 
-    def prepare_input_embeds(
+    def prepare_text_speech_embeds(
         self,
         *,
-        t3_cond: T3Cond,
         text_tokens: torch.LongTensor,
         speech_tokens: torch.LongTensor,
         cfg_weight: float = 0.0,
     ):
-        # prepare input embeddings (skip backbone tranformer embeddings)
-        cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
+        "Text and speech token embeddings, without the conditioning prefix."
         text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
         if cfg_weight > 0.0 and not self.is_gpt:
             text_emb[1].zero_()  # CFG uncond
@@ -118,6 +158,23 @@ class T3(nn.Module):
         if self.hp.input_pos_emb == "learned":
             text_emb = text_emb + self.text_pos_emb(text_tokens)
             speech_emb = speech_emb + self.speech_pos_emb(speech_tokens)
+        return text_emb, speech_emb
+
+    def prepare_input_embeds(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: torch.LongTensor,
+        speech_tokens: torch.LongTensor,
+        cfg_weight: float = 0.0,
+    ):
+        # prepare input embeddings (skip backbone tranformer embeddings)
+        cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
+        text_emb, speech_emb = self.prepare_text_speech_embeds(
+            text_tokens=text_tokens,
+            speech_tokens=speech_tokens,
+            cfg_weight=cfg_weight,
+        )
         len_cond = cond_emb.size(1)
 
         if cond_emb.size(0) != text_emb.size(0):
@@ -130,6 +187,123 @@ class T3(nn.Module):
         ])  # (B, length, dim)
         return embeds, len_cond
 
+    def prepare_inference_embeds(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: torch.LongTensor,
+        initial_speech_tokens: Optional[Tensor] = None,
+        cfg_weight: float = 0.0,
+        include_cond: bool = True,
+    ):
+        """
+        Prefill inputs for speech token decoding: `[cond, text, BOS]` followed by one more BOS frame, which is the
+        layout `inference` has always used. Rows follow `text_tokens` (ie two rows when CFG is on).
+
+        With `include_cond=False` the conditioning prefix is left out (and `len_cond` is 0), for prefilling on top
+        of a cached `CondPrefix` (see `get_cond_prefix`).
+        """
+        text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
+        if initial_speech_tokens is None:
+            initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+        if include_cond:
+            embeds, len_cond = self.prepare_input_embeds(
+                t3_cond=t3_cond,
+                text_tokens=text_tokens,
+                speech_tokens=initial_speech_tokens,
+                cfg_weight=cfg_weight,
+            )
+        else:
+            text_emb, speech_emb = self.prepare_text_speech_embeds(
+                text_tokens=text_tokens,
+                speech_tokens=initial_speech_tokens,
+                cfg_weight=cfg_weight,
+            )
+            embeds, len_cond = torch.cat([text_emb, speech_emb], dim=1), 0
+        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=embeds.device)
+        bos_embed = self.speech_emb(bos_token) + self.speech_pos_emb.get_fixed_embedding(0)  # (1, 1, dim)
+        bos_embed = bos_embed.expand(embeds.size(0), -1, -1)
+        return torch.cat([embeds, bos_embed], dim=1), len_cond
+
+    @torch.inference_mode()
+    def get_cond_prefix(self, t3_cond: T3Cond) -> CondPrefix:
+        """
+        KV state of the conditioning prefix for `t3_cond`, computed once per voice / exaggeration and then served from
+        `cond_prefix_cache`, so requests only prefill their text tokens.
+        """
+        key = CondPrefixCache.key(t3_cond, self.is_gpt, str(self.device), self.tfmr.dtype)
+        prefix = self.cond_prefix_cache.get(key)
+        if prefix is None:
+            cond_emb = self.prepare_conditioning(t3_cond)  # (1, len_cond, dim)
+            assert cond_emb.size(0) == 1, "conditioning prefixes are cached for a single voice"
+            cache = StaticKVCache.for_model(
+                self.cfg,
+                batch_size=1,
+                max_len=cond_emb.size(1),
+                dtype=self.tfmr.dtype,
+                device=cond_emb.device,
+            )
+            if self.is_gpt:
+                gpt2_forward(self.tfmr, cond_emb, cache)
+            else:
+                self.tfmr(inputs_embeds=cond_emb, past_key_values=cache, use_cache=True)
+            prefix = CondPrefix(keys=cache.key_cache, values=cache.value_cache)
+            self.cond_prefix_cache.put(key, prefix)
+        return prefix
+
+    @torch.inference_mode()
+    def find_alignment_heads(self, t3_cond: T3Cond, text_tokens: Tensor, speech_tokens: Tensor, k=3):
+        """
+        Finds (layer, head) pairs whose attention implicitly aligns speech to text, for `T3Config.alignment_heads`.
+        The model is run teacher-forced on (ideally several sentences of) natural speech tokens for the text, eg
+        generated with `inference`, and each head is scored by the attention mass the speech frames put on the text
+        tokens, times the correlation between the frame index and the attended text position (ie how diagonal and
+        monotonic its alignment is).
+
+        Returns the `k` best heads, best first.
+        """
+        text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
+        speech_tokens = torch.atleast_2d(speech_tokens).to(dtype=torch.long, device=self.device)
+        embeds, len_cond = self.prepare_input_embeds(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            speech_tokens=speech_tokens,
+        )
+
+        # Attention maps of all layers, (B, H, L, L) each
+        if self.is_gpt:
+            attentions = [None] * self.cfg.n_layer
+
+            def spy(layer_idx):
+                def store(attn_weights):
+                    attentions[layer_idx] = attn_weights
+                return store
+
+            spies = {layer_idx: spy(layer_idx) for layer_idx in range(self.cfg.n_layer)}
+            cache = StaticKVCache.for_model(
+                self.cfg, batch_size=embeds.size(0), max_len=embeds.size(1), dtype=self.tfmr.dtype, device=self.device
+            )
+            gpt2_forward(self.tfmr, embeds, cache, attention_spies=spies)
+        else:
+            attentions = self.tfmr(inputs_embeds=embeds, output_attentions=True, return_dict=True).attentions
+
+        i, j = len_cond, len_cond + text_tokens.size(-1)
+        scores = {}
+        for layer_idx, attn in enumerate(attentions):
+            A = attn[:, :, j:, i:j].float()  # (B, H, T, S): speech frames attending to the text
+            mass = A.sum(dim=-1).mean(dim=(0, 2))  # (H,)
+            text_pos = (A / A.sum(dim=-1, keepdim=True).clamp(min=1e-6)) @ torch.arange(
+                A.size(-1), dtype=A.dtype, device=A.device
+            )  # (B, H, T) expected text position of each frame
+            frame_idx = torch.arange(A.size(2), dtype=A.dtype, device=A.device)
+            text_pos = text_pos - text_pos.mean(dim=-1, keepdim=True)
+            frame_idx = frame_idx - frame_idx.mean()
+            corr = (text_pos * frame_idx).sum(-1) / (text_pos.norm(dim=-1) * frame_idx.norm()).clamp(min=1e-6)
+            for head_idx, score in enumerate((mass * corr.clamp(min=0).mean(dim=0)).tolist()):
+                scores[(layer_idx, head_idx)] = score
+
+        return sorted(scores, key=scores.get, reverse=True)[:k]
+
     def forward(
         self,
         *,
@@ -245,58 +419,104 @@ class T3(nn.Module):
         length_penalty=1.0,
         repetition_penalty=1.2,
         cfg_weight=0.5,
+        cfg_max_tokens: Optional[int]=None,
+        cfg_until_complete=False,
+        drafter=None,
+        use_token_budget=False,
     ):
         """
+        Args:
+            text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            cfg_max_tokens: only apply CFG to the first `cfg_max_tokens` tokens (None = all of them)
+            cfg_until_complete: only apply CFG until the alignment analyzer (see `alignment_heads`) reports that
+                the text has been fully spoken
+            drafter: speculative decoding with this drafter (eg a `PromptLookupDrafter`), see
+                `_speculative_decode`. Not used with the alignment analyzer, which checks one token at a time.
+            use_token_budget: also cap `max_new_tokens` by `speech_token_budget` of the text (off by default, as
+                it ends the generations that would run longer)
+        Returns:
+            predicted speech tokens, (1, num_tokens) including the final EOS.
+
+        Outside of the CFG window the unconditional row is dropped from the batch, so the remaining tokens cost a
+        single-row forward pass.
+        """
+        predicted = list(self.inference_stream(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            initial_speech_tokens=initial_speech_tokens,
+            prepend_prompt_speech_tokens=prepend_prompt_speech_tokens,
+            num_return_sequences=num_return_sequences,
+            max_new_tokens=max_new_tokens,
+            stop_on_eos=stop_on_eos,
+            do_sample=do_sample,
+            temperature=temperature,
+            top_p=top_p,
+            min_p=min_p,
+            length_penalty=length_penalty,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            cfg_max_tokens=cfg_max_tokens,
+            cfg_until_complete=cfg_until_complete,
+            drafter=drafter,
+            use_token_budget=use_token_budget,
+        ))
+
+        # Concatenate all predicted tokens along the sequence dimension.
+        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
+        return predicted_tokens
+
+    @torch.inference_mode()
+    def inference_stream(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        initial_speech_tokens: Optional[Tensor]=None,
+
+        # misc conditioning
+        prepend_prompt_speech_tokens: Optional[Tensor]=None,
+
+        # HF generate args
+        num_return_sequences=1,
+        max_new_tokens=None,
+        stop_on_eos=True,
+        do_sample=True,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        length_penalty=1.0,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+        cfg_max_tokens: Optional[int]=None,
+        cfg_until_complete=False,
+        drafter=None,
+        use_token_budget=False,
+    ):
+        """
+        Same as `inference`, but yields each predicted token, (1, 1), as soon as it is sampled (the last one is EOS
+        unless `max_new_tokens` is reached first).
+
         Args:
             text_tokens: a 1D (unbatched) or 2D (batched) tensor.
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
+        assert cfg_max_tokens is None or cfg_max_tokens > 0, "use cfg_weight=0 to disable CFG"
         _ensure_BOT_EOT(text_tokens, self.hp)
         text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
 
-        # Default initial speech to a single start-of-speech token
-        if initial_speech_tokens is None:
-            initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
-
-        # Prepare custom input embeds
-        embeds, len_cond = self.prepare_input_embeds(
+        # The conditioning prefix is prefilled once per voice; only text and speech inputs are embedded here.
+        # Speech defaults to a single start-of-speech token, followed by the extra BOS frame.
+        cond_prefix = self.get_cond_prefix(t3_cond)
+        len_cond = cond_prefix.len_cond
+        inputs_embeds, _ = self.prepare_inference_embeds(
             t3_cond=t3_cond,
             text_tokens=text_tokens,
-            speech_tokens=initial_speech_tokens,
+            initial_speech_tokens=initial_speech_tokens,
             cfg_weight=cfg_weight,
+            include_cond=False,
         )
 
-        # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
-        # Note the llama-specific logic. Other tfmr types can be added later.
-
-        self.compiled = False
-
-        # TODO? synchronize the expensive compile function
-        # with self.compile_lock:
-        if not self.compiled:
-            # Default to None for English models, only create for multilingual
-            alignment_stream_analyzer = None
-            if self.hp.is_multilingual:
-                alignment_stream_analyzer = AlignmentStreamAnalyzer(
-                    self.tfmr,
-                    None,
-                    text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
-                    alignment_layer_idx=9, # TODO: hparam or something?
-                    eos_idx=self.hp.stop_speech_token,
-                )
-                assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
-
-            patched_model = T3HuggingfaceBackend(
-                config=self.cfg,
-                llama=self.tfmr,
-                speech_enc=self.speech_emb,
-                speech_head=self.speech_head,
-                alignment_stream_analyzer=alignment_stream_analyzer,
-            )
-            self.patched_model = patched_model
-            self.compiled = True
-
         # # Run normal generate method, which calls our custom extended methods
         # return self.patched_model.generate(
         #     inputs=initial_speech_tokens,
@@ -314,177 +534,300 @@ class T3(nn.Module):
         #     # cache_implementation=None if not self.compiled else "static",
         # )
 
-        device = embeds.device
-
-        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
-        bos_embed = self.speech_emb(bos_token)  # shape: (B, 1, embed_dim)
-        bos_embed = bos_embed + self.speech_pos_emb.get_fixed_embedding(0)
+        device = inputs_embeds.device
 
-        # batch_size=2 for CFG
-        bos_embed = torch.cat([bos_embed, bos_embed])
+        # Fused sampler; seen tokens (for the repetition penalty) start with the BOS token.
+        sampler = SpeechTokenSampler(
+            1,
+            self.hp.speech_tokens_dict_size,
+            temperature=temperature,
+            top_p=top_p,
+            min_p=min_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            device=device,
+        )
+        last_token = self.hp.start_speech_token
+        sampler.update(torch.tensor([last_token], device=device))
+
+        # Pre-allocate the kv_cache for the whole generation
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
+        if use_token_budget:
+            max_new_tokens = min(max_new_tokens, self.speech_token_budget(text_tokens))
+        past = self.kv_cache_pool.acquire(
+            batch_size=inputs_embeds.size(0),
+            max_len=len_cond + inputs_embeds.size(1) + max_new_tokens,
+            dtype=self.tfmr.dtype,
+            device=device,
+        ).load_prefix(cond_prefix)
+
+        # Alignment analysis (hallucination checks, for models with known `alignment_heads`) hooks into the shared
+        # transformer for this request only; the hooks are removed again however decoding ends (EOS, an error, or the
+        # consumer stopping early).
+        analyzer = None
+        try:
+            if self.alignment_heads is not None:
+                analyzer = AlignmentStreamAnalyzer(
+                    self.tfmr,
+                    None,
+                    text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
+                    alignment_layer_idx=9, # TODO: hparam or something?
+                    eos_idx=self.hp.stop_speech_token,
+                    aligned_heads=self.alignment_heads,
+                )
 
-        # Combine condition and BOS token for the initial input
-        inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
+            # ---- Initial Forward Pass (text and BOS on top of the cached conditioning) ----
+            output = self.backend(
+                inputs_embeds=inputs_embeds,
+                past_key_values=past,
+                use_cache=True,
+                output_attentions=False,
+                output_hidden_states=False,
+                return_dict=True,
+                num_logits_to_keep=1,
+            )
 
-        # Track generated token ids; start with the BOS token.
-        generated_ids = bos_token.clone()
-        predicted = []  # To store the predicted tokens
+            # ---- Generation Loop using kv_cache ----
+            if cfg_until_complete and analyzer is None:
+                logger.warning("cfg_until_complete needs the alignment analyzer (see `alignment_heads`), ignored")
+            if drafter is not None and analyzer is not None:
+                logger.warning("speculative decoding is not supported with the alignment analyzer, ignored")
+                drafter = None
+            if drafter is not None:
+                yield from self._speculative_decode(
+                    output, past, sampler, drafter, t3_cond,
+                    max_new_tokens=max_new_tokens, cfg_max_tokens=cfg_max_tokens,
+                )
+                return
+            n_rows = inputs_embeds.size(0)  # 2 while CFG is applied
+            for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
+                logits_step = output.logits[:, -1, :]
+                # CFG combine  → (1, V)
+                uncond = logits_step[1:2, :] if n_rows > 1 else None  # single row without CFG
+                logits = sampler.apply_cfg(logits_step[0:1, :], uncond)
+
+                # Apply alignment stream analyzer integrity checks
+                if analyzer is not None:
+                    # Pass the last generated token for repetition tracking
+                    logits = analyzer.step(logits, next_token=last_token)  # (1, V)
+
+                # Repetition penalty, temperature, min_p / top_p filtering and the draw, in one pass
+                next_token = sampler(logits)  # shape: (B, 1)
+                yield next_token
+
+                # Check for EOS token (and whether the analyzer saw the text completed, in the same host sync).
+                if cfg_until_complete and analyzer is not None and n_rows > 1:
+                    flags = torch.cat([next_token.view(1), analyzer.complete.all().view(1).to(next_token.dtype)])
+                    last_token, text_complete = flags.tolist()
+                else:
+                    last_token, text_complete = next_token.item(), False
+                if last_token == self.hp.stop_speech_token:
+                    logger.info(f"✅ EOS token detected! Stopping generation at step {i+1}")
+                    if analyzer is not None:
+                        analyzer.log_forced_eos()
+                    break
+
+                # Get embedding for the new token.
+                next_token_embed = self.speech_emb(next_token)
+                next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
+
+                # End of the CFG window: drop the uncond row, the following steps run on the cond row only
+                if n_rows > 1 and (
+                    (cfg_max_tokens is not None and i + 1 >= cfg_max_tokens)
+                    or text_complete
+                ):
+                    past.select_rows(1)
+                    n_rows = 1
+
+                #  For CFG
+                next_token_embed = next_token_embed.expand(n_rows, -1, -1)
+
+                # Forward pass with only the new token and the cached past.
+                output = self.backend(
+                    inputs_embeds=next_token_embed,
+                    past_key_values=past,
+                    output_attentions=False,
+                    output_hidden_states=False,
+                    return_dict=True,
+                    num_logits_to_keep=1,
+                )
+                # NOTE: the kv_cache is updated in place
+        finally:
+            if analyzer is not None:
+                analyzer.close()
+            self.kv_cache_pool.release(past)
 
-        # Instantiate the logits processors.
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        min_p_warper = MinPLogitsWarper(min_p=min_p)
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
+    def _speculative_decode(self, output, past, sampler, drafter, t3_cond, *, max_new_tokens, cfg_max_tokens=None):
+        """
+        Decoding loop of `inference_stream` with speculative decoding: `drafter` proposes the next few tokens, the
+        last sampled token and the draft go through the transformer in a single forward pass, and `verify_draft`
+        keeps a prefix of the draft plus one more token (between 1 and k + 1 tokens per pass, with exactly the
+        distribution of token-by-token sampling). The KV-cache is then cropped back to the kept tokens.
 
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
-            use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
-            return_dict=True,
-        )
-        # Initialize kv_cache with the full context.
-        past = output.past_key_values
-
-        # ---- Generation Loop using kv_cache ----
-        for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits_step = output.logits[:, -1, :]
-            # CFG combine  → (1, V)
-            cond   = logits_step[0:1, :]
-            uncond = logits_step[1:2, :]
-            cfg = torch.as_tensor(cfg_weight, device=cond.device, dtype=cond.dtype)
-            logits = cond + cfg * (cond - uncond)
-            
-            # Apply alignment stream analyzer integrity checks
-            if self.patched_model.alignment_stream_analyzer is not None:
-                if logits.dim() == 1:            # guard in case something upstream squeezed
-                    logits = logits.unsqueeze(0) # (1, V)
-                # Pass the last generated token for repetition tracking
-                last_token = generated_ids[0, -1].item() if len(generated_ids[0]) > 0 else None
-                logits = self.patched_model.alignment_stream_analyzer.step(logits, next_token=last_token)  # (1, V)
-
-            # Apply repetition penalty
-            ids_for_proc = generated_ids[:1, ...]   # batch = 1
-            logits = repetition_penalty_processor(ids_for_proc, logits)  # expects (B,V)
-            
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
-                
-            # Apply min_p and top_p filtering
-            logits = min_p_warper(ids_for_proc, logits)
-            logits = top_p_warper(ids_for_proc, logits)
-
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
-
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
-
-            # Check for EOS token.
-            if next_token.view(-1) == self.hp.stop_speech_token:
-                logger.info(f"✅ EOS token detected! Stopping generation at step {i+1}")
+        `output` is the prefill output, `past` its KV-cache; yields (1, 1) tokens like `inference_stream`.
+        """
+        stop_token = self.hp.stop_speech_token
+        prompt_tokens = t3_cond.cond_prompt_speech_tokens
+        history = [] if prompt_tokens is None else prompt_tokens[0].tolist()
+        history.append(self.hp.start_speech_token)
+
+        n_rows = output.logits.size(0)  # 2 while CFG is applied
+        logits = output.logits[:, -1:, :]  # (n_rows, 1 + len(draft), V)
+        draft, len_before = [], None
+        n_tokens = n_drafted = n_accepted = n_passes = 0
+        pbar = tqdm(total=max_new_tokens, desc="Sampling", dynamic_ncols=True)
+        while True:
+            tokens = verify_draft(sampler, logits[0], logits[1] if n_rows > 1 else None, draft)
+            n_drafted += len(draft)
+            n_accepted += len(tokens) - 1
+            if len_before is not None:
+                past.crop(len_before + len(tokens))  # the input token and the accepted draft
+
+            tokens = tokens[:max_new_tokens - n_tokens]
+            if stop_token in tokens:
+                tokens = tokens[:tokens.index(stop_token) + 1]
+            for token in tokens:
+                yield torch.tensor([[token]], device=self.device)
+            n_tokens += len(tokens)
+            history += tokens
+            pbar.update(len(tokens))
+            if tokens[-1] == stop_token or n_tokens >= max_new_tokens:
                 break
 
-            # Get embedding for the new token.
-            next_token_embed = self.speech_emb(next_token)
-            next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
-
-            #  For CFG
-            next_token_embed = torch.cat([next_token_embed, next_token_embed])
-
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
-                inputs_embeds=next_token_embed,
+            # End of the CFG window: drop the uncond row (passes don't cross it, see below)
+            if n_rows > 1 and cfg_max_tokens is not None and n_tokens >= cfg_max_tokens:
+                past.select_rows(1)
+                n_rows = 1
+
+            # Next pass: the last token (position `n_tokens`, see `inference_stream`) followed by the draft. A pass
+            # yields up to len(draft) + 1 tokens, so with CFG the draft stops at the end of the window: the tokens
+            # after it are sampled without the uncond row, as token by token.
+            max_draft = max_new_tokens - n_tokens - 1
+            if n_rows > 1 and cfg_max_tokens is not None:
+                max_draft = min(max_draft, cfg_max_tokens - n_tokens - 1)
+            draft = drafter.propose(history)[:max(max_draft, 0)]
+            input_ids = torch.tensor([[tokens[-1]] + draft], device=self.device)
+            positions = torch.arange(n_tokens, n_tokens + input_ids.size(1), device=self.device)
+            inputs_embeds = self.speech_emb(input_ids) + self.speech_pos_emb.get_fixed_embedding(positions)
+            len_before = past.get_seq_length()
+            output = self.backend(
+                inputs_embeds=inputs_embeds.expand(n_rows, -1, -1),
                 past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
+                output_attentions=False,
+                output_hidden_states=False,
                 return_dict=True,
+                num_logits_to_keep=input_ids.size(1),
             )
-            # Update the kv_cache.
-            past = output.past_key_values
-
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
+            logits = output.logits
+            n_passes += 1
+        pbar.close()
+        logger.info(
+            f"speculative decoding: {n_tokens} tokens in {n_passes + 1} passes, "
+            f"{n_accepted}/{n_drafted} draft tokens accepted"
+        )
 
     @torch.inference_mode()
     def inference_turbo(self, t3_cond, text_tokens, temperature=0.8, top_k=1000, top_p=0.95, repetition_penalty=1.2,
-                        max_gen_len=1000):
+                        max_gen_len=1000, use_token_budget=False):
+        generated_speech_tokens = list(self.inference_turbo_stream(
+            t3_cond, text_tokens, temperature=temperature, top_k=top_k, top_p=top_p,
+            repetition_penalty=repetition_penalty, max_gen_len=max_gen_len, use_token_budget=use_token_budget,
+        ))
+        all_tokens = torch.cat(generated_speech_tokens, dim=1)
 
-        logits_processors = LogitsProcessorList()
-        if temperature > 0 and temperature != 1.0:
-            logits_processors.append(TemperatureLogitsWarper(temperature))
-        if top_k > 0:
-            logits_processors.append(TopKLogitsWarper(top_k))
-        if top_p < 1.0:
-            logits_processors.append(TopPLogitsWarper(top_p))
-        if repetition_penalty != 1.0:
-            logits_processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        # Remove EOS token if present
+        if all_tokens.size(1) > 0 and all_tokens[0, -1] == self.hp.stop_speech_token:
+            all_tokens = all_tokens[:, :-1]
+
+        return all_tokens
 
+    @torch.inference_mode()
+    def inference_turbo_stream(self, t3_cond, text_tokens, temperature=0.8, top_k=1000, top_p=0.95,
+                               repetition_penalty=1.2, max_gen_len=1000, use_token_budget=False):
+        """
+        Same as `inference_turbo`, but yields each predicted token, (B, 1), as soon as it is sampled (incl. EOS).
+
+        With `use_token_budget`, `max_gen_len` is also capped by `speech_token_budget` of the text; with known
+        `alignment_heads` (see `find_alignment_heads`) the alignment analyzer stops hallucinated long tails.
+        """
+        if use_token_budget:
+            max_gen_len = min(max_gen_len, self.speech_token_budget(text_tokens))
+
+        sampler = SpeechTokenSampler(
+            text_tokens.size(0),
+            self.hp.speech_tokens_dict_size,
+            temperature=temperature if temperature > 0 else 1.0,
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            penalty_last=True,  # (Turbo's order: the penalty after temperature / top-k / top-p)
+            device=text_tokens.device,
+        )
 
         speech_start_token = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
-        embeds, _ = self.prepare_input_embeds(
-            t3_cond=t3_cond,
+        cond_prefix = self.get_cond_prefix(t3_cond)
+        text_emb, speech_emb = self.prepare_text_speech_embeds(
             text_tokens=text_tokens,
             speech_tokens=speech_start_token,
             cfg_weight=0.0,
         )
+        embeds = torch.cat([text_emb, speech_emb], dim=1)
+
+        # Pre-allocated kv_cache for the whole generation (HF GPT-2 only grows legacy tuple caches)
+        past_key_values = self.kv_cache_pool.acquire(
+            batch_size=embeds.size(0),
+            max_len=cond_prefix.len_cond + embeds.size(1) + max_gen_len + 1,
+            dtype=self.tfmr.dtype,
+            device=embeds.device,
+        ).load_prefix(cond_prefix)
+
+        analyzer = None
+        try:
+            spies = None
+            if self.alignment_heads is not None:
+                analyzer = AlignmentStreamAnalyzer(
+                    self.tfmr,
+                    None,
+                    text_tokens_slice=(cond_prefix.len_cond, cond_prefix.len_cond + text_tokens.size(-1)),
+                    eos_idx=self.hp.stop_speech_token,
+                    rows=range(text_tokens.size(0)),
+                    aligned_heads=self.alignment_heads,
+                )
+                spies = analyzer.attention_spies
 
-        generated_speech_tokens = []
-
-        llm_outputs = self.tfmr(
-            inputs_embeds=embeds,
-            use_cache=True
-        )
-
-        hidden_states = llm_outputs[0]
-        past_key_values = llm_outputs.past_key_values
-
-        speech_hidden = hidden_states[:, -1:]
-        speech_logits = self.speech_head(speech_hidden)
-
-        processed_logits = logits_processors(speech_start_token, speech_logits[:, -1, :])
-        probs = F.softmax(processed_logits, dim=-1)
-        next_speech_token = torch.multinomial(probs, num_samples=1)
-
-        generated_speech_tokens.append(next_speech_token)
-        current_speech_token = next_speech_token
-
-        for _ in tqdm(range(max_gen_len)):
-            current_speech_embed = self.speech_emb(current_speech_token)
-
-            llm_outputs = self.tfmr(
-                inputs_embeds=current_speech_embed,
-                past_key_values=past_key_values,
-                use_cache=True
-            )
-
-            hidden_states = llm_outputs[0]
-            past_key_values = llm_outputs.past_key_values
-            speech_logits = self.speech_head(hidden_states)
+            hidden_states = gpt2_forward(self.tfmr, embeds, past_key_values, attention_spies=spies)
 
-            input_ids = torch.cat(generated_speech_tokens, dim=1)
-            processed_logits = logits_processors(input_ids, speech_logits[:, -1, :])
-            if torch.all(processed_logits == -float("inf")):
-                print("Warning: All logits are -inf")
-                break
+            speech_logits = self.speech_head(hidden_states[:, -1, :])
+            if analyzer is not None:
+                speech_logits = analyzer.step(speech_logits, next_token=speech_start_token)
 
-            probs = F.softmax(processed_logits, dim=-1)
-            next_speech_token = torch.multinomial(probs, num_samples=1)
+            # The first token is penalized for repeating BOS, the following ones only for repeating generated tokens
+            sampler.update(speech_start_token)
+            next_speech_token = sampler(speech_logits, update=False)
+            sampler.seen.zero_()
+            sampler.update(next_speech_token)
 
-            generated_speech_tokens.append(next_speech_token)
+            yield next_speech_token
             current_speech_token = next_speech_token
-            if torch.all(next_speech_token == self.hp.stop_speech_token):
-                break
-
-        all_tokens = torch.cat(generated_speech_tokens, dim=1)
 
-        # Remove EOS token if present
-        if all_tokens.size(1) > 0 and all_tokens[0, -1] == self.hp.stop_speech_token:
-            all_tokens = all_tokens[:, :-1]
-
-        return all_tokens
+            for _ in tqdm(range(max_gen_len)):
+                current_speech_embed = self.speech_emb(current_speech_token)
+
+                hidden_states = gpt2_forward(self.tfmr, current_speech_embed, past_key_values, attention_spies=spies)
+                speech_logits = self.speech_head(hidden_states[:, -1, :])
+                if analyzer is not None:
+                    speech_logits = analyzer.step(speech_logits, next_token=current_speech_token)
+
+                # NOTE: the sampler always keeps at least the most likely token, so logits can't end up all -inf
+                next_speech_token = sampler(speech_logits)
+
+                yield next_speech_token
+                current_speech_token = next_speech_token
+                if torch.all(next_speech_token == self.hp.stop_speech_token):
+                    if analyzer is not None:
+                        analyzer.log_forced_eos()
+                    break
+        finally:
+            if analyzer is not None:
+                analyzer.close()
+            self.kv_cache_pool.release(past_key_values)
@@ -1,4 +1,35 @@
+import logging
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
 class AttrDict(dict):
     def __init__(self, *args, **kwargs):
         super(AttrDict, self).__init__(*args, **kwargs)
         self.__dict__ = self
+
+
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def apply_precision(precision: str, t3=None, s3gen=None):
+    """
+    Precision policy for inference ("fp32", "bf16" or "fp16"), applied on model load: the bandwidth-bound parts run
+    in `precision`, with casts at the stage boundaries.
+      - `t3`: the whole model (Llama's RMSNorm upcasts to fp32 internally, LayerNorm kernels accumulate in fp32 and
+        the sampler upcasts the logits); conditionals are cast at its input, see `T3.prepare_conditioning`. Int8 T3s
+        (`quantization.quantize_t3`) are left as they are.
+      - `s3gen`: the CFM estimator only, see `S3Token2Wav.set_estimator_dtype`. Mel extraction (STFT), the speaker
+        encoder and S3 tokenizer, the flow encoder and HiFT (iSTFT) stay in fp32.
+    """
+    assert precision in PRECISIONS, f"unknown precision {precision}"
+    if t3 is not None:
+        if t3.quantization is not None:
+            logger.warning(f"T3 is int8 quantized, {precision=} ignored for T3")
+        else:
+            t3.to(dtype=PRECISIONS[precision])  # (KV-caches and cached prefixes are keyed by dtype)
+    if s3gen is not None:
+        s3gen.set_estimator_dtype(precision)
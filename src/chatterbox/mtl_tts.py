@@ -10,12 +10,17 @@ from safetensors.torch import load_file as load_safetensors
 from huggingface_hub import snapshot_download
 
 from .models.t3 import T3
+from .models.t3.inference.batch_scheduler import T3BatchScheduler
 from .models.t3.modules.t3_config import T3Config
 from .models.s3tokenizer import S3_SR, drop_invalid_tokens
-from .models.s3gen import S3GEN_SR, S3Gen
+from .models.utils import apply_precision
+from .models.s3gen import S3GEN_SR, S3Gen, S3GenStreamer
 from .models.tokenizers import MTLTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .conds_cache import ConditionalsCache
+from .voice_library import VoiceLibrary
+from .longform import split_sentences, pipelined_synthesis, crossfade_concat
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -151,6 +156,10 @@ class ChatterboxMultilingualTTS:
         self.device = device
         self.conds = conds
         self.watermarker = perth.PerthImplicitWatermarker()
+        self.conds_cache = ConditionalsCache()
+        self.t3_scheduler = None
+        self.t3_cfg_window = {}  # see `set_cfg_window`
+        self.t3_token_budget = False  # see `enable_token_budget`
 
     @classmethod
     def get_supported_languages(cls):
@@ -158,7 +167,11 @@ class ChatterboxMultilingualTTS:
         return SUPPORTED_LANGUAGES.copy()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxMultilingualTTS':
+    def from_local(cls, ckpt_dir, device, precision="fp32") -> 'ChatterboxMultilingualTTS':
+        """
+        `precision` ("fp32", "bf16" or "fp16") is the precision policy of T3 and the S3Gen CFM estimator, see
+        `models.utils.apply_precision`.
+        """
         ckpt_dir = Path(ckpt_dir)
 
         # Determine map_location for non-CUDA devices to handle CUDA-saved models
@@ -194,10 +207,12 @@ class ChatterboxMultilingualTTS:
         if (builtin_voice := ckpt_dir / "conds.pt").exists():
             conds = Conditionals.load(builtin_voice, map_location=map_location).to(device)
 
+        apply_precision(precision, t3=t3, s3gen=s3gen)
+
         return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
 
     @classmethod
-    def from_pretrained(cls, device: torch.device) -> 'ChatterboxMultilingualTTS':
+    def from_pretrained(cls, device: torch.device, precision="fp32") -> 'ChatterboxMultilingualTTS':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -215,9 +230,63 @@ class ChatterboxMultilingualTTS:
                 # Allow anonymous access by not passing token parameter
             )
         )
-        return cls.from_local(ckpt_dir, device)
+        return cls.from_local(ckpt_dir, device, precision=precision)
     
+    def enable_batching(self, max_batch_size=8):
+        """
+        Decode T3 through a shared `T3BatchScheduler`, so concurrent `generate` calls (eg from a server with several
+        workers) share each transformer step instead of queueing behind each other.
+        """
+        if self.t3_scheduler is None:
+            self.t3_scheduler = T3BatchScheduler(self.t3, max_batch_size=max_batch_size).start()
+        return self
+
+    def set_cfg_window(self, t3_max_tokens=None, t3_until_complete=False, s3gen_interval=(0.0, 1.0)):
+        """
+        Only apply classifier-free guidance within a window, to save the extra (unconditional) batch rows elsewhere:
+        T3 guides the first `t3_max_tokens` speech tokens (and, with `t3_until_complete`, stops once the alignment
+        analyzer of multilingual models reports that the text has been spoken), and the S3Gen flow decoder guides
+        the solver steps with t in `s3gen_interval`. The defaults apply CFG everywhere.
+        """
+        self.t3_cfg_window = dict(cfg_max_tokens=t3_max_tokens, cfg_until_complete=t3_until_complete)
+        self.s3gen.flow.decoder.inference_cfg_interval = tuple(s3gen_interval)
+        return self
+
+    def enable_token_budget(self, enabled=True):
+        """
+        Cap the speech tokens of every T3 generation by `T3.speech_token_budget` of its text, so runaway generations
+        (hallucinated long tails) stop early. Off by default: it changes the length of the generations that would
+        run past the budget.
+        """
+        self.t3_token_budget = enabled
+        return self
+
+    def enable_conds_cache(self, cache_dir=None, max_entries=32):
+        """
+        Replace the in-memory cache of voice conditionals used by `prepare_conditionals`; with `cache_dir` the
+        entries are also saved there and reused by later processes.
+        """
+        self.conds_cache = ConditionalsCache(max_entries=max_entries, cache_dir=cache_dir)
+        return self
+
+    def use_voice(self, library: VoiceLibrary, voice_id: str):
+        """
+        Use a pre-enrolled voice from `library` (a `VoiceLibrary`, or a `VoicePool` in front of one) instead of
+        `prepare_conditionals`.
+        """
+        self.conds = library.get(voice_id, Conditionals, self.device)
+        return self
+
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+        key = None
+        if self.conds_cache is not None:
+            key = ConditionalsCache.key(wav_fpath, "mtl", self.ENC_COND_LEN, self.DEC_COND_LEN)
+            conds = self.conds_cache.get(key, Conditionals, self.device)
+            if conds is not None:
+                conds.t3.emotion_adv = exaggeration * torch.ones(1, 1, 1, device=self.device)
+                self.conds = conds
+                return
+
         ## Load reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
@@ -243,19 +312,16 @@ class ChatterboxMultilingualTTS:
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
         self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        if key is not None:
+            self.conds_cache.put(key, self.conds)
 
-    def generate(
-        self,
-        text,
-        language_id,
-        audio_prompt_path=None,
-        exaggeration=0.5,
-        cfg_weight=0.5,
-        temperature=0.8,
-        repetition_penalty=2.0,
-        min_p=0.05,
-        top_p=1.0,
-    ):
+    def _prepare_inputs(self, text, language_id, audio_prompt_path, exaggeration):
+        "Set up the conditionals and return the text tokens for `generate` / `generate_stream`"
+        self._prepare_conds(language_id, audio_prompt_path, exaggeration)
+        return self._tokenize(text, language_id)
+
+    def _prepare_conds(self, language_id, audio_prompt_path, exaggeration):
+        "Validate the inputs and set up the conditionals (once per call, not per `generate_long` chunk)"
         # Validate language_id
         if language_id and language_id.lower() not in SUPPORTED_LANGUAGES:
             supported_langs = ", ".join(SUPPORTED_LANGUAGES.keys())
@@ -275,9 +341,12 @@ class ChatterboxMultilingualTTS:
             self.conds.t3 = T3Cond(
                 speaker_emb=_cond.speaker_emb,
                 cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
+                cond_prompt_speech_emb=_cond.cond_prompt_speech_emb,
                 emotion_adv=exaggeration * torch.ones(1, 1, 1),
             ).to(device=self.device)
 
+    def _tokenize(self, text, language_id):
+        "Text tokens of `text` (two rows for CFG)"
         # Norm and tokenize text
         text = punc_norm(text)
         text_tokens = self.tokenizer.text_to_tokens(text, language_id=language_id.lower() if language_id else None).to(self.device)
@@ -287,29 +356,151 @@ class ChatterboxMultilingualTTS:
         eot = self.t3.hp.stop_text_token
         text_tokens = F.pad(text_tokens, (1, 0), value=sot)
         text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return text_tokens
 
-        with torch.inference_mode():
+    def generate(
+        self,
+        text,
+        language_id,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        repetition_penalty=2.0,
+        min_p=0.05,
+        top_p=1.0,
+    ):
+        text_tokens = self._prepare_inputs(text, language_id, audio_prompt_path, exaggeration)
+        speech_tokens = self._generate_speech_tokens(
+            text_tokens,
+            cfg_weight=cfg_weight,
+            temperature=temperature,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+        )
+        return self._watermark(self._render(speech_tokens))
+
+    @torch.inference_mode()
+    def _generate_speech_tokens(self, text_tokens, cfg_weight, temperature, repetition_penalty, min_p, top_p):
+        "T3 stage of `generate`: text tokens -> valid speech tokens of the conditional row (1D)"
+        if self.t3_scheduler is not None:
+            speech_tokens = self.t3_scheduler.submit(
+                self.conds.t3,
+                text_tokens,
+                max_new_tokens=1000,
+                temperature=temperature,
+                cfg_weight=cfg_weight,
+                cfg_max_tokens=self.t3_cfg_window.get("cfg_max_tokens"),
+                use_token_budget=self.t3_token_budget,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
+            ).result()
+        else:
             speech_tokens = self.t3.inference(
                 t3_cond=self.conds.t3,
                 text_tokens=text_tokens,
                 max_new_tokens=1000,  # TODO: use the value in config
                 temperature=temperature,
                 cfg_weight=cfg_weight,
+                **self.t3_cfg_window,
+                use_token_budget=self.t3_token_budget,
                 repetition_penalty=repetition_penalty,
                 min_p=min_p,
                 top_p=top_p,
             )
-            # Extract only the conditional batch.
-            speech_tokens = speech_tokens[0]
-
-            # TODO: output becomes 1D
-            speech_tokens = drop_invalid_tokens(speech_tokens)
-            speech_tokens = speech_tokens.to(self.device)
+        # Extract only the conditional batch.
+        speech_tokens = speech_tokens[0]
+
+        # TODO: output becomes 1D
+        speech_tokens = drop_invalid_tokens(speech_tokens)
+        return speech_tokens.to(self.device)
+
+    @torch.inference_mode()
+    def _render(self, speech_tokens):
+        "S3Gen/HiFT stage of `generate`: speech tokens -> (1, n_samples) waveform, not watermarked"
+        wav, _ = self.s3gen.inference(
+            speech_tokens=speech_tokens,
+            ref_dict=self.conds.gen,
+        )
+        return wav.detach().cpu()
 
-            wav, _ = self.s3gen.inference(
-                speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
+    def generate_long(
+        self,
+        text,
+        language_id,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        repetition_penalty=2.0,
+        min_p=0.05,
+        top_p=1.0,
+        max_chars=300,
+        crossfade_ms=50,
+    ):
+        """
+        `generate` for text of any length: the text is split into chunks of whole sentences (at most `max_chars`
+        each, following the punctuation of `language_id`), T3 decodes the next chunk while S3Gen/HiFT render the
+        current one, and the chunks are joined with `crossfade_ms` crossfades.
+        """
+        self._prepare_conds(language_id, audio_prompt_path, exaggeration)
+
+        def generate_tokens(chunk):
+            return self._generate_speech_tokens(
+                self._tokenize(chunk, language_id),
+                cfg_weight=cfg_weight,
+                temperature=temperature,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
             )
-            wav = wav.squeeze(0).detach().cpu().numpy()
-            watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
+
+        chunks = split_sentences(text, language_id=language_id, max_chars=max_chars)
+        wavs = pipelined_synthesis(chunks, generate_tokens, self._render)
+        wav = crossfade_concat(wavs, int(crossfade_ms * self.sr / 1000))
+        return self._watermark(wav)
+
+    def generate_stream(
+        self,
+        text,
+        language_id,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        repetition_penalty=2.0,
+        min_p=0.05,
+        top_p=1.0,
+        chunk_size=25,
+    ):
+        """
+        Same as `generate`, but yields watermarked (1, n_samples) audio chunks while T3 is still decoding.
+        `chunk_size` is the number of speech tokens (25 per second of audio) synthesized per chunk.
+        """
+        text_tokens = self._prepare_inputs(text, language_id, audio_prompt_path, exaggeration)
+        streamer = S3GenStreamer(self.s3gen, self.conds.gen, chunk_size=chunk_size)
+
+        with torch.inference_mode():
+            for speech_token in self.t3.inference_stream(
+                t3_cond=self.conds.t3,
+                text_tokens=text_tokens,
+                max_new_tokens=1000,  # TODO: use the value in config
+                temperature=temperature,
+                cfg_weight=cfg_weight,
+                **self.t3_cfg_window,
+                use_token_budget=self.t3_token_budget,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
+            ):
+                wav = streamer.push(speech_token)
+                if wav is not None:
+                    yield self._watermark(wav)
+            yield self._watermark(streamer.flush())
+
+    def _watermark(self, wav):
+        wav = wav.squeeze(0).detach().cpu().numpy()
+        watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
@@ -9,11 +9,18 @@ from huggingface_hub import hf_hub_download
 from safetensors.torch import load_file
 
 from .models.t3 import T3
+from .models.t3.inference.batch_scheduler import T3BatchScheduler
+from .models.t3.inference.speculative import PromptLookupDrafter
+from .models.t3.quantization import quantize_t3, load_quantized_t3
 from .models.s3tokenizer import S3_SR, drop_invalid_tokens
-from .models.s3gen import S3GEN_SR, S3Gen
+from .models.utils import apply_precision
+from .models.s3gen import S3GEN_SR, S3Gen, S3GenStreamer
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .conds_cache import ConditionalsCache
+from .voice_library import VoiceLibrary
+from .longform import split_sentences, pipelined_synthesis, crossfade_concat
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -124,9 +131,20 @@ class ChatterboxTTS:
         self.device = device
         self.conds = conds
         self.watermarker = perth.PerthImplicitWatermarker()
+        self.conds_cache = ConditionalsCache()
+        self.t3_scheduler = None
+        self.t3_cfg_window = {}  # see `set_cfg_window`
+        self.t3_drafter = None  # see `enable_speculative_decoding`
+        self.t3_token_budget = False  # see `enable_token_budget`
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxTTS':
+    def from_local(cls, ckpt_dir, device, t3_quantization=None, precision="fp32") -> 'ChatterboxTTS':
+        """
+        With `t3_quantization` ("dynamic" or "weight_only", see `models.t3.quantization`) T3 runs with int8 weights,
+        loaded from `t3_cfg_int8.safetensors` when present (written by `save_quantized_t3`), else quantized on load.
+        `precision` ("fp32", "bf16" or "fp16") is the precision policy of T3 and the S3Gen CFM estimator, see
+        `models.utils.apply_precision`.
+        """
         ckpt_dir = Path(ckpt_dir)
 
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -142,10 +160,15 @@ class ChatterboxTTS:
         ve.to(device).eval()
 
         t3 = T3()
-        t3_state = load_file(ckpt_dir / "t3_cfg.safetensors")
-        if "model" in t3_state.keys():
-            t3_state = t3_state["model"][0]
-        t3.load_state_dict(t3_state)
+        if t3_quantization is not None and (ckpt_dir / "t3_cfg_int8.safetensors").exists():
+            load_quantized_t3(t3, ckpt_dir / "t3_cfg_int8.safetensors", mode=t3_quantization)
+        else:
+            t3_state = load_file(ckpt_dir / "t3_cfg.safetensors")
+            if "model" in t3_state.keys():
+                t3_state = t3_state["model"][0]
+            t3.load_state_dict(t3_state)
+            if t3_quantization is not None:
+                quantize_t3(t3, mode=t3_quantization)
         t3.to(device).eval()
 
         s3gen = S3Gen()
@@ -162,10 +185,12 @@ class ChatterboxTTS:
         if (builtin_voice := ckpt_dir / "conds.pt").exists():
             conds = Conditionals.load(builtin_voice, map_location=map_location).to(device)
 
+        apply_precision(precision, t3=t3, s3gen=s3gen)
+
         return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxTTS':
+    def from_pretrained(cls, device, t3_quantization=None, precision="fp32") -> 'ChatterboxTTS':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -177,9 +202,80 @@ class ChatterboxTTS:
         for fpath in ["ve.safetensors", "t3_cfg.safetensors", "s3gen.safetensors", "tokenizer.json", "conds.pt"]:
             local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
 
-        return cls.from_local(Path(local_path).parent, device)
+        return cls.from_local(Path(local_path).parent, device, t3_quantization=t3_quantization, precision=precision)
+
+    def enable_batching(self, max_batch_size=8):
+        """
+        Decode T3 through a shared `T3BatchScheduler`, so concurrent `generate` calls (eg from a server with several
+        workers) share each transformer step instead of queueing behind each other.
+        """
+        if self.t3_scheduler is None:
+            self.t3_scheduler = T3BatchScheduler(self.t3, max_batch_size=max_batch_size).start()
+        return self
+
+    def set_cfg_window(self, t3_max_tokens=None, t3_until_complete=False, s3gen_interval=(0.0, 1.0)):
+        """
+        Only apply classifier-free guidance within a window, to save the extra (unconditional) batch rows elsewhere:
+        T3 guides the first `t3_max_tokens` speech tokens (and, with `t3_until_complete`, stops once the alignment
+        analyzer, see `set_alignment_heads`, reports that the text has been spoken), and the S3Gen flow decoder guides
+        the solver steps with t in `s3gen_interval`. The defaults apply CFG everywhere.
+        """
+        self.t3_cfg_window = dict(cfg_max_tokens=t3_max_tokens, cfg_until_complete=t3_until_complete)
+        self.s3gen.flow.decoder.inference_cfg_interval = tuple(s3gen_interval)
+        return self
+
+    def enable_speculative_decoding(self, num_draft_tokens=4, max_ngram=3):
+        """
+        Decode T3 speculatively: up to `num_draft_tokens` tokens are drafted by looking up the last `max_ngram`
+        tokens in the voice prompt and the speech generated so far, and verified in a single forward pass. The
+        sampling distribution is unchanged. Not used with `enable_batching`.
+        """
+        self.t3_drafter = PromptLookupDrafter(num_draft_tokens=num_draft_tokens, max_ngram=max_ngram)
+        return self
+
+    def set_alignment_heads(self, heads):
+        """
+        Enable the alignment analyzer for T3 (early stopping of hallucinated tails and repetitions) with these
+        (layer, head) pairs, eg from `T3.find_alignment_heads`; None disables it again.
+        """
+        self.t3.hp.alignment_heads = None if heads is None else [tuple(h) for h in heads]
+        return self
+
+    def enable_token_budget(self, enabled=True):
+        """
+        Cap the speech tokens of every T3 generation by `T3.speech_token_budget` of its text, so runaway generations
+        (hallucinated long tails) stop early. Off by default: it changes the length of the generations that would
+        run past the budget.
+        """
+        self.t3_token_budget = enabled
+        return self
+
+    def enable_conds_cache(self, cache_dir=None, max_entries=32):
+        """
+        Replace the in-memory cache of voice conditionals used by `prepare_conditionals`; with `cache_dir` the
+        entries are also saved there and reused by later processes.
+        """
+        self.conds_cache = ConditionalsCache(max_entries=max_entries, cache_dir=cache_dir)
+        return self
+
+    def use_voice(self, library: VoiceLibrary, voice_id: str):
+        """
+        Use a pre-enrolled voice from `library` (a `VoiceLibrary`, or a `VoicePool` in front of one) instead of
+        `prepare_conditionals`.
+        """
+        self.conds = library.get(voice_id, Conditionals, self.device)
+        return self
 
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+        key = None
+        if self.conds_cache is not None:
+            key = ConditionalsCache.key(wav_fpath, "tts", self.ENC_COND_LEN, self.DEC_COND_LEN)
+            conds = self.conds_cache.get(key, Conditionals, self.device)
+            if conds is not None:
+                conds.t3.emotion_adv = exaggeration * torch.ones(1, 1, 1, device=self.device)
+                self.conds = conds
+                return
+
         ## Load reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
@@ -204,18 +300,16 @@ class ChatterboxTTS:
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
         self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        if key is not None:
+            self.conds_cache.put(key, self.conds)
 
-    def generate(
-        self,
-        text,
-        repetition_penalty=1.2,
-        min_p=0.05,
-        top_p=1.0,
-        audio_prompt_path=None,
-        exaggeration=0.5,
-        cfg_weight=0.5,
-        temperature=0.8,
-    ):
+    def _prepare_inputs(self, text, audio_prompt_path, exaggeration, cfg_weight):
+        "Set up the conditionals and return the text tokens for `generate` / `generate_stream`"
+        self._prepare_conds(audio_prompt_path, exaggeration)
+        return self._tokenize(text, cfg_weight)
+
+    def _prepare_conds(self, audio_prompt_path, exaggeration):
+        "Set up the conditionals (once per call, not per `generate_long` chunk)"
         if audio_prompt_path:
             self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
         else:
@@ -227,9 +321,12 @@ class ChatterboxTTS:
             self.conds.t3 = T3Cond(
                 speaker_emb=_cond.speaker_emb,
                 cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
+                cond_prompt_speech_emb=_cond.cond_prompt_speech_emb,
                 emotion_adv=exaggeration * torch.ones(1, 1, 1),
             ).to(device=self.device)
 
+    def _tokenize(self, text, cfg_weight):
+        "Text tokens of `text` (two rows for CFG if `cfg_weight` > 0)"
         # Norm and tokenize text
         text = punc_norm(text)
         text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
@@ -241,32 +338,153 @@ class ChatterboxTTS:
         eot = self.t3.hp.stop_text_token
         text_tokens = F.pad(text_tokens, (1, 0), value=sot)
         text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return text_tokens
 
-        with torch.inference_mode():
+    def generate(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+    ):
+        text_tokens = self._prepare_inputs(text, audio_prompt_path, exaggeration, cfg_weight)
+        speech_tokens = self._generate_speech_tokens(
+            text_tokens,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+            cfg_weight=cfg_weight,
+            temperature=temperature,
+        )
+        return self._watermark(self._render(speech_tokens))
+
+    @torch.inference_mode()
+    def _generate_speech_tokens(self, text_tokens, repetition_penalty, min_p, top_p, cfg_weight, temperature):
+        "T3 stage of `generate`: text tokens -> valid speech tokens of the conditional row (1D)"
+        if self.t3_scheduler is not None:
+            speech_tokens = self.t3_scheduler.submit(
+                self.conds.t3,
+                text_tokens,
+                max_new_tokens=1000,
+                temperature=temperature,
+                cfg_weight=cfg_weight,
+                cfg_max_tokens=self.t3_cfg_window.get("cfg_max_tokens"),
+                use_token_budget=self.t3_token_budget,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
+            ).result()
+        else:
             speech_tokens = self.t3.inference(
                 t3_cond=self.conds.t3,
                 text_tokens=text_tokens,
                 max_new_tokens=1000,  # TODO: use the value in config
                 temperature=temperature,
                 cfg_weight=cfg_weight,
+                **self.t3_cfg_window,
+                use_token_budget=self.t3_token_budget,
+                drafter=self.t3_drafter,
                 repetition_penalty=repetition_penalty,
                 min_p=min_p,
                 top_p=top_p,
             )
-            # Extract only the conditional batch.
-            speech_tokens = speech_tokens[0]
+        # Extract only the conditional batch.
+        speech_tokens = speech_tokens[0]
+
+        # TODO: output becomes 1D
+        speech_tokens = drop_invalid_tokens(speech_tokens)
 
-            # TODO: output becomes 1D
-            speech_tokens = drop_invalid_tokens(speech_tokens)
-            
-            speech_tokens = speech_tokens[speech_tokens < 6561]
+        speech_tokens = speech_tokens[speech_tokens < 6561]
 
-            speech_tokens = speech_tokens.to(self.device)
+        return speech_tokens.to(self.device)
 
-            wav, _ = self.s3gen.inference(
-                speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
+    @torch.inference_mode()
+    def _render(self, speech_tokens):
+        "S3Gen/HiFT stage of `generate`: speech tokens -> (1, n_samples) waveform, not watermarked"
+        wav, _ = self.s3gen.inference(
+            speech_tokens=speech_tokens,
+            ref_dict=self.conds.gen,
+        )
+        return wav.detach().cpu()
+
+    def generate_long(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        max_chars=300,
+        crossfade_ms=50,
+    ):
+        """
+        `generate` for text of any length: the text is split into chunks of whole sentences (at most `max_chars`
+        each), T3 decodes the next chunk while S3Gen/HiFT render the current one, and the chunks are joined with
+        `crossfade_ms` crossfades.
+        """
+        self._prepare_conds(audio_prompt_path, exaggeration)
+
+        def generate_tokens(chunk):
+            return self._generate_speech_tokens(
+                self._tokenize(chunk, cfg_weight),
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
+                cfg_weight=cfg_weight,
+                temperature=temperature,
             )
-            wav = wav.squeeze(0).detach().cpu().numpy()
-            watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
+
+        chunks = split_sentences(text, max_chars=max_chars)
+        wavs = pipelined_synthesis(chunks, generate_tokens, self._render)
+        wav = crossfade_concat(wavs, int(crossfade_ms * self.sr / 1000))
+        return self._watermark(wav)
+
+    def generate_stream(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        chunk_size=25,
+    ):
+        """
+        Same as `generate`, but yields watermarked (1, n_samples) audio chunks while T3 is still decoding.
+        `chunk_size` is the number of speech tokens (25 per second of audio) synthesized per chunk.
+        """
+        text_tokens = self._prepare_inputs(text, audio_prompt_path, exaggeration, cfg_weight)
+        streamer = S3GenStreamer(self.s3gen, self.conds.gen, chunk_size=chunk_size)
+
+        with torch.inference_mode():
+            for speech_token in self.t3.inference_stream(
+                t3_cond=self.conds.t3,
+                text_tokens=text_tokens,
+                max_new_tokens=1000,  # TODO: use the value in config
+                temperature=temperature,
+                cfg_weight=cfg_weight,
+                **self.t3_cfg_window,
+                use_token_budget=self.t3_token_budget,
+                drafter=self.t3_drafter,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
+            ):
+                wav = streamer.push(speech_token)
+                if wav is not None:
+                    yield self._watermark(wav)
+            yield self._watermark(streamer.flush())
+
+    def _watermark(self, wav):
+        wav = wav.squeeze(0).detach().cpu().numpy()
+        watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
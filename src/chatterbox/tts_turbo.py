@@ -13,13 +13,18 @@ from huggingface_hub import snapshot_download
 from transformers import AutoTokenizer
 
 from .models.t3 import T3
+from .models.t3.quantization import quantize_t3, load_quantized_t3
 from .models.s3tokenizer import S3_SR
-from .models.s3gen import S3GEN_SR, S3Gen
+from .models.utils import apply_precision
+from .models.s3gen import S3GEN_SR, S3Gen, S3GenStreamer
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
 from .models.t3.modules.t3_config import T3Config
 from .models.s3gen.const import S3GEN_SIL
+from .conds_cache import ConditionalsCache
+from .voice_library import VoiceLibrary
+from .longform import split_sentences, pipelined_synthesis, crossfade_concat
 import logging
 logger = logging.getLogger(__name__)
 
@@ -128,9 +133,17 @@ class ChatterboxTurboTTS:
         self.device = device
         self.conds = conds
         self.watermarker = perth.PerthImplicitWatermarker()
+        self.conds_cache = ConditionalsCache()
+        self.t3_token_budget = False  # see `enable_token_budget`
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxTurboTTS':
+    def from_local(cls, ckpt_dir, device, t3_quantization=None, precision="fp32") -> 'ChatterboxTurboTTS':
+        """
+        With `t3_quantization` ("dynamic" or "weight_only", see `models.t3.quantization`) T3 runs with int8 weights,
+        loaded from `t3_turbo_v1_int8.safetensors` when present (written by `save_quantized_t3`), else quantized on load.
+        `precision` ("fp32", "bf16" or "fp16") is the precision policy of T3 and the S3Gen CFM estimator, see
+        `models.utils.apply_precision`.
+        """
         ckpt_dir = Path(ckpt_dir)
 
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -148,6 +161,7 @@ class ChatterboxTurboTTS:
         # Turbo specific hp
         hp = T3Config(text_tokens_dict_size=50276)
         hp.llama_config_name = "GPT2_medium"
+        hp.speech_tokens_per_text_token = 20.0  # (GPT-2 BPE tokens are ~4 characters)
         hp.speech_tokens_dict_size = 6563
         hp.input_pos_emb = None
         hp.speech_cond_prompt_len = 375
@@ -155,11 +169,17 @@ class ChatterboxTurboTTS:
         hp.emotion_adv = False
 
         t3 = T3(hp)
-        t3_state = load_file(ckpt_dir / "t3_turbo_v1.safetensors")
-        if "model" in t3_state.keys():
-            t3_state = t3_state["model"][0]
-        t3.load_state_dict(t3_state)
-        del t3.tfmr.wte
+        if t3_quantization is not None and (ckpt_dir / "t3_turbo_v1_int8.safetensors").exists():
+            del t3.tfmr.wte
+            load_quantized_t3(t3, ckpt_dir / "t3_turbo_v1_int8.safetensors", mode=t3_quantization)
+        else:
+            t3_state = load_file(ckpt_dir / "t3_turbo_v1.safetensors")
+            if "model" in t3_state.keys():
+                t3_state = t3_state["model"][0]
+            t3.load_state_dict(t3_state)
+            del t3.tfmr.wte
+            if t3_quantization is not None:
+                quantize_t3(t3, mode=t3_quantization)
         t3.to(device).eval()
 
         s3gen = S3Gen(meanflow=True)
@@ -180,10 +200,12 @@ class ChatterboxTurboTTS:
         if builtin_voice.exists():
             conds = Conditionals.load(builtin_voice, map_location=map_location).to(device)
 
+        apply_precision(precision, t3=t3, s3gen=s3gen)
+
         return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxTurboTTS':
+    def from_pretrained(cls, device, t3_quantization=None, precision="fp32") -> 'ChatterboxTurboTTS':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -199,9 +221,10 @@ class ChatterboxTurboTTS:
             allow_patterns=["*.safetensors", "*.json", "*.txt", "*.pt", "*.model"]
         )
 
-        return cls.from_local(local_path, device)
+        return cls.from_local(local_path, device, t3_quantization=t3_quantization, precision=precision)
 
-    def norm_loudness(self, wav, sr, target_lufs=-27):
+    @staticmethod
+    def norm_loudness(wav, sr, target_lufs=-27):
         try:
             meter = ln.Meter(sr)
             loudness = meter.integrated_loudness(wav)
@@ -214,7 +237,49 @@ class ChatterboxTurboTTS:
 
         return wav
 
+    def set_alignment_heads(self, heads):
+        """
+        Enable the alignment analyzer for T3 (early stopping of hallucinated tails and repetitions) with these
+        (layer, head) pairs, eg from `T3.find_alignment_heads`; None disables it again.
+        """
+        self.t3.hp.alignment_heads = None if heads is None else [tuple(h) for h in heads]
+        return self
+
+    def enable_token_budget(self, enabled=True):
+        """
+        Cap the speech tokens of every T3 generation by `T3.speech_token_budget` of its text, so runaway generations
+        (hallucinated long tails) stop early. Off by default: it changes the length of the generations that would
+        run past the budget.
+        """
+        self.t3_token_budget = enabled
+        return self
+
+    def enable_conds_cache(self, cache_dir=None, max_entries=32):
+        """
+        Replace the in-memory cache of voice conditionals used by `prepare_conditionals`; with `cache_dir` the
+        entries are also saved there and reused by later processes.
+        """
+        self.conds_cache = ConditionalsCache(max_entries=max_entries, cache_dir=cache_dir)
+        return self
+
+    def use_voice(self, library: VoiceLibrary, voice_id: str):
+        """
+        Use a pre-enrolled voice from `library` (a `VoiceLibrary`, or a `VoicePool` in front of one) instead of
+        `prepare_conditionals`.
+        """
+        self.conds = library.get(voice_id, Conditionals, self.device)
+        return self
+
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5, norm_loudness=True):
+        key = None
+        if self.conds_cache is not None:
+            key = ConditionalsCache.key(wav_fpath, "turbo", norm_loudness, self.ENC_COND_LEN, self.DEC_COND_LEN)
+            conds = self.conds_cache.get(key, Conditionals, self.device)
+            if conds is not None:
+                conds.t3.emotion_adv = exaggeration * torch.ones(1, 1, 1, device=self.device)
+                self.conds = conds
+                return
+
         ## Load and norm reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
@@ -244,6 +309,30 @@ class ChatterboxTurboTTS:
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
         self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        if key is not None:
+            self.conds_cache.put(key, self.conds)
+
+    def _prepare_inputs(self, text, audio_prompt_path, exaggeration, cfg_weight, min_p, norm_loudness):
+        "Set up the conditionals and return the text tokens for `generate` / `generate_stream`"
+        self._prepare_conds(audio_prompt_path, exaggeration, cfg_weight, min_p, norm_loudness)
+        return self._tokenize(text)
+
+    def _prepare_conds(self, audio_prompt_path, exaggeration, cfg_weight, min_p, norm_loudness):
+        "Set up the conditionals (once per call, not per `generate_long` chunk)"
+        if audio_prompt_path:
+            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration, norm_loudness=norm_loudness)
+        else:
+            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+
+        if cfg_weight > 0.0 or exaggeration > 0.0 or min_p > 0.0:
+            logger.warning("CFG, min_p and exaggeration are not supported by Turbo version and will be ignored.")
+
+    def _tokenize(self, text):
+        "Text tokens of `text`"
+        # Norm and tokenize text
+        text = punc_norm(text)
+        text_tokens = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True)
+        return text_tokens.input_ids.to(self.device)
 
     def generate(
         self,
@@ -258,19 +347,18 @@ class ChatterboxTurboTTS:
         top_k=1000,
         norm_loudness=True,
     ):
-        if audio_prompt_path:
-            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration, norm_loudness=norm_loudness)
-        else:
-            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
-
-        if cfg_weight > 0.0 or exaggeration > 0.0 or min_p > 0.0:
-            logger.warning("CFG, min_p and exaggeration are not supported by Turbo version and will be ignored.")
-
-        # Norm and tokenize text
-        text = punc_norm(text)
-        text_tokens = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True)
-        text_tokens = text_tokens.input_ids.to(self.device)
+        text_tokens = self._prepare_inputs(text, audio_prompt_path, exaggeration, cfg_weight, min_p, norm_loudness)
+        speech_tokens = self._generate_speech_tokens(
+            text_tokens,
+            repetition_penalty=repetition_penalty,
+            top_p=top_p,
+            temperature=temperature,
+            top_k=top_k,
+        )
+        return self._watermark(self._render(speech_tokens))
 
+    def _generate_speech_tokens(self, text_tokens, repetition_penalty, top_p, temperature, top_k):
+        "T3 stage of `generate`: text tokens -> valid speech tokens (1D)"
         speech_tokens = self.t3.inference_turbo(
             t3_cond=self.conds.t3,
             text_tokens=text_tokens,
@@ -278,11 +366,17 @@ class ChatterboxTurboTTS:
             top_k=top_k,
             top_p=top_p,
             repetition_penalty=repetition_penalty,
+            use_token_budget=self.t3_token_budget,
         )
 
-        # Remove OOV tokens and add silence to end
+        # Remove OOV tokens
         speech_tokens = speech_tokens[speech_tokens < 6561]
-        speech_tokens = speech_tokens.to(self.device)
+        return speech_tokens.to(self.device)
+
+    @torch.inference_mode()
+    def _render(self, speech_tokens):
+        "S3Gen/HiFT stage of `generate`: speech tokens -> (1, n_samples) waveform, not watermarked"
+        # Add silence to end
         silence = torch.tensor([S3GEN_SIL, S3GEN_SIL, S3GEN_SIL]).long().to(self.device)
         speech_tokens = torch.cat([speech_tokens, silence])
 
@@ -291,6 +385,84 @@ class ChatterboxTurboTTS:
             ref_dict=self.conds.gen,
             n_cfm_timesteps=2,
         )
+        return wav.detach().cpu()
+
+    def generate_long(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.00,
+        top_p=0.95,
+        audio_prompt_path=None,
+        exaggeration=0.0,
+        cfg_weight=0.0,
+        temperature=0.8,
+        top_k=1000,
+        norm_loudness=True,
+        max_chars=300,
+        crossfade_ms=50,
+    ):
+        """
+        `generate` for text of any length: the text is split into chunks of whole sentences (at most `max_chars`
+        each), T3 decodes the next chunk while S3Gen/HiFT render the current one, and the chunks are joined with
+        `crossfade_ms` crossfades.
+        """
+        self._prepare_conds(audio_prompt_path, exaggeration, cfg_weight, min_p, norm_loudness)
+
+        def generate_tokens(chunk):
+            return self._generate_speech_tokens(
+                self._tokenize(chunk),
+                repetition_penalty=repetition_penalty,
+                top_p=top_p,
+                temperature=temperature,
+                top_k=top_k,
+            )
+
+        chunks = split_sentences(text, max_chars=max_chars)
+        wavs = pipelined_synthesis(chunks, generate_tokens, self._render)
+        wav = crossfade_concat(wavs, int(crossfade_ms * self.sr / 1000))
+        return self._watermark(wav)
+
+    def generate_stream(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.00,
+        top_p=0.95,
+        audio_prompt_path=None,
+        exaggeration=0.0,
+        cfg_weight=0.0,
+        temperature=0.8,
+        top_k=1000,
+        norm_loudness=True,
+        chunk_size=25,
+    ):
+        """
+        Same as `generate`, but yields watermarked (1, n_samples) audio chunks while T3 is still decoding.
+        `chunk_size` is the number of speech tokens (25 per second of audio) synthesized per chunk.
+        """
+        text_tokens = self._prepare_inputs(text, audio_prompt_path, exaggeration, cfg_weight, min_p, norm_loudness)
+        streamer = S3GenStreamer(self.s3gen, self.conds.gen, chunk_size=chunk_size, n_cfm_timesteps=2)
+
+        with torch.inference_mode():
+            for speech_token in self.t3.inference_turbo_stream(
+                t3_cond=self.conds.t3,
+                text_tokens=text_tokens,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                use_token_budget=self.t3_token_budget,
+            ):
+                wav = streamer.push(speech_token)
+                if wav is not None:
+                    yield self._watermark(wav)
+
+            # Add silence to end
+            silence = torch.tensor([S3GEN_SIL, S3GEN_SIL, S3GEN_SIL]).long().to(self.device)
+            yield self._watermark(streamer.flush(silence))
+
+    def _watermark(self, wav):
         wav = wav.squeeze(0).detach().cpu().numpy()
         watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
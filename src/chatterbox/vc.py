@@ -7,6 +7,7 @@ from huggingface_hub import hf_hub_download
 from safetensors.torch import load_file
 
 from .models.s3tokenizer import S3_SR
+from .models.utils import apply_precision
 from .models.s3gen import S3GEN_SR, S3Gen
 
 
@@ -36,7 +37,11 @@ class ChatterboxVC:
             }
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxVC':
+    def from_local(cls, ckpt_dir, device, precision="fp32") -> 'ChatterboxVC':
+        """
+        `precision` ("fp32", "bf16" or "fp16") is the precision of the S3Gen CFM estimator, see
+        `models.utils.apply_precision`.
+        """
         ckpt_dir = Path(ckpt_dir)
         
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -56,10 +61,12 @@ class ChatterboxVC:
         )
         s3gen.to(device).eval()
 
+        apply_precision(precision, s3gen=s3gen)
+
         return cls(s3gen, device, ref_dict=ref_dict)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxVC':
+    def from_pretrained(cls, device, precision="fp32") -> 'ChatterboxVC':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -71,7 +78,7 @@ class ChatterboxVC:
         for fpath in ["s3gen.safetensors", "conds.pt"]:
             local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
 
-        return cls.from_local(Path(local_path).parent, device)
+        return cls.from_local(Path(local_path).parent, device, precision=precision)
 
     def set_target_voice(self, wav_fpath):
         ## Load reference wav
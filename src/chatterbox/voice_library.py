@@ -0,0 +1,189 @@
+"""
+Packed, memory-mapped library of pre-enrolled voices.
+
+Layout (little endian):
+
+    header   MAGIC, version (u32), id_bytes (u32), n_voices (u64), index_offset (u64)
+    entries  per voice: header length (u32), JSON header, then the tensor bytes, each aligned to `ALIGN`
+    index    n_voices records of (voice id, utf-8 and NUL-padded to `id_bytes`; entry offset u64; entry length u64),
+             sorted by id
+
+Opening a library only maps the file, and a voice is found by binary search over the index, so startup time and
+RSS don't depend on the number of voices. Tensors are views of the (copy-on-write) mapping: a voice materializes
+without copying, and only the pages of voices actually used are ever read.
+"""
+import json
+import mmap
+import struct
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Tuple
+
+import torch
+
+from .models.t3.modules.cond_enc import T3Cond
+
+
+MAGIC = b"CBVOICE\x00"
+VERSION = 1
+ALIGN = 64
+_HEADER = struct.Struct("<8sIIQQ")
+_ENTRY_HEADER_LEN = struct.Struct("<I")
+
+_DTYPES = {
+    str(dtype): dtype
+    for dtype in (torch.float32, torch.float16, torch.bfloat16, torch.float64, torch.int64, torch.int32, torch.int16,
+                  torch.uint8, torch.bool)
+}
+
+
+def _pad(n: int) -> int:
+    return -n % ALIGN
+
+
+def _encode_entry(conds) -> bytes:
+    meta = {}
+    blobs = []
+    offset = 0
+    for group, fields in (("t3", conds.t3.__dict__), ("gen", conds.gen)):
+        meta[group] = {}
+        for name, x in fields.items():
+            if not torch.is_tensor(x):
+                meta[group][name] = None if x is None else float(x)  # eg a scalar `emotion_adv`
+                continue
+            x = x.detach().cpu().contiguous()
+            assert str(x.dtype) in _DTYPES, f"{group}.{name}: unsupported dtype {x.dtype}"
+            data = x.reshape(-1).view(torch.uint8).numpy().tobytes()
+            meta[group][name] = [str(x.dtype), list(x.shape), offset]
+            blobs.append(data + b"\x00" * _pad(len(data)))
+            offset += len(blobs[-1])
+
+    header = json.dumps(meta, separators=(",", ":")).encode()
+    header_len = _ENTRY_HEADER_LEN.size + len(header)
+    header += b" " * _pad(header_len)  # keep the tensor data aligned
+    return _ENTRY_HEADER_LEN.pack(len(header)) + header + b"".join(blobs)
+
+
+class VoiceLibrary:
+    """
+    Read-only, memory-mapped voice library; see the module docstring for the format and `write` to build one.
+
+        library = VoiceLibrary("voices.cbvl")
+        model.conds = library.get("customer-123", Conditionals, model.device)
+    """
+
+    def __init__(self, fpath):
+        self.fpath = Path(fpath)
+        with open(self.fpath, "rb") as f:
+            # ACCESS_COPY: writable (so `torch.frombuffer` can wrap it) but private, the file is never modified
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, version, self.id_bytes, self.n_voices, self.index_offset = _HEADER.unpack_from(self._mmap, 0)
+        assert magic == MAGIC, f"{fpath} is not a voice library"
+        assert version == VERSION, f"{fpath}: unsupported voice library version {version}"
+        self._record = struct.Struct(f"<{self.id_bytes}sQQ")
+
+    def __len__(self):
+        return self.n_voices
+
+    def __contains__(self, voice_id):
+        return self._find(voice_id) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self.n_voices):
+            yield self._read_record(i)[0].rstrip(b"\x00").decode()
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, voice_id: str, conds_cls, device=None):
+        """
+        The voice as a `conds_cls` (the `Conditionals` class of the model it will be used with). The tensors are
+        views of the mapped file unless `device` asks for a move.
+        """
+        entry = self._find(voice_id)
+        if entry is None:
+            raise KeyError(voice_id)
+        offset, _ = entry
+        (header_len,) = _ENTRY_HEADER_LEN.unpack_from(self._mmap, offset)
+        start = offset + _ENTRY_HEADER_LEN.size
+        meta = json.loads(bytes(self._mmap[start:start + header_len]))
+        data_offset = start + header_len
+
+        groups = {}
+        for group, fields in meta.items():
+            groups[group] = {}
+            for name, spec in fields.items():
+                if not isinstance(spec, list):
+                    groups[group][name] = spec
+                    continue
+                dtype, shape, rel = spec
+                dtype = _DTYPES[dtype]
+                count = 1
+                for n in shape:
+                    count *= n
+                x = torch.frombuffer(self._mmap, dtype=dtype, count=count, offset=data_offset + rel) if count else \
+                    torch.empty(0, dtype=dtype)
+                groups[group][name] = x.view(shape)
+
+        conds = conds_cls(T3Cond(**groups["t3"]), groups["gen"])
+        return conds.to(device) if device is not None else conds
+
+    def _read_record(self, i) -> Tuple[bytes, int, int]:
+        return self._record.unpack_from(self._mmap, self.index_offset + i * self._record.size)
+
+    def _find(self, voice_id) -> Optional[Tuple[int, int]]:
+        key = voice_id.encode().ljust(self.id_bytes, b"\x00")
+        if len(key) != self.id_bytes:
+            return None
+        lo, hi = 0, self.n_voices
+        while lo < hi:
+            mid = (lo + hi) // 2
+            rec_id, offset, length = self._read_record(mid)
+            if rec_id == key:
+                return offset, length
+            if rec_id < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    @staticmethod
+    def write(fpath, voices: Iterable[Tuple[str, object]], t3=None, id_bytes: int = 64):
+        """
+        Write `(voice_id, conditionals)` pairs (eg from `Conditionals.load` of `conds.pt` files; any iterable, so
+        voices can be loaded one at a time) to a new library at `fpath`.
+
+        With `t3`, the prompt speech token embeddings (`T3Cond.cond_prompt_speech_emb`) are precomputed and stored
+        too; they are specific to that model, so only use the library with it.
+        """
+        index = []
+        with open(fpath, "wb") as f:
+            f.write(b"\x00" * _HEADER.size)
+            f.write(b"\x00" * _pad(_HEADER.size))
+            for voice_id, conds in voices:
+                key = voice_id.encode()
+                assert 0 < len(key) <= id_bytes and b"\x00" not in key, f"invalid voice id {voice_id!r}"
+                if t3 is not None and conds.t3.cond_prompt_speech_tokens is not None:
+                    t3_cond = T3Cond(**conds.t3.__dict__)
+                    t3_cond.cond_prompt_speech_emb = None
+                    with torch.inference_mode():
+                        t3.prepare_conditioning(t3_cond.to(device=t3.device))
+                    conds = type(conds)(t3_cond, conds.gen)
+                data = _encode_entry(conds)
+                index.append((key.ljust(id_bytes, b"\x00"), f.tell(), len(data)))
+                f.write(data)
+
+            index.sort()
+            for (key, _, _), (next_key, _, _) in zip(index, index[1:]):
+                assert key != next_key, f"duplicate voice id {key.rstrip(bytes(1)).decode()!r}"
+            index_offset = f.tell()
+            record = struct.Struct(f"<{id_bytes}sQQ")
+            for entry in index:
+                f.write(record.pack(*entry))
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, VERSION, id_bytes, len(index), index_offset))
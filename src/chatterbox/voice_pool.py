@@ -0,0 +1,131 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+from .models.t3.modules.cond_enc import T3Cond
+
+
+logger = logging.getLogger(__name__)
+
+
+def _tensors(conds):
+    for x in list(conds.t3.__dict__.values()) + list(conds.gen.values()):
+        if torch.is_tensor(x):
+            yield x
+
+
+def conds_nbytes(conds) -> int:
+    return sum(x.numel() * x.element_size() for x in _tensors(conds))
+
+
+class VoicePool:
+    """
+    Voice conditionals kept resident on the inference device, up to `max_bytes`, in front of a slower `source`
+    (anything with `get(voice_id, conds_cls)`, eg a `VoiceLibrary`).
+
+    A hit costs nothing: the resident tensors are shared. On a miss the voice is staged through pinned host memory
+    (on CUDA) so its upload is asynchronous, and with `t3` the prompt speech token embeddings are derived once and
+    kept with it. Least recently used voices are evicted when over budget. Usable wherever a `VoiceLibrary` is,
+    eg `model.use_voice(pool, voice_id)`.
+    """
+
+    def __init__(self, source, device, max_bytes: int = 256 * 2**20, t3=None):
+        self.source = source
+        self.device = torch.device(device)
+        self.max_bytes = max_bytes
+        self.t3 = t3
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # voice_id -> (conds, nbytes), oldest first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, voice_id):
+        return voice_id in self._entries
+
+    @property
+    def stats(self):
+        return dict(
+            hits=self.hits, misses=self.misses, evictions=self.evictions, voices=len(self._entries),
+            nbytes=self.nbytes, max_bytes=self.max_bytes,
+        )
+
+    def get(self, voice_id, conds_cls, device=None):
+        "The voice as a `conds_cls` on the pool's device (`device`, if given, must be that device)."
+        assert device is None or torch.device(device) == self.device, f"this pool is on {self.device}"
+        with self._lock:
+            entry = self._entries.get(voice_id)
+            if entry is not None:
+                self._entries.move_to_end(voice_id)
+                self.hits += 1
+        if entry is None:
+            conds = self._load(voice_id, conds_cls)
+            with self._lock:
+                self.misses += 1
+                entry = self._insert(voice_id, conds)
+        return self._copy(entry[0], conds_cls)
+
+    def put(self, voice_id, conds):
+        "Make `conds` (eg from `prepare_conditionals`) resident as `voice_id`."
+        conds = self._to_device(self._copy(conds, type(conds)))
+        with self._lock:
+            self._insert(voice_id, conds)
+
+    def evict(self, voice_id):
+        with self._lock:
+            entry = self._entries.pop(voice_id, None)
+            if entry is not None:
+                self.nbytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _load(self, voice_id, conds_cls):
+        conds = self._to_device(self.source.get(voice_id, conds_cls))
+        if self.t3 is not None and conds.t3.cond_prompt_speech_tokens is not None \
+                and conds.t3.cond_prompt_speech_emb is None:
+            with torch.inference_mode():
+                self.t3.prepare_conditioning(conds.t3)
+        return conds
+
+    def _to_device(self, conds):
+        pin = self.device.type == "cuda"
+
+        def move(x):
+            if not torch.is_tensor(x) or x.device == self.device:
+                return x
+            if pin and x.device.type == "cpu":
+                x = x.pin_memory()
+            return x.to(self.device, non_blocking=pin)
+
+        conds.t3 = T3Cond(**{k: move(v) for k, v in conds.t3.__dict__.items()})
+        conds.gen = {k: move(v) for k, v in conds.gen.items()}
+        return conds
+
+    def _insert(self, voice_id, conds):
+        # (under the lock)
+        old = self._entries.pop(voice_id, None)
+        if old is not None:
+            self.nbytes -= old[1]
+        entry = (conds, conds_nbytes(conds))
+        self._entries[voice_id] = entry
+        self.nbytes += entry[1]
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            evicted_id, (_, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+            logger.debug(f"evicted voice {evicted_id} ({nbytes} bytes)")
+        return entry
+
+    @staticmethod
+    def _copy(conds, conds_cls):
+        # New containers sharing the resident tensors, so callers replacing fields don't touch the pool
+        return conds_cls(T3Cond(**conds.t3.__dict__), dict(conds.gen))
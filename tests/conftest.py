@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.llama_configs import LLAMA_CONFIGS, LLAMA_520M_CONFIG_DICT, GPT2_MEDIUM_CONFIG
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.modules.t3_config import T3Config
+
+
+# Randomly initialised T3 models with the real vocabularies and widths but fewer / thinner layers, so a test decodes in
+# seconds on the CPU (the alignment analyzer reads layer 9, hence 14 Llama layers).
+TINY_LLAMA = dict(LLAMA_520M_CONFIG_DICT, num_hidden_layers=14, intermediate_size=256, torch_dtype="float32")
+TINY_GPT2 = dict(GPT2_MEDIUM_CONFIG, n_layer=3)
+
+
+def make_t3(gpt=False, seed=0) -> T3:
+    hp = T3Config.english_only()
+    if gpt:
+        hp.llama_config_name = "GPT2_medium"
+        hp.input_pos_emb = None
+        hp.speech_cond_prompt_len = 375
+        hp.use_perceiver_resampler = False
+        hp.emotion_adv = False
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setitem(LLAMA_CONFIGS, hp.llama_config_name, TINY_GPT2 if gpt else TINY_LLAMA)
+        torch.manual_seed(seed)
+        return T3(hp).eval()
+
+
+def make_cond(t3: T3, seed=1) -> T3Cond:
+    g = torch.Generator().manual_seed(seed)
+    return T3Cond(
+        speaker_emb=torch.randn(1, 256, generator=g),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, t3.hp.speech_cond_prompt_len), generator=g),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+
+
+def make_text(t3: T3, n=12, seed=2, cfg=True):
+    "Random text tokens between SOT and EOT, duplicated for CFG like `ChatterboxTTS.generate` does"
+    g = torch.Generator().manual_seed(seed)
+    text = torch.randint(1, 200, (1, n), generator=g)
+    text = torch.cat([torch.tensor([[t3.hp.start_text_token]]), text, torch.tensor([[t3.hp.stop_text_token]])], 1)
+    return torch.cat([text, text]) if cfg else text
+
+
+@pytest.fixture(scope="session")
+def t3():
+    return make_t3()
+
+
+@pytest.fixture(scope="session")
+def t3_turbo():
+    return make_t3(gpt=True)
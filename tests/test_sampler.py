@@ -0,0 +1,125 @@
+import pytest
+import torch
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    MinPLogitsWarper,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from chatterbox.models.t3.inference.sampler import SpeechTokenSampler
+
+from conftest import make_cond, make_text
+
+
+B, V = 4, 8194  # (speech vocab of T3)
+
+
+def _logits(seed=0, scale=3.0):
+    return scale * torch.randn(B, V, generator=torch.Generator().manual_seed(seed))
+
+
+def _history(seed=1, n=50):
+    return torch.randint(0, V, (B, n), generator=torch.Generator().manual_seed(seed))
+
+
+def _sampler(history, **kwargs):
+    sampler = SpeechTokenSampler(B, V, **kwargs)
+    sampler.update(history)
+    return sampler
+
+
+def _assert_same_distribution(sampler, logits, hf_logits):
+    torch.testing.assert_close(sampler.probs(logits), torch.softmax(hf_logits, dim=-1), rtol=1e-5, atol=1e-7)
+
+
+@pytest.mark.parametrize(
+    "kwargs, processor",
+    [
+        (dict(repetition_penalty=1.3), RepetitionPenaltyLogitsProcessor(1.3)),
+        (dict(temperature=0.7), TemperatureLogitsWarper(0.7)),
+        (dict(top_k=100), TopKLogitsWarper(100)),
+        (dict(min_p=0.05), MinPLogitsWarper(0.05)),
+        (dict(top_p=0.8), TopPLogitsWarper(0.8)),
+    ],
+    ids=["repetition_penalty", "temperature", "top_k", "min_p", "top_p"],
+)
+def test_stage_matches_hf_processor(kwargs, processor):
+    logits, history = _logits(), _history()
+    _assert_same_distribution(_sampler(history, **kwargs), logits, processor(history, logits.clone()))
+
+
+def test_per_row_parameters_match_hf_processors():
+    logits, history = _logits(), _history()
+    top_p = [0.5, 0.8, 0.95, 1.0]
+    sampler = _sampler(history, top_p=top_p)
+    hf_logits = torch.cat([
+        TopPLogitsWarper(p)(history[i:i + 1], logits[i:i + 1].clone()) if p < 1.0 else logits[i:i + 1]
+        for i, p in enumerate(top_p)
+    ])
+    _assert_same_distribution(sampler, logits, hf_logits)
+
+
+def test_draw_is_from_the_filtered_distribution():
+    logits, history = _logits(), _history()
+    sampler = _sampler(history, top_p=0.5, min_p=0.05)
+    allowed = sampler.probs(logits) > 0
+    for _ in range(20):
+        tokens = sampler(logits, update=False)
+        assert allowed.gather(1, tokens).all()
+
+
+@pytest.fixture
+def sampled(monkeypatch):
+    "Records, for every draw, the logits the sampler gets and the distribution it draws from"
+    records = []
+    draw = SpeechTokenSampler.__call__
+
+    def spy(self, logits, uncond_logits=None, update=True):
+        records.append((logits.clone(), self.probs(logits, uncond_logits)))
+        return draw(self, logits, uncond_logits, update)
+
+    monkeypatch.setattr(SpeechTokenSampler, "__call__", spy)
+    return records
+
+
+def test_t3_sampling_matches_baseline_chain(t3, sampled):
+    kwargs = dict(temperature=0.7, top_p=0.8, min_p=0.02, repetition_penalty=1.5)
+    tokens = torch.cat(list(t3.inference_stream(
+        t3_cond=make_cond(t3), text_tokens=make_text(t3), max_new_tokens=20, cfg_weight=0.5, **kwargs,
+    )), dim=1)
+
+    # the chain `T3.inference` used to run on the CFG-combined logits, penalizing the generated ids and BOS
+    penalty = RepetitionPenaltyLogitsProcessor(kwargs["repetition_penalty"])
+    min_p, top_p = MinPLogitsWarper(kwargs["min_p"]), TopPLogitsWarper(kwargs["top_p"])
+    bos = torch.tensor([[t3.hp.start_speech_token]])
+    assert len(sampled) == tokens.size(1)
+    for i, (logits, probs) in enumerate(sampled):
+        generated_ids = torch.cat([bos, tokens[:, :i]], dim=1)
+        hf_logits = penalty(generated_ids, logits.clone()) / kwargs["temperature"]
+        hf_logits = top_p(generated_ids, min_p(generated_ids, hf_logits))
+        torch.testing.assert_close(probs, torch.softmax(hf_logits, dim=-1), rtol=1e-5, atol=1e-7)
+
+
+def test_turbo_sampling_matches_baseline_chain(t3_turbo, sampled):
+    kwargs = dict(temperature=0.7, top_k=200, top_p=0.8, repetition_penalty=1.5)
+    tokens = torch.cat(list(t3_turbo.inference_turbo_stream(
+        make_cond(t3_turbo), make_text(t3_turbo, cfg=False), max_gen_len=20, **kwargs,
+    )), dim=1)
+
+    # the chain `T3.inference_turbo` used to run: the penalty last, on BOS for the first token and then on the
+    # generated ids only
+    processors = LogitsProcessorList([
+        TemperatureLogitsWarper(kwargs["temperature"]),
+        TopKLogitsWarper(kwargs["top_k"]),
+        TopPLogitsWarper(kwargs["top_p"]),
+        RepetitionPenaltyLogitsProcessor(kwargs["repetition_penalty"]),
+    ])
+    bos = torch.tensor([[t3_turbo.hp.start_speech_token]])
+    assert len(sampled) == tokens.size(1)
+    for i, (logits, probs) in enumerate(sampled):
+        input_ids = bos if i == 0 else tokens[:, :i]
+        hf_logits = processors(input_ids, logits.clone())
+        torch.testing.assert_close(probs, torch.softmax(hf_logits, dim=-1), rtol=1e-5, atol=1e-7)
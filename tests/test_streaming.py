@@ -0,0 +1,22 @@
+import pytest
+import torch
+
+from chatterbox.models.s3gen import S3Gen, compare_streaming
+from chatterbox.models.s3gen.streamer import STREAMING_MEL_TOLERANCE
+
+
+@pytest.fixture(scope="module")
+def s3gen():
+    torch.manual_seed(0)
+    s3gen = S3Gen().eval()
+    with torch.inference_mode():
+        ref_dict = s3gen.embed_ref(torch.randn(1, 24000 * 2) * 0.1, 24000)
+    return s3gen, ref_dict
+
+
+@pytest.mark.parametrize("chunk_size", [25, 7])
+def test_streamed_mels_match_offline(s3gen, chunk_size):
+    s3gen, ref_dict = s3gen
+    speech_tokens = torch.randint(0, 6561, (1, 40), generator=torch.Generator().manual_seed(1))
+    stats = compare_streaming(s3gen, speech_tokens, ref_dict, chunk_size=chunk_size)
+    assert stats["rel_l2"] < STREAMING_MEL_TOLERANCE
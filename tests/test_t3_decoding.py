@@ -0,0 +1,74 @@
+import torch
+from transformers import DynamicCache
+
+from chatterbox.models.t3.inference.batch_scheduler import T3BatchScheduler
+from chatterbox.models.t3.inference.kv_cache import StaticKVCache, gpt2_forward
+
+from conftest import make_cond, make_text
+
+
+# top_p this small keeps only the most likely token: greedy decoding through the regular sampling path
+GREEDY = dict(temperature=1.0, top_p=1e-6, min_p=0.0, repetition_penalty=1.3)
+
+
+def test_batched_greedy_decoding_matches_solo(t3):
+    cond = make_cond(t3)
+    requests = [
+        (make_text(t3, n=5), dict(max_new_tokens=15, cfg_weight=0.5)),
+        (make_text(t3, n=20, seed=3, cfg=False), dict(max_new_tokens=25, cfg_weight=0.0)),
+        (make_text(t3, n=12, seed=4), dict(max_new_tokens=20, cfg_weight=0.5, cfg_max_tokens=6)),
+    ]
+    solo = [t3.inference(t3_cond=cond, text_tokens=text, **GREEDY, **kw) for text, kw in requests]
+
+    # (two slots, so the last request joins a batch that is already decoding)
+    scheduler = T3BatchScheduler(t3, max_batch_size=2)
+    futures = [scheduler.submit(cond, text, **GREEDY, **kw) for text, kw in requests]
+    scheduler.run_until_complete()
+    for future, expected in zip(futures, solo):
+        assert future.result().tolist() == expected.tolist()
+
+
+def _decode(forward, cache, embeds, chunks):
+    "Hidden states of `embeds` fed `chunks` positions at a time (prefill, then single tokens) over `cache`"
+    outputs, start = [], 0
+    for n in chunks:
+        outputs.append(forward(embeds[:, start:start + n], cache))
+        start += n
+    return torch.cat(outputs, dim=1)
+
+
+@torch.inference_mode()
+def test_static_cache_matches_dynamic_cache(t3):
+    # conditioning, then text on top of it (a multi-token step over a filled cache), then speech tokens one by one
+    chunks = [12, 8] + [1] * 5
+    embeds = torch.randn(2, sum(chunks), t3.cfg.hidden_size, generator=torch.Generator().manual_seed(0))
+    forward = lambda x, cache: t3.tfmr(inputs_embeds=x, past_key_values=cache, use_cache=True).last_hidden_state
+
+    static = StaticKVCache.for_model(t3.cfg, batch_size=2, max_len=embeds.size(1), dtype=embeds.dtype, device="cpu")
+    torch.testing.assert_close(
+        _decode(forward, static, embeds, chunks),
+        _decode(forward, DynamicCache(), embeds, chunks),
+    )
+
+
+@torch.inference_mode()
+def test_gpt2_forward_matches_hf(t3_turbo):
+    chunks = [12, 8] + [1] * 5
+    embeds = torch.randn(2, sum(chunks), t3_turbo.cfg.hidden_size, generator=torch.Generator().manual_seed(0))
+    static = StaticKVCache.for_model(
+        t3_turbo.cfg, batch_size=2, max_len=embeds.size(1), dtype=embeds.dtype, device="cpu"
+    )
+    expected, past = [], None
+    start = 0
+    for n in chunks:
+        # (HF GPT-2 grows a legacy tuple cache)
+        output = t3_turbo.tfmr(inputs_embeds=embeds[:, start:start + n], past_key_values=past, use_cache=True)
+        expected.append(output.last_hidden_state)
+        past = output.past_key_values
+        start += n
+    torch.testing.assert_close(
+        _decode(lambda x, cache: gpt2_forward(t3_turbo.tfmr, x, cache), static, embeds, chunks),
+        torch.cat(expected, dim=1),
+        rtol=1e-4,
+        atol=1e-4,
+    )